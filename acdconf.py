@@ -12,3 +12,42 @@ negativesfolder = os.path.join(imagesrootfolder, "negatives")
 jsonfolder = os.path.join(datarootfolder, "json")
 bboxesfolder = os.path.join(jsonfolder, "boundingboxes")
 metadatafolder = os.path.join(jsonfolder, "metadata")
+# voc-dpm MATLAB code
+vocdpmfolder = "voc-dpm-anime"
+# caches
+cachefolder = "cache"
+imagecachefolder = os.path.join(cachefolder, "images")
+# maximum size of the decoded images kept in memory, in bytes
+imagecachebytes = 512 * 1024 * 1024
+# maximum size of the decoded images kept on disk, in bytes, least recently used
+# ones being removed beyond it
+imagecachediskbytes = 8 * 1024 * 1024 * 1024
+# single file store of all the annotations, see annotations.py
+annotationsfile = os.path.join(jsonfolder, "annotations.sqlite")
+# perceptual hashes of the source images, see duplicates.py
+hashindexfile = os.path.join(cachefolder, "phash.json")
+# maximum hamming distance between the hashes of near duplicate images
+duplicateradius = 8
+# fraction of the data file of a patch store of negatives.py left unreferenced by
+# images processed again, beyond which the file is rewritten without it
+patchstoreslack = 0.5
+# feature pyramids shared by the folds of a cross validation, see crossvalidation.py
+featurecachefolder = os.path.join(cachefolder, "features")
+# instrumentation of the pipeline, see instrumentation.py, also turned on by the
+# ACD_INSTRUMENT environment variable
+instrument = False
+instrumentfolder = os.path.join(cachefolder, "instrumentation")
+# profile instrumented runs with cProfile, and tracemalloc where available
+profile = False
+# tiled detection of large images, see tiling.py: memory budget of the feature
+# pyramid of each tile in bytes, and overlap between tiles in pixels
+tilebytes = 512 * 1024 * 1024
+tileoverlap = 512
+# detection of video and image streams, see streaming.py: number of frames detected
+# at once, maximum number of decoded frames waiting for detection, maximum hamming
+# distance between the perceptual hashes of frames of the same shot, and maximum
+# number of frames in a row reusing the detections of an earlier frame
+streambatchsize = 8
+streamqueuesize = 32
+sceneradius = 10
+maxreuse = 24
@@ -0,0 +1,291 @@
+""" Storage of the annotations of the dataset, i.e. the bounding boxes of the characters
+in each image and the metadata scraped along with it.
+
+Annotations were historically stored as one <stem>_bb.json file per image in
+acdconf.bboxesfolder, and one <stem>.json metadata file per image in
+acdconf.metadatafolder. AnnotationStore keeps all of them in a single sqlite file
+instead, indexed by stem and character name, and can import from and export to the
+json layout. JsonAnnotations reads the json layout through the same interface, so
+tools can work with either.
+
+Bounding boxes use the same format as negatives.py: [[ulx,uly],[drx,dry]].
+"""
+import sqlite3
+import json
+import os
+import os.path
+import time
+import argparse
+import acdconf as conf
+
+_schema = """
+create table if not exists images (
+    stem text primary key,
+    character text not null,
+    metadata text,
+    bboxesmtime real
+);
+create index if not exists images_character on images (character);
+create table if not exists boxes (
+    stem text not null,
+    idx integer not null,
+    ulx integer not null,
+    uly integer not null,
+    drx integer not null,
+    dry integer not null,
+    primary key (stem, idx)
+);
+"""
+
+def character_name(stem):
+    """ Name of the character in an image, from its stem as written by the scraper,
+        i.e. the words of the search query separated by _ followed by an index.
+    """
+    return ' '.join(stem.split('_')[:-1])
+
+class AnnotationStore:
+    """ Annotations of the dataset stored in a single sqlite file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_schema)
+
+    def close(self):
+        self.connection.close()
+
+    def _addimages(self, stems):
+        self.connection.executemany(
+            "insert or ignore into images (stem, character) values (?, ?)",
+            [(stem, character_name(stem)) for stem in stems])
+
+    def putboxes(self, stembboxes, mtimes=None):
+        """ Sets the bounding boxes of many images at once, in a single transaction.
+        Args:
+            stembboxes (dict): bounding boxes of each stem, replacing existing ones.
+            mtimes (dict): modification time to record for each stem, the current
+                time by default.
+        """
+        now = time.time()
+        if mtimes == None:
+            mtimes = {}
+        with self.connection:
+            self._addimages(stembboxes.keys())
+            self.connection.executemany("delete from boxes where stem = ?",
+                                        [(stem,) for stem in stembboxes])
+            self.connection.executemany(
+                "insert into boxes values (?, ?, ?, ?, ?, ?)",
+                [(stem, i, ulx, uly, drx, dry)
+                 for stem, bboxes in stembboxes.items()
+                 for i, [[ulx,uly],[drx,dry]] in enumerate(bboxes)])
+            self.connection.executemany(
+                "update images set bboxesmtime = ? where stem = ?",
+                [(mtimes.get(stem, now), stem) for stem in stembboxes])
+
+    def setboxes(self, stem, bboxes):
+        """ Sets the bounding boxes of an image.
+        """
+        self.putboxes({stem: bboxes})
+
+    def putmetadata(self, stemmetadata):
+        """ Sets the metadata of many images at once, in a single transaction.
+        Args:
+            stemmetadata (dict): json serializable metadata of each stem.
+        """
+        with self.connection:
+            self._addimages(stemmetadata.keys())
+            self.connection.executemany(
+                "update images set metadata = ? where stem = ?",
+                [(json.dumps(metadata, default=repr), stem)
+                 for stem, metadata in stemmetadata.items()])
+
+    def hasboxes(self, stem):
+        """ True if and only if the image was annotated with bounding boxes, possibly
+            none of them.
+        """
+        return self.mtime(stem) != None
+
+    def boxes(self, stem):
+        """ Bounding boxes of an image, or None if it was not annotated.
+        """
+        if not self.hasboxes(stem):
+            return None
+        return [[[ulx,uly],[drx,dry]] for ulx, uly, drx, dry
+                in self.connection.execute(
+                    "select ulx, uly, drx, dry from boxes where stem = ? order by idx",
+                    (stem,))]
+
+    def allboxes(self):
+        """ Bounding boxes of all annotated images, loaded in a single query.
+        Returns:
+            A dict mapping each annotated stem to its bounding boxes.
+        """
+        allboxes = dict([(stem, []) for (stem,) in self.connection.execute(
+                    "select stem from images where bboxesmtime is not null")])
+        for stem, ulx, uly, drx, dry in self.connection.execute(
+            "select stem, ulx, uly, drx, dry from boxes order by stem, idx"):
+            allboxes[stem].append([[ulx,uly],[drx,dry]])
+        return allboxes
+
+    def mtime(self, stem):
+        """ Time the bounding boxes of an image were last set, None if they never were.
+        """
+        row = self.connection.execute(
+            "select bboxesmtime from images where stem = ?", (stem,)).fetchone()
+        return None if row == None else row[0]
+
+    def metadata(self, stem):
+        """ Metadata of an image, or None if there is none.
+        """
+        row = self.connection.execute(
+            "select metadata from images where stem = ?", (stem,)).fetchone()
+        return None if row == None or row[0] == None else json.loads(row[0])
+
+    def stems(self, character=None):
+        """ Sorted stems of all the images, or only those of a given character.
+        """
+        if character == None:
+            rows = self.connection.execute("select stem from images order by stem")
+        else:
+            rows = self.connection.execute(
+                "select stem from images where character = ? order by stem",
+                (character,))
+        return [stem for (stem,) in rows]
+
+    def characters(self):
+        """ Sorted names of all the characters in the dataset.
+        """
+        return [character for (character,) in self.connection.execute(
+                "select distinct character from images order by character")]
+
+    def importjson(self, bboxesfolder, metadatafolder=None):
+        """ Imports all the <stem>_bb.json files of a folder, and <stem>.json metadata
+            files if a metadata folder is given.
+        Returns:
+            The number of bounding boxes and metadata files imported.
+        """
+        jsonannotations = JsonAnnotations(bboxesfolder)
+        stembboxes = {}
+        mtimes = {}
+        for stem in jsonannotations.stems():
+            stembboxes[stem] = jsonannotations.boxes(stem)
+            # Keep the modification times, so importing does not look like the boxes
+            # were all changed.
+            mtimes[stem] = jsonannotations.mtime(stem)
+        self.putboxes(stembboxes, mtimes)
+        stemmetadata = {}
+        if metadatafolder != None:
+            for filename in os.listdir(metadatafolder):
+                if filename.endswith('.json'):
+                    jsonfile = open(os.path.join(metadatafolder, filename))
+                    stemmetadata[filename[:-len('.json')]] = json.load(jsonfile)
+                    jsonfile.close()
+            self.putmetadata(stemmetadata)
+        return len(stembboxes), len(stemmetadata)
+
+    def exportjson(self, bboxesfolder, metadatafolder=None):
+        """ Writes the annotations back to the json layout.
+        """
+        for stem, bboxes in self.allboxes().items():
+            jsonfile = open(os.path.join(bboxesfolder, stem + '_bb.json'), 'w')
+            json.dump(bboxes, jsonfile)
+            jsonfile.close()
+        if metadatafolder != None:
+            for stem, metadata in self.connection.execute(
+                "select stem, metadata from images where metadata is not null"):
+                jsonfile = open(os.path.join(metadatafolder, stem + '.json'), 'w')
+                json.dump(json.loads(metadata), jsonfile, indent = 4)
+                jsonfile.close()
+
+class JsonAnnotations:
+    """ Access to annotations in the json layout, with the same interface as
+        AnnotationStore for reading and setting bounding boxes.
+    """
+    def __init__(self, bboxesfolder, metadatafolder=None):
+        self.bboxesfolder = bboxesfolder
+        self.metadatafolder = metadatafolder
+
+    def close(self):
+        pass
+
+    def _bboxesfilename(self, stem):
+        return os.path.join(self.bboxesfolder, stem + '_bb.json')
+
+    def setboxes(self, stem, bboxes):
+        jsonfile = open(self._bboxesfilename(stem), 'w')
+        json.dump(bboxes, jsonfile)
+        jsonfile.close()
+
+    def hasboxes(self, stem):
+        return os.path.isfile(self._bboxesfilename(stem))
+
+    def boxes(self, stem):
+        if not self.hasboxes(stem):
+            return None
+        jsonfile = open(self._bboxesfilename(stem))
+        bboxes = json.load(jsonfile)
+        jsonfile.close()
+        return bboxes
+
+    def allboxes(self):
+        return dict([(stem, self.boxes(stem)) for stem in self.stems()])
+
+    def mtime(self, stem):
+        if not self.hasboxes(stem):
+            return None
+        return os.path.getmtime(self._bboxesfilename(stem))
+
+    def metadata(self, stem):
+        if self.metadatafolder == None:
+            return None
+        filename = os.path.join(self.metadatafolder, stem + '.json')
+        if not os.path.isfile(filename):
+            return None
+        jsonfile = open(filename)
+        metadata = json.load(jsonfile)
+        jsonfile.close()
+        return metadata
+
+    def stems(self, character=None):
+        stems = sorted([f[:-len('_bb.json')] for f in os.listdir(self.bboxesfolder)
+                        if f.endswith('_bb.json')])
+        if character != None:
+            stems = [stem for stem in stems if character_name(stem) == character]
+        return stems
+
+    def characters(self):
+        return sorted(set([character_name(stem) for stem in self.stems()]))
+
+def open_annotations(path, metadatafolder=None, create=False):
+    """ Opens annotations from either a sqlite store file or a folder of _bb.json
+        files.
+    Args:
+        path (str): store file or bounding boxes folder.
+        metadatafolder (str): folder of the metadata files of a bounding boxes
+            folder.
+        create (bool): True to create a new empty store if there is nothing at path.
+            Otherwise a missing path, e.g. a mistyped folder, raises IOError rather
+            than giving an empty store.
+    """
+    if os.path.isdir(path):
+        return JsonAnnotations(path, metadatafolder)
+    if not create and not os.path.isfile(path):
+        raise IOError("No annotations store or bounding boxes folder at " + path)
+    return AnnotationStore(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts annotations between the json layout and a store.")
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('--store', default=conf.annotationsfile)
+    parser.add_argument('--bboxes', default=conf.bboxesfolder)
+    parser.add_argument('--metadata', default=conf.metadatafolder)
+    args = parser.parse_args()
+    store = AnnotationStore(args.store)
+    if args.command == 'import':
+        nbbboxes, nbmetadata = store.importjson(args.bboxes, args.metadata)
+        print ("imported " + repr(nbbboxes) + " bounding boxes and "
+               + repr(nbmetadata) + " metadata files")
+    else:
+        store.exportjson(args.bboxes, args.metadata)
+    store.close()
@@ -0,0 +1,275 @@
+""" Benchmarks of the stages of the pipeline on seeded synthetic data, so they run
+without the chardetect-data submodule and give the same data on every machine.
+
+Each stage is timed over a sweep of data sizes: negatives.negative_samples_boxes with
+both engines over growing numbers of boxes, the crop and write loop of
+negatives.batch_negatives over growing numbers of images in each output mode,
+building, saving and streaming folds as makefolds.py does, and detection batches
+through DPMObjectDetection with stub backends, which measures pooling and batching
+overhead without MATLAB.
+
+Results are saved as json, one entry per stage and size with the minimum and median
+time of the repetitions, and two result files are compared to flag the stages whose
+minimum time grew by more than a threshold:
+
+python benchmarks.py run results.json
+python benchmarks.py compare baseline.json results.json --threshold 0.2
+"""
+import numpy as np
+import cv2
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import acdconf as conf
+import annotations
+import dpmDetection as dpmd
+import folds
+import imagecache
+import negatives as neg
+
+def synthetic_boxes(rng, rows, cols, nbboxes, maxsize=200):
+    """ Generates nbboxes random bounding boxes within a rows x cols image.
+    """
+    ul = np.stack([rng.randint(0, cols, nbboxes), rng.randint(0, rows, nbboxes)],
+                  axis=1)
+    size = rng.randint(1, maxsize, size=[nbboxes, 2])
+    dr = np.minimum(ul + size, [cols-1, rows-1])
+    return [[[int(x1),int(y1)],[int(x2),int(y2)]]
+            for [x1,y1],[x2,y2] in zip(ul, dr)]
+
+def synthetic_image(rng, rows, cols):
+    """ Generates a smooth random BGR image, which compresses like a drawing rather
+        than like noise.
+    """
+    noise = rng.randint(0, 256, [max(rows // 8, 1), max(cols // 8, 1), 3])
+    return cv2.resize(cv2.GaussianBlur(noise.astype(np.uint8), (0, 0), 2),
+                      (cols, rows))
+
+def synthetic_dataset(rng, folder, nbimages, rows=480, cols=640, nbboxes=5):
+    """ Writes jpeg images named after characters and their bounding boxes to a
+        folder, in the layout of the dataset.
+    Returns:
+        The images folder and the bounding boxes folder.
+    """
+    imagesfolder = os.path.join(folder, 'images')
+    bboxesfolder = os.path.join(folder, 'bboxes')
+    for f in [imagesfolder, bboxesfolder]:
+        os.makedirs(f)
+    source = annotations.JsonAnnotations(bboxesfolder)
+    for i in range(0, nbimages):
+        stem = 'character_' + repr(i % 20) + '_' + repr(i)
+        cv2.imwrite(os.path.join(imagesfolder, stem + '.jpg'),
+                    synthetic_image(rng, rows, cols))
+        source.setboxes(stem, synthetic_boxes(rng, rows, cols, nbboxes))
+    return imagesfolder, bboxesfolder
+
+class _Quiet:
+    """ Silences the progress printed by the timed code.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def bench_negative_boxes(rng, tmpfolder, quick):
+    """ negatives.negative_samples_boxes with both engines.
+    """
+    rows, cols = 1200, 1600
+    image = np.zeros([rows, cols, 3], dtype=np.uint8)
+    for nbboxes in [1, 10, 50] if quick else [1, 2, 5, 10, 20, 50, 100, 200, 500]:
+        bboxes = synthetic_boxes(rng, rows, cols, nbboxes)
+        for engine in neg.engines:
+            yield (engine + '/boxes=' + repr(nbboxes),
+                   lambda bboxes=bboxes, engine=engine:
+                   neg.negative_samples_boxes(image, bboxes, engine))
+
+def bench_crop_write(rng, tmpfolder, quick):
+    """ Cropping the negatives of a folder of images and writing them in each output
+        mode of negatives.batch_negatives. The image cache is warm after the first
+        repetition, as it is when negatives are computed again.
+    """
+    for nbimages in [4, 16] if quick else [10, 50, 200]:
+        folder = os.path.join(tmpfolder, 'crop_' + repr(nbimages))
+        imagesfolder, bboxesfolder = synthetic_dataset(rng, folder, nbimages)
+        for mode in neg.outputmodes:
+            outputfolder = os.path.join(folder, mode)
+            os.makedirs(outputfolder)
+            def run(outputfolder=outputfolder, mode=mode):
+                # Without the manifest, all the images are processed again
+                manifestfilename = os.path.join(outputfolder, 'manifest.json')
+                if os.path.isfile(manifestfilename):
+                    os.remove(manifestfilename)
+                with _Quiet():
+                    neg.batch_negatives(imagesfolder, bboxesfolder, outputfolder,
+                                        mode=mode)
+            yield mode + '/images=' + repr(nbimages), run
+
+def bench_folds(rng, tmpfolder, quick):
+    """ Building and saving 5 folds as makefolds.py does, then streaming the names
+        of their negatives.
+    """
+    for nbimages in [100, 1000] if quick else [100, 1000, 10000]:
+        folder = os.path.join(tmpfolder, 'folds_' + repr(nbimages))
+        positivesfolder = os.path.join(folder, 'positives')
+        negativesfolder = os.path.join(folder, 'negatives')
+        for f in [positivesfolder, negativesfolder]:
+            os.makedirs(f)
+        # Only names matter to folds, so files are empty
+        for i in range(0, nbimages):
+            stem = 'character_' + repr(i % 20) + '_' + repr(i)
+            open(os.path.join(positivesfolder, stem + '.jpg'), 'w').close()
+            for j in range(0, rng.randint(1, 6)):
+                open(os.path.join(negativesfolder, neg.negative_filename(stem, j)),
+                     'w').close()
+        def run(positivesfolder=positivesfolder, negativesfolder=negativesfolder,
+                folder=folder):
+            manifest = folds.FoldManifest.build(5, positivesfolder, negativesfolder,
+                                                seed=0)
+            manifest.save(os.path.join(folder, folds.manifestname))
+            manifest = folds.open_folds(folder)
+            for fold in range(0, len(manifest)):
+                for negative in manifest.negativefiles(manifest.complement([fold])):
+                    pass
+        yield 'images=' + repr(nbimages), run
+
+def bench_detection(rng, tmpfolder, quick):
+    """ Detection batches through DPMObjectDetection with stub backends.
+    """
+    for nbimages in [16, 64] if quick else [16, 128, 1024]:
+        images = [synthetic_image(rng, 240, 320) for i in range(0, nbimages)]
+        for nbsessions in [1, 4]:
+            detector = dpmd.DPMObjectDetection(nbsessions, dpmd.StubBackend)
+            detector.setModel('stub')
+            yield ('sessions=' + repr(nbsessions) + '/images=' + repr(nbimages),
+                   lambda detector=detector, images=images:
+                   detector.detectBatch(images, 0, 10))
+            detector.close()
+
+# Stages, in the order they run.
+stages = [
+    ('negative_samples_boxes', bench_negative_boxes),
+    ('crop_write', bench_crop_write),
+    ('folds', bench_folds),
+    ('detection', bench_detection)
+    ]
+
+def run(names=None, repeat=3, quick=False, seed=0):
+    """ Runs benchmarks.
+    Args:
+        names (list): names of the stages to run, None for all of them.
+        repeat (int): number of times each benchmark is timed.
+        quick (bool): True for smaller sweeps, e.g. to check the benchmarks work.
+        seed (int): seed of the synthetic data.
+    Returns:
+        A dict with the environment the benchmarks ran in, and the results as a dict
+        mapping 'stage/parameters' names to their minimum and median times.
+    """
+    results = {}
+    tmpfolder = tempfile.mkdtemp()
+    # Keep the image cache of the benchmarks away from the one of the dataset
+    defaultcache = imagecache.defaultcache
+    imagecache.defaultcache = imagecache.ImageCache(
+        os.path.join(tmpfolder, 'imagecache'), conf.imagecachebytes)
+    try:
+        for stage, bench in stages:
+            if names != None and stage not in names:
+                continue
+            rng = np.random.RandomState(seed)
+            for name, function in bench(rng, tmpfolder, quick):
+                times = timeit.repeat(function, number=1, repeat=repeat)
+                results[stage + '/' + name] = {'min': min(times),
+                                               'median': float(np.median(times)),
+                                               'repeat': repeat}
+    finally:
+        imagecache.defaultcache = defaultcache
+        shutil.rmtree(tmpfolder)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'seed': seed,
+            'quick': quick,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+            },
+        'results': results
+        }
+
+def save(report, filename):
+    jsonfile = open(filename, 'w')
+    json.dump(report, jsonfile, indent=4, sort_keys=True)
+    jsonfile.close()
+
+def load(filename):
+    jsonfile = open(filename)
+    report = json.load(jsonfile)
+    jsonfile.close()
+    return report
+
+def compare(baseline, current, threshold=0.1):
+    """ Compares the minimum times of two benchmark runs.
+    Args:
+        baseline, current (dict): reports as returned by run.
+        threshold (float): relative slowdown above which a benchmark is a
+            regression, e.g. 0.1 for 10% slower.
+    Returns:
+        A list of (name, baseline time, current time, ratio) for the benchmarks of
+        both runs, in order of name, and the list of names of the regressions.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before = baseline['results'][name]['min']
+        after = current['results'][name]['min']
+        ratio = after / max(before, 1e-12)
+        rows.append((name, before, after, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline on synthetic data, or compares runs.")
+    subparsers = parser.add_subparsers(dest='command')
+    runparser = subparsers.add_parser('run', help="run benchmarks")
+    runparser.add_argument('output', help="json file to write the results to")
+    runparser.add_argument('--stages', nargs='+', choices=[s for s, b in stages],
+                           default=None)
+    runparser.add_argument('--repeat', type=int, default=3)
+    runparser.add_argument('--quick', action='store_true',
+                           help="smaller data sizes")
+    runparser.add_argument('--seed', type=int, default=0)
+    compareparser = subparsers.add_parser('compare',
+                                          help="flag regressions between runs")
+    compareparser.add_argument('baseline')
+    compareparser.add_argument('current')
+    compareparser.add_argument('--threshold', type=float, default=0.1,
+                               help="relative slowdown flagged as a regression")
+    args = parser.parse_args()
+    if args.command == 'run':
+        report = run(args.stages, args.repeat, args.quick, args.seed)
+        save(report, args.output)
+        for name, result in sorted(report['results'].items()):
+            print "%-50s %10.5f %10.5f" % (name, result['min'], result['median'])
+    else:
+        rows, regressions = compare(load(args.baseline), load(args.current),
+                                    args.threshold)
+        for name, before, after, ratio in rows:
+            print "%-50s %10.5f %10.5f %7.2fx%s" % (
+                name, before, after, ratio,
+                "  REGRESSION" if name in regressions else "")
+        if regressions != []:
+            print (repr(len(regressions)) + " benchmarks slower by more than "
+                   + repr(int(round(100 * args.threshold))) + "%")
+            sys.exit(1)
@@ -0,0 +1,231 @@
+""" Cascade detection with deformable parts models, as in Felzenszwalb, Girshick and
+McAllester, "Cascade Object Detection with Deformable Part Models".
+
+Instead of scoring every root location with all the parts, parts are added one at a
+time and locations whose partial score falls below the threshold of the current
+stage are dropped. Part responses are only computed at the placements surviving
+locations need, within a bounded displacement around the anchor of the part.
+
+Thresholds are learned from positive examples as the probably approximately
+admissible thresholds of the paper: the lowest partial score at each stage among the
+detections of the positives by the exhaustive detector, or a quantile of them to
+trade recall for speed.
+"""
+import numpy as np
+import json
+import time
+import dpmscoring as dpms
+import geometry
+import imagecache
+import folds
+
+class Cascade:
+    def __init__(self, thresholds, radius=4):
+        """ Initializes a cascade.
+        Args:
+            thresholds (list): for each component of the model, the minimum partial
+                score after the root then after each part, -inf to keep all
+                locations at a stage.
+            radius (int): maximum displacement of parts from their anchor, in part
+                cells.
+        """
+        self.thresholds = [np.asarray(t, dtype=np.float64) for t in thresholds]
+        self.radius = radius
+
+    def score_level(self, model, rootfeat, partfeat, padx, pady, method='direct'):
+        """ Scores the root locations of one pyramid level surviving the cascade, see
+            dpmscoring.score_level.
+        Returns:
+            For each component, the (rows, cols) map of scores of its root at each
+            location, -inf where the location was pruned or parts do not fit.
+        """
+        rootresponses = dpms.convolve(rootfeat, [c.root for c in model.components],
+                                      method)
+        r = np.arange(-self.radius, self.radius + 1)
+        dy, dx = [d.ravel() for d in np.meshgrid(r, r, indexing='ij')]
+        scores = []
+        for component, rootscore, t in zip(model.components, rootresponses,
+                                           self.thresholds):
+            total = (rootscore + component.bias).ravel()
+            alive = np.nonzero(total >= t[0])[0]
+            total = total[alive]
+            for j, part in enumerate(component.parts):
+                if alive.size == 0:
+                    break
+                ph, pw, d = part.filter.shape
+                H, W = partfeat.shape[0] - ph + 1, partfeat.shape[1] - pw + 1
+                ys, xs = np.divmod(alive, rootscore.shape[1])
+                anchory, anchorx = dpms.part_anchors(ys, xs, part.anchor, padx, pady)
+                inside = (anchory >= 0) & (anchory < H) & (anchorx >= 0) & (anchorx < W)
+                alive, total = alive[inside], total[inside]
+                anchory, anchorx = anchory[inside], anchorx[inside]
+                # (locations, displacements) placements of the part
+                py = anchory[:,np.newaxis] + dy
+                px = anchorx[:,np.newaxis] + dx
+                valid = (py >= 0) & (py < H) & (px >= 0) & (px < W)
+                # Filter response at each distinct placement only
+                placements, inverse = np.unique((py * W + px)[valid],
+                                                return_inverse=True)
+                windows = np.lib.stride_tricks.as_strided(
+                    partfeat, [max(H, 0), max(W, 0), ph, pw, d],
+                    partfeat.strides[0:2] + partfeat.strides)
+                uy, ux = np.divmod(placements, max(W, 1))
+                response = windows[uy, ux].reshape([placements.size, -1]).dot(
+                    part.filter.ravel())
+                ax, bx, ay, by = part.defcost
+                cost = ax * dx**2 + bx * dx + ay * dy**2 + by * dy
+                values = np.full(py.shape, -np.inf)
+                values[valid] = (response[inverse]
+                                 - np.broadcast_to(cost, py.shape)[valid])
+                total = total + values.max(axis=1)
+                keep = total >= t[j + 1]
+                alive, total = alive[keep], total[keep]
+            score = np.full(rootscore.size, -np.inf)
+            score[alive] = total
+            scores.append(score.reshape(rootscore.shape))
+        return scores
+
+def savecascade(cascade, filename):
+    """ Exports the thresholds of a cascade to a json file.
+    """
+    jsonfile = open(filename, 'w')
+    json.dump({'radius': cascade.radius,
+               'thresholds': [t.tolist() for t in cascade.thresholds]}, jsonfile)
+    jsonfile.close()
+
+def loadcascade(filename):
+    """ Loads a cascade exported by savecascade.
+    """
+    jsonfile = open(filename)
+    data = json.load(jsonfile)
+    jsonfile.close()
+    return Cascade(data['thresholds'], data['radius'])
+
+def fold_positives(foldspath, foldidxs, annotationsource):
+    """ Positive images of some folds, with their bounding boxes.
+    Args:
+        foldspath (str): fold manifest or folds folder, see folds.open_folds.
+        foldidxs (list): indices of the folds to take positives from.
+        annotationsource: AnnotationStore or JsonAnnotations with the bounding boxes.
+    Returns:
+        A list of (imagefilename, bboxes) pairs, for annotated images only.
+    """
+    positives = []
+    for stem, imagefilename in folds.open_folds(foldspath).positives(foldidxs):
+        bboxes = annotationsource.boxes(stem)
+        if bboxes != None and bboxes != []:
+            positives.append((imagefilename, bboxes))
+    return positives
+
+def _examples(positives):
+    """ Images and bounding boxes of positives given either as images or filenames.
+    """
+    for image, bboxes in positives:
+        if isinstance(image, basestring):
+            image = imagecache.imread(image)
+            if image is None:
+                continue
+        yield image, bboxes
+
+def partial_scores(model, pyramid, bboxes, minoverlap=0.7, method='direct'):
+    """ Partial scores of the exhaustive detections of ground truth boxes, i.e. of the
+        best scoring root location overlapping each box enough.
+    Returns:
+        A list of (component, partials) pairs, one per box with such a location,
+        partials being the cumulative score after the root then after each part.
+    """
+    haveparts = any([c.parts != [] for c in model.components])
+    gtboxes = geometry.toarray(bboxes)
+    best = [(-np.inf, None, None)] * len(gtboxes)
+    for l in range(pyramid.interval if haveparts else 0, len(pyramid)):
+        levelcontributions = dpms.component_scores(
+            model, pyramid.feat[l],
+            pyramid.feat[l - pyramid.interval] if haveparts else None,
+            pyramid.padx, pyramid.pady, method)
+        for c, (component, contributions) in enumerate(zip(model.components,
+                                                           levelcontributions)):
+            partials = np.cumsum(contributions, axis=0)
+            ys, xs = np.nonzero(partials[-1] > -np.inf)
+            if ys.size == 0:
+                continue
+            boxes = dpms.location_boxes(pyramid, l, component.root, xs, ys)
+            ious = geometry.pairwise_iou(gtboxes, boxes)
+            for i in range(0, len(gtboxes)):
+                candidates = np.nonzero(ious[i] >= minoverlap)[0]
+                if candidates.size == 0:
+                    continue
+                k = candidates[np.argmax(partials[-1][ys[candidates], xs[candidates]])]
+                if partials[-1][ys[k], xs[k]] > best[i][0]:
+                    best[i] = (partials[-1][ys[k], xs[k]], c, partials[:, ys[k], xs[k]])
+    return [(c, partials) for score, c, partials in best if c != None]
+
+def calibrate(model, positives, thresh, recall=1.0, minoverlap=0.7, radius=4,
+              method='direct'):
+    """ Learns the thresholds of a cascade from positive examples.
+    Args:
+        model (DPMModel): model to build a cascade for.
+        positives (iterable): (image, bboxes) pairs, images being BGR arrays or
+            filenames, e.g. from fold_positives.
+        thresh (float): detection threshold the cascade will be used with. Only
+            positives the exhaustive detector finds above it are used.
+        recall (float): fraction of those positives each stage should keep, 1 for the
+            lowest partial scores.
+        minoverlap (float): minimum overlap of a detection with a ground truth box.
+        radius (int): maximum displacement of parts, see Cascade.
+    Returns:
+        The Cascade. Components without any positive do not prune at all.
+    """
+    builder = model.pyramidbuilder()
+    partials = [[] for c in model.components]
+    for image, bboxes in _examples(positives):
+        pyramid = builder.build(image)
+        for c, p in partial_scores(model, pyramid, bboxes, minoverlap, method):
+            if p[-1] >= thresh:
+                partials[c].append(p)
+    thresholds = []
+    for component, p in zip(model.components, partials):
+        if p == []:
+            thresholds.append(np.full(len(component.parts) + 1, -np.inf))
+        else:
+            thresholds.append(np.percentile(np.array(p), 100 * (1 - recall), axis=0))
+    return Cascade(thresholds, radius)
+
+def _recall(detections, bboxes, minoverlap):
+    """ Number of ground truth boxes matched by some detection.
+    """
+    if detections == []:
+        return 0
+    boxes = geometry.toarray([bbox for bbox, score in detections])
+    ious = geometry.pairwise_iou(geometry.toarray(bboxes), boxes)
+    return int(np.sum(np.any(ious >= minoverlap, axis=1)))
+
+def compare(model, cascade, positives, thresh, max_num, minoverlap=0.5,
+            method='direct'):
+    """ Compares cascade detection with exhaustive detection on positive examples.
+    Returns:
+        A dict with the total detection times of both, not counting feature
+        pyramids, the speedup, the recall of both and the recall loss.
+    """
+    builder = model.pyramidbuilder()
+    times = {'exhaustive': 0.0, 'cascade': 0.0}
+    found = {'exhaustive': 0, 'cascade': 0}
+    nbboxes = 0
+    for image, bboxes in _examples(positives):
+        pyramid = builder.build(image)
+        nbboxes += len(bboxes)
+        for name, c in [('exhaustive', None), ('cascade', cascade)]:
+            start = time.time()
+            detections = dpms.detect(model, pyramid, thresh, max_num, method,
+                                     cascade=c)
+            times[name] += time.time() - start
+            found[name] += _recall(detections, bboxes, minoverlap)
+    recall = dict([(name, float(n) / max(nbboxes, 1)) for name, n in found.items()])
+    return {
+        'exhaustivetime': times['exhaustive'],
+        'cascadetime': times['cascade'],
+        'speedup': times['exhaustive'] / max(times['cascade'], 1e-12),
+        'exhaustiverecall': recall['exhaustive'],
+        'cascaderecall': recall['cascade'],
+        'recallloss': recall['exhaustive'] - recall['cascade'],
+        'nbboxes': nbboxes
+        }
@@ -0,0 +1,283 @@
+""" Parallel k-fold cross validation of deformable parts models over the folds of a
+folds.FoldManifest.
+
+Each fold trains on the other folds and is evaluated on its own positives, in its own
+worker process with its own detector and backends, so folds never wait for the
+MATLAB session or the pool of another fold. When detecting natively, feature pyramids
+go through a featpyramid.PyramidStore shared by all the workers: the pyramid of an
+image, e.g. a negative patch the hard negative mining of each of the k-1 folds
+training on it scans, is computed once, then memory mapped read-only by every fold
+needing it. precompute fills the store fold by fold beforehand, so folds never
+compute the same pyramid concurrently.
+
+Each fold reports the average precision of its detections on its positives, see
+evaluation.py, its training and evaluation times, and the peak resident memory of
+its worker process. Folds run in the calling process only report the peak of the
+whole process.
+"""
+import numpy as np
+import functools
+import inspect
+import itertools
+import multiprocessing as mp
+import resource
+import time
+import os.path
+import dpmDetection as dpmd
+import dpmscoring as dpms
+import featpyramid as fp
+import evaluation
+import hardnegatives
+import imagecache
+
+def peak_memory():
+    """ Peak resident memory of this process so far, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MiningTrainer:
+    """ Trains the model of a fold with hardnegatives.train_with_mining, mining the
+        negatives of its training folds only.
+    """
+    def __init__(self, outputfolder, nbrounds, cachesize, budget, warp, nbiter,
+                 nbnegiter, maxnumexamples, overlap, numfp, cont, tag, C,
+                 thresh=-1.0):
+        """ Initializes the trainer.
+        Args:
+            outputfolder (str): folder to write the hard negatives of each fold to, in
+                a subfolder per fold.
+            tag (str): tag of the training runs, suffixed with the fold.
+            See hardnegatives.train_with_mining for the other arguments.
+        """
+        self.outputfolder = outputfolder
+        self.nbrounds = nbrounds
+        self.cachesize = cachesize
+        self.budget = budget
+        self.trainargs = (warp, nbiter, nbnegiter, maxnumexamples, overlap, numfp,
+                          cont)
+        self.tag = tag
+        self.C = C
+        self.thresh = thresh
+
+    def __call__(self, detector, model, manifest, trainfolds, positives, fold):
+        warp, nbiter, nbnegiter, maxnumexamples, overlap, numfp, cont = self.trainargs
+        return hardnegatives.train_with_mining(
+            detector, model, positives, lambda: manifest.negatives(trainfolds),
+            os.path.join(self.outputfolder, repr(fold)), self.nbrounds,
+            self.cachesize, self.budget, warp, nbiter, nbnegiter, maxnumexamples,
+            overlap, numfp, cont, self.tag + '_fold' + repr(fold), self.C,
+            self.thresh)
+
+def _trains(backendfactory):
+    """ Whether the backends of a factory train models, as far as can be told without
+        starting one: classes without a train method, or partial functions of them,
+        do not, and neither do the default native backends.
+    """
+    if backendfactory == None:
+        return False
+    factory = getattr(backendfactory, 'func', backendfactory)
+    return not inspect.isclass(factory) or hasattr(factory, 'train')
+
+def _runfold_worker((cv, fold)):
+    return cv.runfold(fold)
+
+def _precompute_worker((cv, fold)):
+    return cv.precomputefold(fold)
+
+class CrossValidation:
+    def __init__(self, manifest, annotationsource, model, backendfactory=None,
+                 trainer=None, featurefolder=None, nbsessions=1, thresh=-1.0,
+                 max_num=10, minoverlap=0.5, batchsize=8):
+        """ Initializes the cross validation.
+        Args:
+            manifest (folds.FoldManifest): folds to cross validate on.
+            annotationsource: AnnotationStore or JsonAnnotations with the bounding
+                boxes of the positives. Only annotated positives are evaluated on.
+            model: model to train each fold from, or list of models, one per fold, to
+                start from. Models are DPMModel or their filenames for the native
+                backend, whatever the backend loads otherwise.
+            backendfactory (function): picklable function without arguments returning
+                a new backend, e.g. dpmDetection.MatlabBackend, None for a
+                dpmscoring.NativeBackend sharing pyramids through the feature folder.
+                Workers are daemon processes, so native backends must score pyramid
+                levels in their own process.
+            trainer (function): picklable function of (detector, model, manifest,
+                trainfolds, positives, fold) returning the model of a fold trained on
+                the positives of its training folds, e.g. a MiningTrainer, or None to
+                evaluate the models as they are.
+            featurefolder (str): folder of the shared feature pyramids, None to
+                compute them in each worker.
+            nbsessions (int): number of backends of the detector of each fold.
+            thresh (float): minimum score of detections.
+            max_num (int): maximum number of detections per image.
+            minoverlap (float): minimum overlap of a detection with a ground truth
+                box for it to be correct.
+            batchsize (int): number of images given to detectBatch at once.
+        """
+        if isinstance(trainer, MiningTrainer) and not _trains(backendfactory):
+            raise ValueError("Training with hard negative mining requires backends "
+                             + "training models, e.g. dpmDetection.MatlabBackend")
+        self.manifest = manifest
+        # Boxes are read here, as annotation stores do not cross processes
+        self.positives = []
+        for fold in range(0, len(manifest)):
+            positives = []
+            for stem, imagefilename in manifest.positives([fold]):
+                bboxes = annotationsource.boxes(stem)
+                if bboxes != None and bboxes != []:
+                    positives.append((imagefilename, bboxes))
+            self.positives.append(positives)
+        self.model = model
+        self.backendfactory = backendfactory
+        self.trainer = trainer
+        self.featurefolder = featurefolder
+        self.nbsessions = nbsessions
+        self.thresh = thresh
+        self.max_num = max_num
+        self.minoverlap = minoverlap
+        self.batchsize = batchsize
+
+    def foldmodel(self, fold):
+        """ Model the training of a fold starts from.
+        """
+        return self.model[fold] if isinstance(self.model, list) else self.model
+
+    def detector(self):
+        """ New detector with its own backends, for the fold of this process.
+        """
+        backendfactory = self.backendfactory
+        if backendfactory == None:
+            backendfactory = functools.partial(dpms.NativeBackend,
+                                               featurefolder=self.featurefolder)
+        return dpmd.DPMObjectDetection(self.nbsessions, backendfactory)
+
+    def precomputefold(self, fold):
+        """ Stores the feature pyramids of the positives and negatives of a fold, for
+            the native models of all the folds.
+        Returns:
+            The number of images of the fold.
+        """
+        store = fp.PyramidStore(self.featurefolder)
+        builders = {}
+        for f in range(0, len(self.manifest)):
+            model = self.foldmodel(f)
+            if isinstance(model, basestring):
+                model = dpms.loadmodel(model)
+            builder = model.pyramidbuilder(0, store)
+            builders[(builder.sbin, builder.interval, builder.padx,
+                      builder.pady)] = builder
+        images = itertools.chain(
+            (imagecache.imread(f) for f, bboxes in self.positives[fold]),
+            (patch for key, patch in self.manifest.negatives([fold])))
+        nbimages = 0
+        for image in images:
+            if image is None:
+                continue
+            nbimages += 1
+            for builder in builders.values():
+                builder.build(image)
+        return nbimages
+
+    def runfold(self, fold):
+        """ Trains the model of a fold on the other folds, then evaluates it on the
+            positives of the fold.
+        Returns:
+            A dict with the fold, its average precision, numbers of images, ground
+            truth boxes and detections, training, evaluation and total times in
+            seconds, and the peak memory of the process in bytes.
+        """
+        start = time.time()
+        detector = self.detector()
+        try:
+            model = self.foldmodel(fold)
+            if self.trainer != None:
+                trainfolds = self.manifest.complement([fold])
+                model = self.trainer(detector, model, self.manifest, trainfolds,
+                                     [p for f in trainfolds for p in self.positives[f]],
+                                     fold)
+            detector.setModel(model)
+            traintime = time.time() - start
+            detections = {}
+            groundtruth = {}
+            positives = self.positives[fold]
+            for b in range(0, len(positives), self.batchsize):
+                batch = [(imagefilename, imagecache.imread(imagefilename), bboxes)
+                         for imagefilename, bboxes in positives[b:b+self.batchsize]]
+                batch = [(f, image, bboxes) for f, image, bboxes in batch
+                         if image is not None]
+                batchdetections = detector.detectBatch(
+                    [image for f, image, bboxes in batch], self.thresh, self.max_num)
+                for (imagefilename, image, bboxes), ds in zip(batch, batchdetections):
+                    detections[imagefilename] = ds
+                    groundtruth[imagefilename] = bboxes
+        finally:
+            detector.close()
+        result = evaluation.evaluate(detections, groundtruth, self.minoverlap)
+        walltime = time.time() - start
+        return {
+            'fold': fold,
+            'ap': result['ap'],
+            'nbimages': len(groundtruth),
+            'nbboxes': result['nbpositives'],
+            'nbdetections': result['nbdetections'],
+            'traintime': traintime,
+            'evaltime': walltime - traintime,
+            'walltime': walltime,
+            'peakmemory': peak_memory()
+            }
+
+    def _map(self, worker, folds, nbprocesses):
+        """ Runs a worker on each fold, in a new process per fold.
+        """
+        if nbprocesses == 1:
+            return map(worker, [(self, fold) for fold in folds])
+        # A fresh process per fold, so its peak memory is its own
+        pool = mp.Pool(nbprocesses, maxtasksperchild=1)
+        try:
+            return pool.map(worker, [(self, fold) for fold in folds], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def precompute(self, nbprocesses=None):
+        """ Fills the feature folder with the pyramids of all the images of the folds,
+            one fold per process.
+        Returns:
+            The number of images.
+        """
+        if self.featurefolder == None:
+            raise ValueError("No feature folder to precompute pyramids into.")
+        folds = range(0, len(self.manifest))
+        return sum(self._map(_precompute_worker, folds, nbprocesses))
+
+    def run(self, folds=None, nbprocesses=None):
+        """ Runs the folds, one process per fold.
+        Args:
+            folds (list): folds to run, None for all of them.
+            nbprocesses (int): maximum number of folds run at once, None for the
+                number of CPUs, 1 to run them in this process.
+        Returns:
+            A dict with the result of each fold as returned by runfold, their mean
+            average precision, the total time in seconds, and the largest peak memory
+            of a fold in bytes. Folds run in this process have no peak memory of
+            their own, None, and the peak memory is the one of this whole process.
+        """
+        if folds == None:
+            folds = range(0, len(self.manifest))
+        start = time.time()
+        results = self._map(_runfold_worker, folds, nbprocesses)
+        if nbprocesses == 1:
+            # The peak of this process includes earlier folds and whatever it did
+            # before them
+            for result in results:
+                result['peakmemory'] = None
+            peakmemory = peak_memory()
+        else:
+            peakmemory = max([r['peakmemory'] for r in results])
+        return {
+            'folds': results,
+            'meanap': float(np.mean([r['ap'] for r in results])),
+            'walltime': time.time() - start,
+            'peakmemory': peakmemory
+            }
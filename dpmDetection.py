@@ -1,55 +1,356 @@
+""" Object detection with deformable parts models as described by Felzenszwalb and
+    Girshick, through a pool of detection backends.
+
+A backend computes detections for one image at a time with a model loaded once. The
+MATLAB backend wraps the voc-dpm code through a pymatlab session, training examples
+being assembled into voc-dpm structs by matlab/acd_examples.m, and
+dpmscoring.NativeBackend scores exported models natively,
+optionally pruning locations with a cascade.Cascade. The stub backend
+returns synthetic detections without MATLAB, for testing the pooling and batching
+logic. Models are saved in the native format of dpmscoring.py with saveModel, e.g.
+after training through MATLAB. Very large images are detected tile by tile with
+bounded memory, see tiling.py.
+
+Detections are returned as lists of (bbox, score) pairs in decreasing order of score,
+with bbox = [[ulx,uly],[drx,dry]] as in negatives.py.
+"""
 import cv2
-import pymatlab as mlb
+import numpy as np
+import os
+import os.path
+import re
+import time
+import Queue
+from multiprocessing.pool import ThreadPool
+import acdconf as conf
+import dpmscoring as dpms
+import instrumentation as instr
+import tiling
+import vocdpm
+try:
+    import pymatlab as mlb
+except ImportError:
+    mlb = None
 
-class DPMObjectDetection:
-    def __init__(self):
+def detections_frommatlab(ds, max_num):
+    """ Converts voc-dpm detections, one [x1 y1 x2 y2 ... score] row per detection with
+        1-based coordinates, into (bbox, score) pairs.
+    """
+    ds = np.asarray(ds, dtype=np.float64)
+    if ds.size == 0:
+        return []
+    ds = ds.reshape([-1, ds.shape[-1]])
+    order = np.argsort(-ds[:,-1], kind='mergesort')[0:max_num]
+    return [([[int(round(x1))-1, int(round(y1))-1],
+              [int(round(x2))-1, int(round(y2))-1]], float(score))
+            for [x1, y1, x2, y2], score in zip(ds[order,0:4].tolist(),
+                                               ds[order,-1].tolist())]
+
+def examples_tomatlab(examples):
+    """ Converts training examples into the arrays matlab/acd_examples.m builds the
+        pos and neg structs of voc-dpm's train from, as pymatlab only passes numpy
+        arrays.
+    Args:
+        examples (list): image file names of negatives, or (imagefilename, bboxes)
+            pairs of positives with [[ulx,uly],[drx,dry]] boxes.
+    Returns:
+        The (nbimages, length) uint8 array of the absolute file names padded with
+        zeros, as training runs in another folder, and
+        the (nbboxes, 5) float64 array of [image x1 y1 x2 y2] rows with 1-based
+        image indices and coordinates, without rows for negatives.
+    """
+    names = [os.path.abspath(e if isinstance(e, basestring) else e[0])
+             for e in examples]
+    boxes = [[i + 1, ulx + 1, uly + 1, drx + 1, dry + 1]
+             for i, e in enumerate(examples) if not isinstance(e, basestring)
+             for [[ulx, uly], [drx, dry]] in e[1]]
+    length = max([len(n) for n in names] + [1])
+    namearray = np.zeros([len(names), length], dtype=np.uint8)
+    for i, name in enumerate(names):
+        namearray[i,0:len(name)] = np.frombuffer(name, dtype=np.uint8)
+    return namearray, np.array(boxes, dtype=np.float64).reshape([-1, 5])
+
+# MATLAB functions of this package, added to the path of the sessions
+matlabfolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'matlab')
+
+class TimedSession:
+    """ Proxy of a pymatlab session timing each round trip with instrumentation.py,
+        runs being timed per MATLAB function called.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def putvalue(self, name, value):
+        with instr.timer('matlab/putvalue', getattr(value, 'nbytes', 0)):
+            self.session.putvalue(name, value)
+
+    def run(self, command):
+        function = re.match(r"\s*(?:\w+\s*=\s*)?(\w*)", command).group(1)
+        with instr.timer('matlab/run/' + function):
+            self.session.run(command)
+
+    def getvalue(self, name):
+        with instr.timer('matlab/getvalue') as t:
+            value = self.session.getvalue(name)
+            t.nbytes = getattr(value, 'nbytes', 0)
+        return value
+
+class MatlabBackend:
+    """ Runs the voc-dpm MATLAB code in a pymatlab session.
+    """
+    def __init__(self, vocdpmfolder=conf.vocdpmfolder):
+        if mlb == None:
+            raise ImportError("pymatlab is required for the MATLAB backend")
         self.session = mlb.session_factory()
-        self.session.run('cd ./voc-dpm/')
+        if instr.enabled():
+            self.session = TimedSession(self.session)
+        self.session.run("cd '" + vocdpmfolder + "'")
+        self.session.run("startup")
+        self.session.run("addpath('" + matlabfolder + "')")
+
+    def loadmodel(self, model):
+        """ Pushes a model to the session, once for all subsequent detections.
+        """
+        self.session.putvalue('model', model)
+
+    def detect(self, image, thresh, max_num):
+        """ Detects objects in a BGR image with the loaded model.
+        """
+        self.session.putvalue('im', np.ascontiguousarray(image[:,:,::-1]))
+        self.session.putvalue('thresh', np.array(thresh, dtype=np.float64))
+        self.session.run("ds = imgdetect(im, model, thresh);")
+        self.session.run("if isempty(ds), ds = zeros(0,5); "
+                         + "else ds = ds(nms(ds, 0.5),:); end")
+        return detections_frommatlab(self.session.getvalue('ds'), max_num)
+
+    def savemodel(self, filename):
+        """ Saves the loaded model in the native format, through a .mat file.
+        """
+        matfilename = os.path.abspath(filename) + '.mat'
+        self.session.run("save('" + matfilename + "', 'model');")
+        try:
+            dpms.savemodel(vocdpm.import_model(matfilename), filename)
+        finally:
+            os.remove(matfilename)
+
+    def train(self, model, pos, neg, warp, randneg, nbiter, nbnegiter,
+              maxnumexamples, overlap, numfp, cont, tag, C):
+        """ Trains a model with the voc-dpm train function, see
+            DPMObjectDetection.trainDPMmodel.
+        """
+        self.session.run('cd ./train/')
+        self.session.putvalue('model', model)
+        # Examples are passed as arrays and assembled into structs in MATLAB
+        posnames, posboxes = examples_tomatlab(pos)
+        negnames, _ = examples_tomatlab(neg)
+        self.session.putvalue('posnames', posnames)
+        self.session.putvalue('posboxes', posboxes)
+        self.session.putvalue('negnames', negnames)
+        self.session.run('pos = acd_examples(posnames, posboxes);')
+        self.session.run('neg = acd_examples(negnames);')
+        for name, value in [('warp', warp), ('randneg', randneg), ('iter', nbiter),
+                            ('negiter', nbnegiter),
+                            ('max_num_examples', maxnumexamples),
+                            ('overlap', overlap), ('num_fp', numfp), ('cont', cont),
+                            ('C', C)]:
+            self.session.putvalue(name, np.array(value, dtype=np.float64))
+        self.session.run("tag = '" + tag.replace("'", "''") + "';")
+        self.session.run('nmodel = train(model,pos,neg,warp,randneg,iter,negiter,'
+                         + 'max_num_examples,overlap,num_fp,cont,tag,C)')
+        nmodel = self.session.getvalue('nmodel')
+        self.session.run('cd ../')
+        return nmodel
+
+    def close(self):
+        self.session = None
+
+class StubBackend:
+    """ Backend returning synthetic detections, so the pool can be tested without
+        MATLAB. By default, detects the whole image with its mean intensity as score.
+    """
+    def __init__(self, detector=None, delay=0):
+        """ Initializes the backend.
+        Args:
+            detector (function): function of an image and the model returning a list
+                of (bbox, score) pairs.
+            delay (float): time in seconds each detection takes.
+        """
+        self.detector = detector
+        self.delay = delay
+        self.model = None
+        self.nbloads = 0
+        self.nbdetections = 0
+
+    def loadmodel(self, model):
+        self.model = model
+        self.nbloads += 1
+
+    def detect(self, image, thresh, max_num):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        self.nbdetections += 1
+        if self.detector != None:
+            detections = self.detector(image, self.model)
+        else:
+            rows, cols = image.shape[0:2]
+            detections = [([[0,0],[cols-1,rows-1]], float(np.mean(image)))]
+        detections = sorted([d for d in detections if d[1] >= thresh],
+                            key=lambda d: d[1], reverse=True)
+        return detections[0:max_num]
+
+    def train(self, model, *args):
+        return model
+
+    def close(self):
+        pass
+
+class DetectionPool:
+    """ Pool of warm detection backends, each with the model loaded once. Batches of
+        images are spread across the backends, each of them processing one image at
+        a time.
+    """
+    def __init__(self, backendfactory, nbsessions):
+        """ Starts the backends.
+        Args:
+            backendfactory (function): function without arguments returning a new
+                backend, e.g. MatlabBackend.
+            nbsessions (int): number of backends to start.
+        """
+        self.backends = [backendfactory() for i in range(0, nbsessions)]
+        self.idle = Queue.Queue()
+        for backend in self.backends:
+            self.idle.put(backend)
+        self.threadpool = ThreadPool(nbsessions)
+
+    def loadmodel(self, model):
+        """ Loads a model into all the backends.
+        """
+        for backend in self.backends:
+            backend.loadmodel(model)
+
+    def run(self, function):
+        """ Runs a function of a backend on the next idle one.
+        """
+        backend = self.idle.get()
+        try:
+            return function(backend)
+        finally:
+            self.idle.put(backend)
+
+    def detectBatch(self, images, thresh, max_num):
+        """ Detects objects in a batch of images, in parallel across the backends.
+        Returns:
+            The detections of each image, in the same order as the images.
+        """
+        def detect(image):
+            with instr.timer('detection/image', image.nbytes):
+                return self.run(lambda b: b.detect(image, thresh, max_num))
+        return self.threadpool.map(detect, images, chunksize=1)
+
+    def close(self):
+        self.threadpool.close()
+        self.threadpool.join()
+        for backend in self.backends:
+            backend.close()
+
+class DPMObjectDetection:
+    def __init__(self, nbsessions=1, backendfactory=MatlabBackend):
+        """ Initializes the detector.
+        Args:
+            nbsessions (int): number of backends, e.g. MATLAB sessions, to detect
+                with in parallel.
+            backendfactory (function): function without arguments returning a new
+                backend, MatlabBackend by default.
+        """
+        self.pool = DetectionPool(backendfactory, nbsessions)
         self.model = None
 
-        def trainDPMmodel(self, model, pos, neg, warp, randneg, nbiter, nbnegiter, 
-                          maxnumexamples, overlap, numfp, cont, tag, C):
-            """ Trains a model opptimizing a WL-SSVM or LSVM. 
-            (thin wrapper around matlab code by Girshick, R. B.)
-            Returns:
-            model     The new model
-
-            Arguments
-            warp      1 => use warped positives
-                      0 => use latent positives
-            randneg   1 => use random negaties
-                      0 => use hard negatives
-            iter      The number of training iterations
-            negiter   The number of data-mining steps within each training iteration
-            max_num_examples  
-                      The maximum number of negative examples that the feature vector
-                      cache may hold
-            overlap   The minimum overlap in latent positive search
-            cont      True => restart training from a previous run
-            C         Regularization/surrogate loss tradeoff parameter
-            """
-            self.session.run('cd ./train/')
-            self.session.putvalue('model', model)
-            self.session.putvalue('pos', pos)
-            self.session.putvalue('neg', neg)
-            self.session.putvalue('warp', warp)
-            self.session.putvalue('randneg', randneg)
-            self.session.putvalue('iter', nbiter)
-            self.session.putvalue('negiter', nbnegiter)
-            self.session.putvalue('maximum_examples', maximumexamples)
-            self.session.putvalue('overlap', overlap)
-            self.session.putvalue('num_fp', numfp)
-            self.session.putvalue('cont', cont)
-            self.session.putvalue('tag', tag)
-            self.session.putvalue('C', C)
-            self.session.run('nmodel = train(model,pos,neg.warp,randneg,iter,negiter,max_num_exampples,overlap,num_fp,cont,tag,C)')
-            self.model = self.session.getvalue('nmodel')
-            self.session.run('cd ../')
-
-        def detectObject(image, thresh, max_num):
-            if self.model == None:
-                
-            self.session.run('cd ./features/')
-            self.session.putvalue('im', image)
-            self.session.putvalue('model', self.model)
-            
+    def setModel(self, model):
+        """ Sets the model to detect with, loading it once into each backend.
+        """
+        self.model = model
+        with instr.timer('detection/loadmodel'):
+            self.pool.loadmodel(model)
+
+    def trainDPMmodel(self, model, pos, neg, warp, randneg, nbiter, nbnegiter,
+                      maxnumexamples, overlap, numfp, cont, tag, C):
+        """ Trains a model opptimizing a WL-SSVM or LSVM.
+        (thin wrapper around matlab code by Girshick, R. B.)
+        Only backends with a train method, e.g. MatlabBackend, train models.
+        Returns:
+        model     The new model
+
+        Arguments
+        pos       Positives, as (imagefilename, bboxes) pairs
+        neg       Negatives, as image filenames
+        warp      1 => use warped positives
+                  0 => use latent positives
+        randneg   1 => use random negaties
+                  0 => use hard negatives
+        iter      The number of training iterations
+        negiter   The number of data-mining steps within each training iteration
+        max_num_examples
+                  The maximum number of negative examples that the feature vector
+                  cache may hold
+        overlap   The minimum overlap in latent positive search
+        cont      True => restart training from a previous run
+        C         Regularization/surrogate loss tradeoff parameter
+        """
+        if not self._backendshave('train'):
+            raise ValueError("The backends of the detector cannot train models, "
+                             + "train with MatlabBackend.")
+        with instr.timer('detection/train'):
+            nmodel = self.pool.run(
+                lambda backend: backend.train(model, pos, neg, warp, randneg, nbiter,
+                                              nbnegiter, maxnumexamples, overlap,
+                                              numfp, cont, tag, C))
+        self.setModel(nmodel)
+        return nmodel
+
+    def _backendshave(self, method):
+        """ Whether all the backends have a method, e.g. savemodel or train.
+        """
+        return all([hasattr(b, method) for b in self.pool.backends])
+
+    def saveModel(self, filename):
+        """ Saves the model in the native format of dpmscoring.savemodel, e.g. after
+            training it, so other processes detect with it without MATLAB.
+        """
+        if self.model == None:
+            raise ValueError("No model to save, train or set one first.")
+        if not self._backendshave('savemodel'):
+            raise ValueError("The backends of the detector cannot save models.")
+        self.pool.run(lambda backend: backend.savemodel(filename))
+
+    def detectBatch(self, images, thresh, max_num):
+        """ Detects objects in a batch of images, spreading them across the backends.
+        Args:
+            images (list): BGR images as loaded by cv2.imread.
+            thresh (float): minimum score of detections.
+            max_num (int): maximum number of detections per image.
+        Returns:
+            For each image, a list of (bbox, score) pairs in decreasing score order.
+        """
+        if self.model == None:
+            raise ValueError("No model to detect with, train or set one first.")
+        instr.count('detection/images', len(images))
+        with instr.timer('detection/batch'):
+            return self.pool.detectBatch(images, thresh, max_num)
+
+    def detectObject(self, image, thresh, max_num):
+        """ Detects objects in a single image, see detectBatch.
+        """
+        return self.detectBatch([image], thresh, max_num)[0]
+
+    def detectTiled(self, image, thresh, max_num, maxbytes=conf.tilebytes,
+                    overlap=conf.tileoverlap, builder=None):
+        """ Detects objects in a large image with bounded memory, through overlapping
+            tiles spread across the backends, see tiling.detect_tiled.
+        """
+        if self.model == None:
+            raise ValueError("No model to detect with, train or set one first.")
+        return tiling.detect_tiled(self, image, thresh, max_num, maxbytes, overlap,
+                                   builder)
+
+    def close(self):
+        self.pool.close()
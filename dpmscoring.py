@@ -0,0 +1,527 @@
+""" Native scoring of deformable parts models over feature pyramids, as an alternative
+to the voc-dpm MATLAB detection code.
+
+A model is a mixture of components, each with a root filter, part filters at twice
+the resolution of the root, the anchor of each part relative to the root, and
+deformation costs. The score of a root location is the root filter response, plus
+for each part the best response of its filter around its anchor minus the
+deformation cost, plus a bias. Filter responses are computed with batched matrix
+products or FFTs, and the best part placements with the linear time generalized
+distance transform of Felzenszwalb and Huttenlocher.
+
+Deformation costs are [ax, bx, ay, by], the cost of placing a part at (dx,dy) from
+its anchor being ax*dx^2 + bx*dx + ay*dy^2 + by*dy, with ax, ay > 0.
+
+Models are saved in a compact file: a json header describing the components, then
+all the filters and deformation costs as contiguous float32 arrays. Loading a model
+maps the file read-only instead of reading it, so it takes milliseconds and
+processes detecting with the same model share its pages. Models loaded from a file
+are pickled as the file name, so worker processes map the file in turn rather than
+receiving a copy of the filters with each task. See vocdpm.py to import voc-dpm
+models.
+"""
+import json
+import os
+import os.path
+import struct
+import numpy as np
+import multiprocessing as mp
+import featpyramid as fp
+import geometry
+
+def _weights(array):
+    """ Converts weights to float64, except float32 ones, e.g. mapped from a model
+        file, which are kept as they are.
+    """
+    array = np.asarray(array)
+    if array.dtype == np.float32:
+        return array
+    return np.asarray(array, dtype=np.float64)
+
+class Part:
+    def __init__(self, filter, anchor, defcost):
+        """ Initializes a part.
+        Args:
+            filter (array): (h, w, 31) filter, at twice the resolution of the root.
+            anchor (tuple): (ax, ay) position of the part in part cells relative to
+                the top-left corner of the root, at part resolution.
+            defcost (array): [ax, bx, ay, by] deformation costs.
+        """
+        self.filter = _weights(filter)
+        self.anchor = tuple([int(a) for a in anchor])
+        self.defcost = _weights(defcost)
+
+class Component:
+    def __init__(self, root, parts, bias):
+        """ Initializes a component from its (h, w, 31) root filter, list of Part and
+            bias.
+        """
+        self.root = _weights(root)
+        self.parts = parts
+        self.bias = float(bias)
+
+class DPMModel:
+    def __init__(self, components, sbin=8, interval=10):
+        """ Initializes a mixture model from its components, and the cell size and
+            number of levels per octave of the feature pyramids it works on.
+        """
+        self.components = components
+        self.sbin = sbin
+        self.interval = interval
+        # File the model is mapped from, if any, and the version of it mapped
+        self.filename = None
+        self.filekey = None
+
+    def __getstate__(self):
+        if self.filename != None:
+            return {'filename': self.filename, 'key': self.filekey}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'components' not in state:
+            state = _mapped(state['filename'], state['key']).__dict__
+        self.__dict__.update(state)
+
+    def maxsize(self):
+        """ Largest root filter size, as (rows, cols) in cells.
+        """
+        return (max([c.root.shape[0] for c in self.components]),
+                max([c.root.shape[1] for c in self.components]))
+
+    def pyramidbuilder(self, cachesize=0, store=None):
+        """ Feature pyramid builder matching the model, with enough padding for roots
+            to be partially out of the image, see featpyramid.PyramidBuilder.
+        """
+        rows, cols = self.maxsize()
+        return fp.PyramidBuilder(self.sbin, self.interval, cols - 1, rows - 1,
+                                 cachesize, store)
+
+# Model files start with the magic string, the version of the format and the length
+# of the json header, padded so the float32 data after it is aligned.
+_magic = '\x93DPMMODEL'
+_version = 1
+_alignment = 64
+
+def savemodel(model, filename):
+    """ Saves a model to a file, its weights as float32.
+    """
+    arrays = []
+    size = [0]
+    def add(array):
+        array = np.ascontiguousarray(array, dtype='<f4')
+        arrays.append(array.ravel())
+        entry = [size[0], list(array.shape)]
+        size[0] += array.size
+        return entry
+    components = []
+    for component in model.components:
+        components.append({
+            'root': add(component.root),
+            'bias': component.bias,
+            'parts': [{'filter': add(part.filter), 'anchor': list(part.anchor),
+                       'def': add(part.defcost)}
+                      for part in component.parts]
+            })
+    header = json.dumps({'sbin': model.sbin, 'interval': model.interval,
+                         'size': size[0], 'components': components})
+    prefixsize = len(_magic) + struct.calcsize('<BI')
+    headersize = (-(prefixsize + len(header)) % _alignment) + len(header)
+    tmpfilename = filename + '.tmp'
+    modelfile = open(tmpfilename, 'wb')
+    modelfile.write(_magic + struct.pack('<BI', _version, headersize))
+    modelfile.write(header.ljust(headersize))
+    for array in arrays:
+        modelfile.write(array.tobytes())
+    modelfile.close()
+    os.rename(tmpfilename, filename)
+
+def _loadnpz(filename):
+    """ Loads a model from the npz files written before the current format.
+    """
+    data = np.load(filename)
+    components = []
+    for i in range(0, int(data['nbcomponents'])):
+        prefix = 'comp' + repr(i) + '_'
+        parts = []
+        for j in range(0, int(data[prefix + 'nbparts'])):
+            partprefix = prefix + 'part' + repr(j) + '_'
+            parts.append(Part(data[partprefix + 'filter'], data[partprefix + 'anchor'],
+                              data[partprefix + 'def']))
+        components.append(Component(data[prefix + 'root'], parts,
+                                    data[prefix + 'bias']))
+    return DPMModel(components, int(data['sbin']), int(data['interval']))
+
+def loadmodel(filename, mmap=True):
+    """ Loads a model saved by savemodel.
+    Args:
+        filename (str): model file, or npz file of the previous format.
+        mmap (bool): True to map the weights read-only from the file, False to read
+            them into memory.
+    Returns:
+        The DPMModel, with float32 weights.
+    """
+    modelfile = open(filename, 'rb')
+    magic = modelfile.read(len(_magic))
+    if magic[0:2] == 'PK':
+        modelfile.close()
+        return _loadnpz(filename)
+    if magic != _magic:
+        modelfile.close()
+        raise ValueError(filename + " is not a model file")
+    version, headersize = struct.unpack('<BI', modelfile.read(struct.calcsize('<BI')))
+    if version != _version:
+        modelfile.close()
+        raise ValueError("Unsupported model file version " + repr(version))
+    header = json.loads(modelfile.read(headersize))
+    if mmap:
+        filekey = _filekey(modelfile)
+        data = np.memmap(modelfile, dtype='<f4', mode='r', offset=modelfile.tell(),
+                         shape=(header['size'],))
+    else:
+        data = np.fromfile(modelfile, dtype='<f4', count=header['size'])
+    modelfile.close()
+    def array((offset, shape)):
+        return data[offset:offset+int(np.prod(shape))].reshape(shape)
+    components = []
+    for component in header['components']:
+        parts = [Part(array(part['filter']), part['anchor'], array(part['def']))
+                 for part in component['parts']]
+        components.append(Component(array(component['root']), parts,
+                                    component['bias']))
+    model = DPMModel(components, header['sbin'], header['interval'])
+    if mmap:
+        model.filename = os.path.abspath(filename)
+        model.filekey = filekey
+    return model
+
+def _filekey(modelfile):
+    """ Identifies a version of a file, given by name or open, which savemodel
+        replaces rather than modifying.
+    """
+    if isinstance(modelfile, basestring):
+        stat = os.stat(modelfile)
+    else:
+        stat = os.fstat(modelfile.fileno())
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+# Models mapped by this process when unpickling them, by file name
+_mappedmodels = {}
+
+def _mapped(filename, key):
+    """ Model mapped from a file, once per process as long as the file is the same.
+        Raises IOError if the file is not the version of it mapped by the process
+        the model was pickled in, e.g. because another model was saved over it.
+    """
+    model = _mappedmodels.get(filename)
+    if model == None or model.filekey != tuple(key):
+        model = loadmodel(filename)
+        if model.filekey != tuple(key):
+            raise IOError("Model file " + filename + " was replaced since it was "
+                          + "mapped")
+        _mappedmodels[filename] = model
+    return model
+
+def convolve(feat, filters, method='direct'):
+    """ Computes the responses of filters over a feature map, i.e. their valid cross
+        correlation with it.
+    Args:
+        feat (array): (H, W, d) feature map.
+        filters (list): (h, w, d) filters.
+        method (str): 'direct' to sum matrix products over filter cells, batching all
+            filters of the same size together, or 'fft' to multiply in the frequency
+            domain, sharing the transform of the feature map between filters.
+    Returns:
+        A list of (H-h+1, W-w+1) responses, one per filter. Empty if the filter is
+        larger than the feature map.
+    """
+    H, W, d = feat.shape
+    responses = [None] * len(filters)
+    if method == 'fft':
+        ffeat = None
+        for n, filt in enumerate(filters):
+            h, w = filt.shape[0:2]
+            if h > H or w > W:
+                responses[n] = np.zeros([max(H-h+1, 0), max(W-w+1, 0)])
+                continue
+            if ffeat is None:
+                ffeat = np.fft.rfft2(feat, axes=(0,1))
+            ffilt = np.fft.rfft2(filt, s=(H, W), axes=(0,1))
+            # correlation is the product with the conjugate, summed over features
+            corr = np.fft.irfft2(np.sum(ffeat * np.conj(ffilt), axis=2), s=(H, W))
+            responses[n] = corr[0:H-h+1, 0:W-w+1]
+        return responses
+    elif method != 'direct':
+        raise ValueError("Unknown method " + repr(method))
+    # Group filters by size, to compute each group with the same matrix products
+    groups = {}
+    for n, filt in enumerate(filters):
+        groups.setdefault(filt.shape[0:2], []).append(n)
+    for (h, w), idxs in groups.items():
+        if h > H or w > W:
+            for n in idxs:
+                responses[n] = np.zeros([max(H-h+1, 0), max(W-w+1, 0)])
+            continue
+        out = convolve_stacked(feat, np.stack([filters[n] for n in idxs], axis=3))
+        for k, n in enumerate(idxs):
+            responses[n] = out[:,:,k]
+    return responses
+
+def convolve_stacked(feat, stacked):
+    """ Computes the responses of filters of the same size stacked into a tensor, with
+        a matrix product per filter cell for all the filters.
+    Args:
+        feat (array): (H, W, d) feature map.
+        stacked (array): (h, w, d, n) filters.
+    Returns:
+        The (H-h+1, W-w+1, n) responses.
+    """
+    H, W, d = feat.shape
+    h, w, n = stacked.shape[0], stacked.shape[1], stacked.shape[3]
+    outh, outw = H-h+1, W-w+1
+    out = np.zeros([outh * outw, n])
+    for i in range(0, h):
+        for j in range(0, w):
+            window = np.ascontiguousarray(feat[i:i+outh, j:j+outw])
+            out += np.dot(window.reshape([-1, d]), stacked[i,j])
+    return out.reshape([outh, outw, n])
+
+def dt1d(src, a, b):
+    """ Generalized distance transform along the last axis of a 2D array, computing
+        dst[l,q] = max_p src[l,p] - a*(p-q)^2 - b*(p-q) in linear time with the lower
+        envelope algorithm, running on all lines in lockstep. a and b are scalars, or
+        arrays with a value per line to transform lines of different parts at once.
+    Returns:
+        dst, and the argmax p for each q.
+    """
+    # Lower envelope of parabolas of the negated scores, as in voc-dpm's dt.cc
+    f = -np.asarray(src, dtype=np.float64)
+    L, n = f.shape
+    a = np.broadcast_to(np.asarray(a, dtype=np.float64), [L])
+    b = -np.broadcast_to(np.asarray(b, dtype=np.float64), [L])
+    lines = np.arange(L)
+    v = np.zeros([L, n], dtype=np.int64)
+    z = np.empty([L, n+1])
+    z[:,0] = -np.inf
+    z[:,1] = np.inf
+    k = np.zeros(L, dtype=np.int64)
+    def intersection(ls, q):
+        vk = v[ls, k[ls]]
+        return (((f[ls,q] - f[ls,vk]) - b[ls] * (q - vk) + a[ls] * (q*q - vk*vk))
+                / (2 * a[ls] * (q - vk)))
+    for q in range(1, n):
+        s = intersection(lines, q)
+        pop = lines[s <= z[lines, k]]
+        while pop.size > 0:
+            k[pop] -= 1
+            s[pop] = intersection(pop, q)
+            pop = pop[s[pop] <= z[pop, k[pop]]]
+        k += 1
+        v[lines, k] = q
+        z[lines, k] = s
+        z[lines, k+1] = np.inf
+    dst = np.empty([L, n])
+    ptr = np.empty([L, n], dtype=np.int64)
+    k[:] = 0
+    for q in range(0, n):
+        advance = lines[z[lines, k+1] < q]
+        while advance.size > 0:
+            k[advance] += 1
+            advance = advance[z[advance, k[advance]+1] < q]
+        vk = v[lines, k]
+        dst[:,q] = a * (q - vk) ** 2 + b * (q - vk) + f[lines, vk]
+        ptr[:,q] = vk
+    return -dst, ptr
+
+def dt2d(score, defcost):
+    """ 2D generalized distance transform of a part filter response.
+    Returns:
+        The best score for the part anchored at each location, and the x and y
+        coordinates of the corresponding placement.
+    """
+    ax, bx, ay, by = defcost
+    rows, cols = score.shape
+    mx, ix = dt1d(score, ax, bx)
+    m, iy = dt1d(mx.T, ay, by)
+    m = m.T
+    iy = iy.T
+    ix = ix[iy, np.arange(cols)[np.newaxis,:]]
+    return m, ix, iy
+
+def part_anchors(ys, xs, anchor, padx, pady):
+    """ Locations in the part feature map of the anchor of a part, for root locations
+        of a level, as voc-dpm's virtual padding does. Both maps are padded by the
+        same number of cells, so a root at padded location (y,x) has its upper left
+        corner at (2y-pady, 2x-padx) in the map at twice the resolution.
+    Args:
+        ys, xs (array): padded root locations.
+        anchor (tuple): (ax, ay) anchor of the part, see Part.
+        padx, pady (int): padding of the pyramid, see featpyramid.FeaturePyramid.
+    Returns:
+        The (py, px) locations, out of the part map for roots too close to its
+        edges.
+    """
+    ax, ay = anchor
+    return 2 * ys + ay - pady, 2 * xs + ax - padx
+
+def component_scores(model, rootfeat, partfeat, padx, pady, method='direct'):
+    """ Computes the contributions of the root and of each part to the score of all
+        root locations of one pyramid level.
+    Args:
+        model (DPMModel): model to score.
+        rootfeat (array): feature map of the level.
+        partfeat (array): feature map at twice the resolution, for the parts.
+        padx, pady (int): padding of the pyramid of the maps.
+        method (str): convolution method, see convolve.
+    Returns:
+        For each component, a list of (rows, cols) maps: the root score plus bias,
+        then the best score of each part anchored at each root location, -inf where
+        the part does not fit in the feature map.
+    """
+    rootresponses = convolve(rootfeat, [c.root for c in model.components], method)
+    partfilters = [part.filter for c in model.components for part in c.parts]
+    partresponses = []
+    if partfilters != []:
+        partresponses = convolve(partfeat, partfilters, method)
+    contributions = []
+    p = 0
+    for component, rootscore in zip(model.components, rootresponses):
+        scores = [rootscore + component.bias]
+        ys, xs = np.mgrid[0:rootscore.shape[0], 0:rootscore.shape[1]]
+        for part in component.parts:
+            response = partresponses[p]
+            p += 1
+            partscore = np.full(rootscore.shape, -np.inf)
+            if response.size > 0:
+                m, _, _ = dt2d(response, part.defcost)
+                py, px = part_anchors(ys, xs, part.anchor, padx, pady)
+                inside = ((py >= 0) & (py < m.shape[0])
+                          & (px >= 0) & (px < m.shape[1]))
+                partscore[inside] = m[py[inside], px[inside]]
+            scores.append(partscore)
+        contributions.append(scores)
+    return contributions
+
+def score_level(model, rootfeat, partfeat, padx, pady, method='direct'):
+    """ Scores all root locations of one pyramid level, see component_scores.
+    Returns:
+        For each component, the (rows, cols) map of scores of its root at each
+        location, -inf where parts do not fit in the feature map.
+    """
+    return [np.sum(scores, axis=0) for scores
+            in component_scores(model, rootfeat, partfeat, padx, pady, method)]
+
+def _score_level_worker((model, rootfeat, partfeat, padx, pady, method, cascade)):
+    if cascade != None:
+        return cascade.score_level(model, rootfeat, partfeat, padx, pady, method)
+    return score_level(model, rootfeat, partfeat, padx, pady, method)
+
+def location_boxes(pyramid, level, root, xs, ys):
+    """ Boxes in image pixels of a root filter at padded feature map locations of a
+        pyramid level.
+    Returns:
+        An (N,4) float array of [ulx,uly,drx,dry] boxes, not clipped to the image.
+    """
+    scale = pyramid.sbin / pyramid.scales[level]
+    h, w = root.shape[0:2]
+    x1 = (xs - pyramid.padx) * scale
+    y1 = (ys - pyramid.pady) * scale
+    return np.stack([x1, y1, x1 + w * scale - 1, y1 + h * scale - 1], axis=1)
+
+def detect(model, pyramid, thresh, max_num, method='direct', pool=None, overlap=0.5,
+           cascade=None):
+    """ Detects objects in a feature pyramid.
+    Args:
+        model (DPMModel): model to detect with.
+        pyramid (featpyramid.FeaturePyramid): pyramid of the image, built with the
+            padding of model.pyramidbuilder.
+        thresh (float): minimum score of detections.
+        max_num (int): maximum number of detections.
+        method (str): convolution method, see convolve.
+        pool (multiprocessing.Pool): pool of worker processes to score the pyramid
+            levels in parallel, None to score them in this process.
+        overlap (float): maximum overlap between kept detections.
+        cascade (cascade.Cascade): cascade to prune locations with, None to score
+            all of them exhaustively.
+    Returns:
+        A list of (bbox, score) pairs in decreasing order of score, with
+        bbox = [[ulx,uly],[drx,dry]] in image pixels.
+    """
+    haveparts = any([c.parts != [] for c in model.components])
+    first = pyramid.interval if haveparts else 0
+    levels = range(first, len(pyramid))
+    args = [(model, pyramid.feat[l],
+             pyramid.feat[l - pyramid.interval] if haveparts else None,
+             pyramid.padx, pyramid.pady, method, cascade)
+            for l in levels]
+    if pool != None:
+        levelscores = pool.map(_score_level_worker, args)
+    else:
+        levelscores = map(_score_level_worker, args)
+    boxes = []
+    scores = []
+    rows, cols = pyramid.imsize
+    for l, componentscores in zip(levels, levelscores):
+        for component, score in zip(model.components, componentscores):
+            ys, xs = np.nonzero(score >= thresh)
+            if ys.size == 0:
+                continue
+            boxes.append(location_boxes(pyramid, l, component.root, xs, ys))
+            scores.append(score[ys, xs])
+    if boxes == []:
+        return []
+    boxes = np.concatenate(boxes)
+    scores = np.concatenate(scores)
+    boxes = np.round(boxes).astype(np.int64)
+    boxes[:,0::2] = np.clip(boxes[:,0::2], 0, cols - 1)
+    boxes[:,1::2] = np.clip(boxes[:,1::2], 0, rows - 1)
+    keep = geometry.nms(boxes, scores, overlap, max_num=max_num)
+    return [([[ulx,uly],[drx,dry]], s) for [ulx,uly,drx,dry], s
+            in zip(boxes[keep].tolist(), scores[keep].tolist())]
+
+class NativeBackend:
+    """ Detection backend for dpmDetection.DetectionPool scoring models natively.
+        Each backend scores pyramid levels across its own pool of worker processes.
+    """
+    def __init__(self, nbworkers=1, method='direct', cachesize=8, cascade=None,
+                 featurefolder=None):
+        """ Initializes the backend.
+        Args:
+            nbworkers (int): number of processes to score pyramid levels with, 1 to
+                score them in this process.
+            method (str): convolution method, see convolve.
+            cachesize (int): number of feature pyramids to cache.
+            cascade (cascade.Cascade): cascade to detect with, None for exhaustive
+                detection.
+            featurefolder (str): folder of a featpyramid.PyramidStore to share
+                feature pyramids with other processes through, None to compute them
+                in this one.
+        """
+        self.cascade = cascade
+        self.pool = mp.Pool(nbworkers) if nbworkers > 1 else None
+        self.method = method
+        self.cachesize = cachesize
+        self.store = None
+        if featurefolder != None:
+            self.store = fp.PyramidStore(featurefolder)
+        self.model = None
+        self.builder = None
+
+    def loadmodel(self, model):
+        """ Loads a DPMModel, or a model exported to a file by savemodel.
+        """
+        if isinstance(model, basestring):
+            model = loadmodel(model)
+        self.model = model
+        self.builder = model.pyramidbuilder(self.cachesize, self.store)
+
+    def detect(self, image, thresh, max_num):
+        pyramid = self.builder.build(image)
+        return detect(self.model, pyramid, thresh, max_num, self.method, self.pool,
+                      cascade=self.cascade)
+
+    def savemodel(self, filename):
+        savemodel(self.model, filename)
+
+    def close(self):
+        if self.pool != None:
+            self.pool.terminate()
@@ -0,0 +1,242 @@
+""" Detection of near duplicate images, e.g. reposts and rescaled copies of the same
+fan art, with 64-bit perceptual hashes.
+
+The hash of an image is the sign of the low frequencies of the discrete cosine
+transform of its downscaled grayscale version relative to their median, so images
+differing by rescaling, recompression or small color changes have hashes at a small
+hamming distance. Hashes are indexed in a BK-tree, which finds all the hashes within
+a given distance of a query without comparing it to most of them, so clustering a
+whole folder takes far less than comparing all pairs of images.
+
+Hashes of a folder are saved to acdconf.hashindexfile along with the modification
+time of each image, so only new or modified images are hashed again.
+"""
+import numpy as np
+import cv2
+import json
+import os
+import os.path
+import argparse
+import acdconf as conf
+
+_imageextensions = ('.jpg', '.png', '.gif')
+
+def phash(image):
+    """ 64-bit perceptual hash of a BGR or grayscale image, as a python integer.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[0:8,0:8].ravel()
+    # The first coefficient is the mean intensity, ignored for the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hamming(hash1, hash2):
+    """ Number of bits differing between two hashes.
+    """
+    return bin(hash1 ^ hash2).count('1')
+
+class BKTree:
+    """ Burkhard-Keller tree of hashes under the hamming distance. Each node has
+        children at each distance from it, so by the triangle inequality a search
+        within radius r of a query at distance d of a node only needs to look into
+        the children at distances d-r to d+r.
+    """
+    def __init__(self):
+        # Nodes are [hash, items, children] lists, children mapping distances to
+        # nodes
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, h, item):
+        """ Adds an item with hash h.
+        """
+        self.size += 1
+        if self.root == None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child == None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def search(self, h, radius):
+        """ Items whose hash is within radius of h.
+        Returns:
+            A list of (distance, item) pairs, in increasing order of distance.
+        """
+        found = []
+        stack = [self.root] if self.root != None else []
+        while stack != []:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                found.extend([(d, item) for item in node[1]])
+            for childd, child in node[2].items():
+                if d - radius <= childd <= d + radius:
+                    stack.append(child)
+        return sorted(found)
+
+class HashIndex:
+    """ Perceptual hashes of the images of a folder, indexed in a BK-tree.
+    """
+    def __init__(self, folder, radius=conf.duplicateradius):
+        """ Initializes an empty index of a folder.
+        Args:
+            folder (str): folder of the images.
+            radius (int): default maximum distance between near duplicates.
+        """
+        self.folder = folder
+        self.radius = radius
+        # filename relative to the folder -> (modification time, hash)
+        self.hashes = {}
+        self.tree = BKTree()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, filename, h, mtime=None):
+        """ Adds the hash of an image of the folder, given by its name relative to it.
+        """
+        if filename in self.hashes and self.hashes[filename][1] == h:
+            self.hashes[filename] = (mtime, h)
+            return
+        if filename in self.hashes:
+            # BK-trees do not support removal, so rebuild it without the old hash
+            self.hashes[filename] = (mtime, h)
+            self._rebuild()
+            return
+        self.hashes[filename] = (mtime, h)
+        self.tree.add(h, filename)
+
+    def _rebuild(self):
+        self.tree = BKTree()
+        for filename, (mtime, h) in sorted(self.hashes.items()):
+            self.tree.add(h, filename)
+
+    def near(self, h, radius=None):
+        """ Images near a hash.
+        Returns:
+            A list of (distance, filename) pairs, in increasing order of distance.
+        """
+        return self.tree.search(h, self.radius if radius == None else radius)
+
+    def update(self):
+        """ Hashes the new and modified images of the folder, and forgets the removed
+            ones.
+        Returns:
+            The number of images hashed.
+        """
+        filenames = [f for f in os.listdir(self.folder)
+                     if f.lower().endswith(_imageextensions)]
+        removed = set(self.hashes.keys()) - set(filenames)
+        for filename in removed:
+            del self.hashes[filename]
+        if removed:
+            self._rebuild()
+        nbhashed = 0
+        for filename in sorted(filenames):
+            path = os.path.join(self.folder, filename)
+            mtime = os.path.getmtime(path)
+            if filename in self.hashes and self.hashes[filename][0] == mtime:
+                continue
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            self.add(filename, phash(image), mtime)
+            nbhashed += 1
+        return nbhashed
+
+    def save(self, filename):
+        """ Saves the hashes to a json file.
+        """
+        hashfile = open(filename, 'w')
+        json.dump({'folder': os.path.abspath(self.folder),
+                   'hashes': dict([(f, [mtime, '%016x' % h]) for f, (mtime, h)
+                                   in self.hashes.items()])}, hashfile)
+        hashfile.close()
+
+    def load(self, filename):
+        """ Loads hashes saved by save, if they were saved for the same folder.
+        Returns:
+            True if and only if the hashes were loaded.
+        """
+        if not os.path.isfile(filename):
+            return False
+        hashfile = open(filename)
+        data = json.load(hashfile)
+        hashfile.close()
+        if data['folder'] != os.path.abspath(self.folder):
+            return False
+        self.hashes = dict([(f, (mtime, int(h, 16))) for f, [mtime, h]
+                            in data['hashes'].items()])
+        self._rebuild()
+        return True
+
+    def clusters(self, radius=None):
+        """ Groups the images into clusters of near duplicates, i.e. the connected
+            components of the graph linking images within radius of each other.
+        Returns:
+            The clusters of more than one image, as sorted lists of filenames, from
+            the largest to the smallest.
+        """
+        radius = self.radius if radius == None else radius
+        # Union-find over filenames, with path halving
+        parent = dict([(f, f) for f in self.hashes])
+        def find(f):
+            while parent[f] != f:
+                parent[f] = parent[parent[f]]
+                f = parent[f]
+            return f
+        for filename, (mtime, h) in self.hashes.items():
+            for d, other in self.tree.search(h, radius):
+                root1, root2 = find(filename), find(other)
+                if root1 != root2:
+                    parent[max(root1, root2)] = min(root1, root2)
+        clusters = {}
+        for filename in self.hashes:
+            clusters.setdefault(find(filename), []).append(filename)
+        return sorted([sorted(c) for c in clusters.values() if len(c) > 1],
+                      key=lambda c: (-len(c), c))
+
+def open_index(folder=conf.imagesfolder, hashindexfile=conf.hashindexfile,
+               radius=conf.duplicateradius):
+    """ Index of the images of a folder, hashing only those not in the saved index,
+        which is then updated.
+    """
+    index = HashIndex(folder, radius)
+    index.load(hashindexfile)
+    if index.update() > 0 or not os.path.isfile(hashindexfile):
+        folder = os.path.dirname(hashindexfile)
+        if folder != '' and not os.path.isdir(folder):
+            os.makedirs(folder)
+        index.save(hashindexfile)
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Groups the images of a folder into clusters of near duplicates.")
+    parser.add_argument('folder', nargs='?', default=conf.imagesfolder)
+    parser.add_argument('--index', default=conf.hashindexfile,
+                        help="file to keep the hashes in")
+    parser.add_argument('--radius', type=int, default=conf.duplicateradius,
+                        help="maximum hamming distance between near duplicates")
+    args = parser.parse_args()
+    index = open_index(args.folder, args.index, args.radius)
+    clusters = index.clusters()
+    for cluster in clusters:
+        print ' '.join(cluster)
+    print (repr(len(clusters)) + " clusters of near duplicates, "
+           + repr(sum([len(c) - 1 for c in clusters])) + " redundant images out of "
+           + repr(len(index)))
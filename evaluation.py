@@ -0,0 +1,270 @@
+""" Evaluation of detections against the ground truth bounding boxes of the dataset, as
+in the PASCAL VOC challenge: detections are visited in decreasing order of score, and
+each is a true positive if its intersection over union with the ground truth box it
+overlaps most is at least 0.5, and that box was not matched by a higher scoring
+detection. Average precision is the area under the precision/recall curve made
+monotonic, as in the VOC devkit since 2010, or the mean of its 11 points as in
+VOC2007.
+
+Detections and ground truth boxes of the whole dataset are flattened into arrays,
+each box with the index of its image, and matched in a constant number of array
+operations: the pairs of detections and ground truth boxes of the same image are
+enumerated at once, their intersection over union computed row-wise, and the first
+detection of each box in score order found with a single np.unique. This evaluates
+100k detections in well under a second, see scripts/benchevaluation.py.
+
+Detections are given as a dict mapping image stems to lists of (bbox, score) pairs,
+as returned by DPMObjectDetection.detectBatch, or (bbox, score, label) triples to
+evaluate the label of each detection as well, e.g. the character it was identified
+as. Ground truth is a dict mapping stems to lists of bounding boxes, in the format of
+the _bb.json files, e.g. from the allboxes method of annotation sources. Characters
+are named after the stems of their images, see annotations.character_name.
+"""
+import numpy as np
+import argparse
+import json
+import acdconf as conf
+import annotations
+import geometry
+
+def best_matches(detimages, detboxes, gtimages, gtboxes):
+    """ Finds the ground truth box each detection overlaps most, among the boxes of its
+        own image.
+    Args:
+        detimages (array): (N,) index of the image of each detection.
+        detboxes (array): (N,4) detections.
+        gtimages (array): (M,) index of the image of each ground truth box.
+        gtboxes (array): (M,4) ground truth boxes.
+    Returns:
+        The index of the best ground truth box of each detection, -1 for detections
+        in images without any, and the intersection over union with it. Ties go to
+        the first box, as in the VOC devkit.
+    """
+    detimages = np.asarray(detimages, dtype=np.int64)
+    gtimages = np.asarray(gtimages, dtype=np.int64)
+    bestgt = np.full(detimages.size, -1, dtype=np.int64)
+    bestiou = np.zeros(detimages.size)
+    if detimages.size == 0 or gtimages.size == 0:
+        return bestgt, bestiou
+    # All (detection, ground truth box) pairs of the same image, grouped by detection
+    gtorder = np.argsort(gtimages, kind='mergesort')
+    sortedimages = gtimages[gtorder]
+    starts = np.searchsorted(sortedimages, detimages, 'left')
+    counts = np.searchsorted(sortedimages, detimages, 'right') - starts
+    pairdets = np.repeat(np.arange(detimages.size), counts)
+    if pairdets.size == 0:
+        return bestgt, bestiou
+    offsets = np.arange(pairdets.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairgts = gtorder[np.repeat(starts, counts) + offsets]
+    ious = geometry.iou(detboxes[pairdets], gtboxes[pairgts])
+    # Best pair of each detection first within its group
+    order = np.lexsort((pairgts, -ious, pairdets))
+    first = order[np.concatenate([[True], pairdets[order][1:] != pairdets[order][:-1]])]
+    bestgt[pairdets[first]] = pairgts[first]
+    bestiou[pairdets[first]] = ious[first]
+    return bestgt, bestiou
+
+def match(detimages, detboxes, scores, gtimages, gtboxes, minoverlap=0.5):
+    """ Matches detections with ground truth boxes, see best_matches for the
+        arguments.
+    Args:
+        scores (array): (N,) score of each detection.
+        minoverlap (float): minimum intersection over union of a match.
+    Returns:
+        A boolean array, True for the detections matching a box, and the index of the
+        box each detection matched, -1 for false positives.
+    """
+    bestgt, bestiou = best_matches(detimages, detboxes, gtimages, gtboxes)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='mergesort')
+    candidates = order[bestiou[order] >= minoverlap]
+    # Only the first detection of a box in score order matches it
+    boxes, first = np.unique(bestgt[candidates], return_index=True)
+    matched = np.full(bestgt.size, -1, dtype=np.int64)
+    matched[candidates[first]] = boxes
+    return matched >= 0, matched
+
+def precision_recall(scores, truepositives, nbpositives):
+    """ Precision and recall of the detections above each score.
+    Args:
+        scores (array): score of each detection, across all images.
+        truepositives (array): True for each detection matching a ground truth box.
+        nbpositives (int): number of ground truth boxes.
+    Returns:
+        The precision and recall arrays, in decreasing order of score.
+    """
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='mergesort')
+    tp = np.cumsum(np.asarray(truepositives, dtype=np.float64)[order])
+    return tp / np.arange(1, order.size + 1), tp / max(nbpositives, 1)
+
+def average_precision(precision, recall, method='voc2010'):
+    """ Average precision from a precision/recall curve.
+    Args:
+        method (str): 'voc2010' for the area under the curve made monotonic, or
+            'voc2007' for the mean of its maximum precision at 11 recall levels.
+    """
+    precision = np.asarray(precision, dtype=np.float64)
+    recall = np.asarray(recall, dtype=np.float64)
+    if method == 'voc2007':
+        return float(np.mean([np.max(precision[recall >= t], initial=0)
+                              for t in np.linspace(0, 1, 11)]))
+    elif method != 'voc2010':
+        raise ValueError("Unknown method " + repr(method))
+    recall = np.concatenate([[0], recall, [1]])
+    precision = np.concatenate([[0], precision, [0]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    steps = np.nonzero(recall[1:] != recall[:-1])[0]
+    return float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1]))
+
+class EvaluationSet:
+    """ Detections and ground truth boxes of a dataset flattened into arrays.
+    Attributes:
+        stems (list): stem of each image.
+        detimages, detboxes, scores, labels (array): image, box, score and label of
+            each detection, labels being None for unlabeled detections.
+        gtimages, gtboxes (array): image and box of each ground truth box.
+    """
+    def __init__(self, detections, groundtruth):
+        """ Flattens detections and ground truth, see the module documentation for
+            their format. Images with detections and without ground truth count as
+            images without any object.
+        """
+        self.stems = sorted(set(groundtruth.keys()) | set(detections.keys()))
+        detlists = [detections.get(stem, []) for stem in self.stems]
+        gtlists = [groundtruth.get(stem) or [] for stem in self.stems]
+        flat = [d for ds in detlists for d in ds]
+        self.detimages = np.repeat(np.arange(len(self.stems)),
+                                   [len(ds) for ds in detlists])
+        self.detboxes = geometry.toarray([d[0] for d in flat])
+        self.scores = np.array([d[1] for d in flat], dtype=np.float64)
+        self.labels = None
+        if flat != [] and len(flat[0]) > 2:
+            self.labels = np.array([d[2] for d in flat])
+        self.gtimages = np.repeat(np.arange(len(self.stems)),
+                                  [len(bs) for bs in gtlists])
+        self.gtboxes = geometry.toarray([b for bs in gtlists for b in bs])
+
+    def evaluate(self, detmask=None, gtmask=None, minoverlap=0.5, method='voc2010'):
+        """ Evaluates a subset of the detections against a subset of the ground truth.
+        Args:
+            detmask, gtmask (array): boolean masks of the detections and ground truth
+                boxes to evaluate, None for all of them.
+            minoverlap (float): minimum intersection over union of a match.
+            method (str): see average_precision.
+        Returns:
+            A dict with the average precision, the precision and recall arrays in
+            decreasing order of score, and the numbers of detections, ground truth
+            boxes and true positives.
+        """
+        detidxs = (np.arange(self.scores.size) if detmask is None
+                   else np.nonzero(detmask)[0])
+        gtidxs = (np.arange(self.gtimages.size) if gtmask is None
+                  else np.nonzero(gtmask)[0])
+        truepositives, _ = match(self.detimages[detidxs], self.detboxes[detidxs],
+                                 self.scores[detidxs], self.gtimages[gtidxs],
+                                 self.gtboxes[gtidxs], minoverlap)
+        precision, recall = precision_recall(self.scores[detidxs], truepositives,
+                                             gtidxs.size)
+        return {
+            'ap': average_precision(precision, recall, method),
+            'precision': precision,
+            'recall': recall,
+            'nbdetections': int(detidxs.size),
+            'nbpositives': int(gtidxs.size),
+            'nbtruepositives': int(np.sum(truepositives))
+            }
+
+    def characters(self):
+        """ Character of each image, as an array.
+        """
+        return np.array([annotations.character_name(stem) for stem in self.stems])
+
+def evaluate(detections, groundtruth, minoverlap=0.5, method='voc2010'):
+    """ Evaluates all the detections of a dataset at once, see EvaluationSet.evaluate.
+    """
+    return EvaluationSet(detections, groundtruth).evaluate(None, None, minoverlap,
+                                                           method)
+
+def evaluate_characters(detections, groundtruth, minoverlap=0.5, method='voc2010'):
+    """ Evaluates detections per character. The ground truth of a character is the
+        boxes of its images. Its detections are the detections labeled with it
+        across all images if they are labeled, the detections in its images
+        otherwise.
+    Returns:
+        A dict mapping each character to its evaluation, see EvaluationSet.evaluate.
+    """
+    evalset = EvaluationSet(detections, groundtruth)
+    imagecharacters = evalset.characters()
+    gtcharacters = imagecharacters[evalset.gtimages]
+    if evalset.labels is not None:
+        detcharacters = evalset.labels
+    else:
+        detcharacters = imagecharacters[evalset.detimages]
+    results = {}
+    for character in sorted(set(gtcharacters.tolist())):
+        results[character] = evalset.evaluate(detcharacters == character,
+                                              gtcharacters == character,
+                                              minoverlap, method)
+    return results
+
+def load_detections(filename):
+    """ Loads detections from a json lines file, one
+        {"stem": ..., "boxes": [...], "scores": [...]} object per image, with boxes in
+        the format of the _bb.json files and an optional "labels" list.
+    """
+    detections = {}
+    detectionsfile = open(filename)
+    for line in detectionsfile:
+        if line.strip() == '':
+            continue
+        entry = json.loads(line)
+        columns = [entry['boxes'], entry['scores']]
+        if 'labels' in entry:
+            columns.append(entry['labels'])
+        detections.setdefault(entry['stem'], []).extend(
+            [tuple(d) for d in zip(*columns)])
+    detectionsfile.close()
+    return detections
+
+def detections_entry(stem, ds):
+    """ Line of a json lines file of detections for the detections of an image, see
+        load_detections.
+    """
+    entry = {'stem': stem, 'boxes': [d[0] for d in ds], 'scores': [d[1] for d in ds]}
+    if ds != [] and len(ds[0]) > 2:
+        entry['labels'] = [d[2] for d in ds]
+    return json.dumps(entry) + '\n'
+
+def save_detections(detections, filename):
+    """ Saves detections to a json lines file, see load_detections.
+    """
+    detectionsfile = open(filename, 'w')
+    for stem in sorted(detections.keys()):
+        detectionsfile.write(detections_entry(stem, detections[stem]))
+    detectionsfile.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluates detections against the annotations, overall and per "
+        + "character.")
+    parser.add_argument('detections', help="json lines file of detections")
+    parser.add_argument('--annotations', default=conf.bboxesfolder,
+                        help="bounding boxes folder or annotations store")
+    parser.add_argument('--minoverlap', type=float, default=0.5)
+    parser.add_argument('--method', choices=['voc2010', 'voc2007'], default='voc2010')
+    args = parser.parse_args()
+    annotationsource = annotations.open_annotations(args.annotations)
+    groundtruth = annotationsource.allboxes()
+    annotationsource.close()
+    detections = load_detections(args.detections)
+    results = evaluate_characters(detections, groundtruth, args.minoverlap,
+                                  args.method)
+    rows = sorted(results.items())
+    rows.append(('(all)', evaluate(detections, groundtruth, args.minoverlap,
+                                   args.method)))
+    for name, result in rows:
+        print "%-30s AP %.4f  %6d detections  %5d/%-5d boxes found" % (
+            name, result['ap'], result['nbdetections'], result['nbtruepositives'],
+            result['nbpositives'])
+    if results != {}:
+        print "mean AP over characters %.4f" % np.mean([r['ap']
+                                                        for r in results.values()])
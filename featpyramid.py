@@ -0,0 +1,366 @@
+""" HOG feature pyramids as used by deformable parts models, computed natively
+instead of going through the voc-dpm MATLAB code.
+
+Features are the 31-dimensional HOG variant of Felzenszwalb et al., "Object Detection
+with Discriminatively Trained Part Based Models": 18 contrast sensitive orientations,
+9 contrast insensitive orientations and 4 texture features per cell. features is a
+vectorized port of voc-dpm's features.cc (without the truncation feature), and
+featpyramid one of featpyramid.m.
+
+Images are BGR uint8 arrays as loaded by cv2.imread.
+"""
+import numpy as np
+import cv2
+import collections
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+# Unit vectors of the 9 contrast insensitive orientations, as in features.cc.
+_uu = np.array([1.0000, 0.9397, 0.7660, 0.500, 0.1736, -0.1736, -0.5000, -0.7660,
+                -0.9397])
+_vv = np.array([0.0000, 0.3420, 0.6428, 0.8660, 0.9848, 0.9848, 0.8660, 0.6428,
+                0.3420])
+_eps = 0.0001
+# Number of features per cell.
+nbfeatures = 31
+# Peak memory of the work buffers of HOGComputer.features, in bytes per pixel of the
+# image, measured at the finest scale of a pyramid
+workbytesperpixel = 264
+
+class HOGComputer:
+    """ Computes HOG features, reusing the same work buffers across calls. Buffers grow
+        to fit the largest image seen, so computing all the scales of a pyramid from
+        the largest one down does not allocate any more of them.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype=np.float64):
+        """ Returns a buffer of the given shape, as a view of a reused flat array.
+        """
+        size = int(np.prod(shape))
+        flat = self.buffers.get(name)
+        if flat is None or flat.size < size or flat.dtype != dtype:
+            flat = np.empty(size, dtype=dtype)
+            self.buffers[name] = flat
+        return flat[0:size].reshape(shape)
+
+    def features(self, image, sbin):
+        """ Computes the HOG features of an image.
+        Args:
+            image (array): BGR image.
+            sbin (int): size of the cells in pixels.
+        Returns:
+            A (rows, cols, 31) float64 array of features, with
+            rows = max(round(height/sbin)-2, 0) and similarly for cols.
+        """
+        # features.cc works on RGB doubles, which matters for ties when picking the
+        # channel with the strongest gradient. Channels first so each is contiguous.
+        im = np.ascontiguousarray(image.transpose([2,0,1])[::-1], dtype=np.float64)
+        dims = im.shape[1:3]
+        blocks = [int(round(float(dims[0]) / sbin)), int(round(float(dims[1]) / sbin))]
+        out = [max(blocks[0]-2, 0), max(blocks[1]-2, 0)]
+        visible = [blocks[0]*sbin, blocks[1]*sbin]
+        feat = np.zeros([out[0], out[1], nbfeatures])
+        if out[0] == 0 or out[1] == 0 or dims[0] < 3 or dims[1] < 3:
+            return feat
+        # Gradients of all channels in the image interior
+        inner = [3, dims[0]-2, dims[1]-2]
+        dy = np.subtract(im[:,2:,1:-1], im[:,:-2,1:-1], out=self.buffer('dy', inner))
+        dx = np.subtract(im[:,1:-1,2:], im[:,1:-1,:-2], out=self.buffer('dx', inner))
+        v = np.square(dx, out=self.buffer('v', inner))
+        v += np.square(dy, out=self.buffer('dy2', inner))
+        # Keep the gradient of the channel with the largest magnitude, the first one
+        # in case of ties
+        bestdx, bestdy, bestv = dx[0], dy[0], v[0]
+        for c in [1, 2]:
+            larger = v[c] > bestv
+            bestdx = np.where(larger, dx[c], bestdx)
+            bestdy = np.where(larger, dy[c], bestdy)
+            bestv = np.where(larger, v[c], bestv)
+        # Pixels visible in the cells, with coordinates clamped to the interior
+        ys = np.minimum(np.arange(1, visible[0]-1), dims[0]-2) - 1
+        xs = np.minimum(np.arange(1, visible[1]-1), dims[1]-2) - 1
+        dx = bestdx.take(ys, axis=0).take(xs, axis=1)
+        dy = bestdy.take(ys, axis=0).take(xs, axis=1)
+        mag = np.sqrt(bestv.take(ys, axis=0).take(xs, axis=1))
+        # Snap to one of 18 orientations. features.cc keeps the first maximum among
+        # the dot products with each orientation and its opposite, which is the first
+        # orientation with the largest absolute dot product, on the side of its sign.
+        dots = self.buffer('dots', [ys.size, xs.size, 9])
+        np.multiply(dx[:,:,np.newaxis], _uu, out=dots)
+        dots += dy[:,:,np.newaxis] * _vv
+        orientation = np.argmax(np.abs(dots), axis=2)
+        negative = dots.reshape([-1, 9])[np.arange(orientation.size),
+                                         orientation.ravel()] < 0
+        orientation += 9 * negative.reshape(orientation.shape)
+        # Add to the 4 cells around each pixel with bilinear interpolation
+        yp = (np.arange(1, visible[0]-1) + 0.5) / sbin - 0.5
+        xp = (np.arange(1, visible[1]-1) + 0.5) / sbin - 0.5
+        iyp = np.floor(yp).astype(np.int64)
+        ixp = np.floor(xp).astype(np.int64)
+        vy0 = yp - iyp
+        vx0 = xp - ixp
+        nbcells = blocks[0] * blocks[1]
+        hist = np.zeros(18 * nbcells)
+        for offy, wy in [(0, 1.0 - vy0), (1, vy0)]:
+            for offx, wx in [(0, 1.0 - vx0), (1, vx0)]:
+                cy = iyp + offy
+                cx = ixp + offx
+                # cells are increasing with pixels, so valid ones form a slice
+                vy = slice(np.searchsorted(cy, 0), np.searchsorted(cy, blocks[0]))
+                vx = slice(np.searchsorted(cx, 0), np.searchsorted(cx, blocks[1]))
+                weights = mag[vy,vx] * wy[vy,np.newaxis]
+                weights *= wx[vx]
+                idx = orientation[vy,vx] * nbcells
+                idx += cy[vy,np.newaxis] * blocks[1] + cx[vx]
+                hist += np.bincount(idx.ravel(), weights.ravel(), 18 * nbcells)
+        hist = hist.reshape([18, blocks[0], blocks[1]])
+        # Energy of each cell, then of each 2x2 block of cells
+        norm = np.sum(np.square(hist[0:9] + hist[9:18]), axis=0)
+        blocknorm = norm[:-1,:-1] + norm[1:,:-1] + norm[:-1,1:] + norm[1:,1:]
+        invnorm = 1.0 / np.sqrt(blocknorm + _eps)
+        n1 = invnorm[1:,1:]
+        n2 = invnorm[:-1,1:]
+        n3 = invnorm[1:,:-1]
+        n4 = invnorm[:-1,:-1]
+        src = hist[:,1:-1,1:-1].transpose([1,2,0])
+        # Contrast sensitive features, and texture features from their sums
+        for k, n in enumerate([n1, n2, n3, n4]):
+            h = np.minimum(src * n[:,:,np.newaxis], 0.2)
+            feat[:,:,0:18] += h
+            feat[:,:,27+k] = 0.2357 * np.sum(h, axis=2)
+        feat[:,:,0:18] *= 0.5
+        # Contrast insensitive features
+        insensitive = src[:,:,0:9] + src[:,:,9:18]
+        for n in [n1, n2, n3, n4]:
+            feat[:,:,18:27] += np.minimum(insensitive * n[:,:,np.newaxis], 0.2)
+        feat[:,:,18:27] *= 0.5
+
+        return feat
+
+class FeaturePyramid:
+    """ HOG features of an image at multiple scales.
+    Attributes:
+        feat (list): (rows, cols, 31) feature maps, from the largest to the smallest.
+        scales (array): scale of the image each feature map was computed at,
+            relative to the cell size sbin.
+        sbin (int): cell size in pixels at scale 1.
+        interval (int): number of levels per octave.
+        padx, pady (int): number of cells of zero padding around each map.
+        imsize (tuple): rows and columns of the image.
+    """
+    def __init__(self, feat, scales, sbin, interval, padx, pady, imsize):
+        self.feat = feat
+        self.scales = np.asarray(scales)
+        self.sbin = sbin
+        self.interval = interval
+        self.padx = padx
+        self.pady = pady
+        self.imsize = imsize
+
+    def __len__(self):
+        return len(self.feat)
+
+def _resize(image, scale):
+    """ Resizes an image by a factor, with area averaging when shrinking.
+    """
+    rows = int(round(image.shape[0] * scale))
+    cols = int(round(image.shape[1] * scale))
+    return cv2.resize(image, (max(cols, 1), max(rows, 1)), interpolation=cv2.INTER_AREA)
+
+class PyramidStore:
+    """ Feature pyramids stored on disk, so processes working on the same images, e.g.
+        the folds of a cross validation, compute each pyramid once. All the levels of
+        a pyramid are stored contiguously in a npy file, memory mapped read-only when
+        loaded so processes share the pages of the same pyramid, and its scales and
+        level shapes in a json file next to it.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another process may have created it in the meantime
+                pass
+
+    def filename(self, key, params):
+        """ Name of the files of a pyramid without extension, from the key of its image
+            and the parameters it was computed with.
+        """
+        return os.path.join(self.folder, hashlib.sha1(repr((key, params))).hexdigest())
+
+    def load(self, key, params):
+        """ Loads a stored pyramid.
+        Args:
+            key: key of the image, see PyramidBuilder.key.
+            params (tuple): (sbin, interval, padx, pady) of the pyramid.
+        Returns:
+            The pyramid with read-only levels, or None if it is not stored.
+        """
+        filename = self.filename(key, params)
+        # The json file is written last, so the data is complete once it exists
+        if not os.path.isfile(filename + '.json'):
+            self.misses += 1
+            return None
+        jsonfile = open(filename + '.json')
+        header = json.load(jsonfile)
+        jsonfile.close()
+        data = np.load(filename + '.npy', mmap_mode='r')
+        feat = []
+        offset = 0
+        for shape in header['shapes']:
+            size = int(np.prod(shape))
+            feat.append(data[offset:offset+size].reshape(shape))
+            offset += size
+        self.hits += 1
+        sbin, interval, padx, pady = params
+        return FeaturePyramid(feat, header['scales'], sbin, interval, padx, pady,
+                              tuple(header['imsize']))
+
+    def save(self, key, params, pyramid):
+        """ Stores a pyramid, see load.
+        """
+        filename = self.filename(key, params)
+        # Write to temporary files first so concurrent readers never see a partially
+        # written pyramid.
+        fd, tmpfilename = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        tmpfile = os.fdopen(fd, 'wb')
+        np.save(tmpfile, np.concatenate([f.ravel() for f in pyramid.feat]))
+        tmpfile.close()
+        os.rename(tmpfilename, filename + '.npy')
+        fd, tmpfilename = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        tmpfile = os.fdopen(fd, 'w')
+        json.dump({'shapes': [f.shape for f in pyramid.feat],
+                   'scales': pyramid.scales.tolist(),
+                   'imsize': list(pyramid.imsize)}, tmpfile)
+        tmpfile.close()
+        os.rename(tmpfilename, filename + '.json')
+
+class PyramidBuilder:
+    """ Builds feature pyramids, reusing buffers across scales and caching the pyramids
+        of the most recent images.
+    """
+    def __init__(self, sbin=8, interval=10, padx=0, pady=0, cachesize=8, store=None):
+        """ Initializes the builder.
+        Args:
+            sbin (int): cell size in pixels.
+            interval (int): number of levels per octave.
+            padx, pady (int): number of cells of zero padding around each level,
+                usually the size of the largest root filter minus one.
+            cachesize (int): number of pyramids to keep in the cache, 0 to disable it.
+            store (PyramidStore): on-disk store to look pyramids up in before
+                computing them, and to save computed ones to, None to disable it.
+        """
+        self.sbin = sbin
+        self.interval = interval
+        self.padx = padx
+        self.pady = pady
+        self.cachesize = cachesize
+        self.store = store
+        self.cache = collections.OrderedDict()
+        self.hog = HOGComputer()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image):
+        """ Key of an image in the cache, from its contents.
+        """
+        image = np.ascontiguousarray(image)
+        return (hashlib.sha1(image.data).hexdigest(), image.shape, image.dtype.str)
+
+    def build(self, image):
+        """ Returns the feature pyramid of an image, from the cache or the store if
+            possible.
+        """
+        key = None
+        if self.cachesize > 0 or self.store != None:
+            key = self.key(image)
+        if self.cachesize > 0:
+            pyramid = self.cache.pop(key, None)
+            if pyramid != None:
+                self.cache[key] = pyramid
+                self.hits += 1
+                return pyramid
+        self.misses += 1
+        pyramid = None
+        if self.store != None:
+            params = (self.sbin, self.interval, self.padx, self.pady)
+            pyramid = self.store.load(key, params)
+            if pyramid == None:
+                pyramid = self.compute(image)
+                self.store.save(key, params, pyramid)
+        else:
+            pyramid = self.compute(image)
+        if self.cachesize > 0:
+            self.cache[key] = pyramid
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        return pyramid
+
+    def nbbytes(self, rows, cols):
+        """ Estimates the peak memory taken by computing the pyramid of an image: its
+            features, and the work buffers of HOGComputer for the largest scale.
+        """
+        sc = 2 ** (1. / self.interval)
+        maxscale = 1 + int(np.floor(np.log(min(rows, cols) / (5. * self.sbin))
+                                    / np.log(sc)))
+        nblevels = max(maxscale, 0) + self.interval
+        nbcells = 0
+        for level in range(0, nblevels):
+            # Level l is at scale 2/sc**l in cells of sbin pixels, padded by 1 more
+            # cell than the padding
+            scale = 2 / sc ** level
+            size = [max(int(round(d * scale / self.sbin)) - 2, 0) + 2 * (p + 1)
+                    for d, p in [(rows, self.pady), (cols, self.padx)]]
+            nbcells += size[0] * size[1]
+        return nbcells * nbfeatures * 8 + workbytesperpixel * rows * cols
+
+    def compute(self, image):
+        """ Computes the feature pyramid of an image, as featpyramid.m does: each
+            octave is computed at sbin/2 for the first one, then at sbin for each
+            successive halving of the image.
+        """
+        sbin, interval = self.sbin, self.interval
+        sc = 2 ** (1. / interval)
+        imsize = image.shape[0:2]
+        maxscale = 1 + int(np.floor(np.log(min(imsize) / (5. * sbin)) / np.log(sc)))
+        nblevels = max(maxscale, 0) + interval
+        feat = [None] * nblevels
+        scales = np.zeros(nblevels)
+        for i in range(0, interval):
+            scaled = _resize(image, 1 / sc ** i)
+            # "first" 2x interval
+            feat[i] = self.hog.features(scaled, sbin // 2)
+            scales[i] = 2 / sc ** i
+            # "second" 2x interval
+            if i + interval < nblevels:
+                feat[i + interval] = self.hog.features(scaled, sbin)
+                scales[i + interval] = 1 / sc ** i
+            # remaining intervals
+            for j in range(i + interval, nblevels - interval, interval):
+                scaled = _resize(scaled, 0.5)
+                feat[j + interval] = self.hog.features(scaled, sbin)
+                scales[j + interval] = 0.5 * scales[j]
+        # Pad with 1 more cell because features deletes a 1-cell border
+        padding = [(self.pady + 1, self.pady + 1), (self.padx + 1, self.padx + 1),
+                   (0, 0)]
+        feat = [np.pad(f, padding, 'constant') for f in feat if f is not None]
+        return FeaturePyramid(feat, scales[0:len(feat)], sbin, interval, self.padx,
+                              self.pady, imsize)
+
+def features(image, sbin):
+    """ Computes the HOG features of an image, see HOGComputer.features.
+    """
+    return HOGComputer().features(image, sbin)
+
+def featpyramid(image, sbin=8, interval=10, padx=0, pady=0):
+    """ Computes the feature pyramid of an image, without caching.
+    """
+    return PyramidBuilder(sbin, interval, padx, pady, 0).build(image)
@@ -0,0 +1,248 @@
+""" Folds for k-fold cross validation, stored as a manifest listing the positive images
+of each fold instead of folders of symlinks.
+
+Positives are split at random into k folds of sizes differing by at most one, and
+each fold gets the negatives generated from its own positives ONLY, as negatives
+from other folds may otherwise end up in the test data. Negatives are indexed by the
+stem of their source image once, whether they were written as png files or as a box
+index or patch store by negatives.py, so building folds does not scan the negatives
+folder per positive.
+
+The manifest is a json file with paths relative to it:
+
+{"k": 5, "seed": 0, "positivesfolder": ..., "negativesfolder": ...,
+ "folds": [[image names of fold 0], ...]}
+
+Training and evaluation code streams positives and negatives of some folds from it.
+export_symlinks writes the historical layout of makefolds.py, one folder per fold
+with positives and negatives subfolders of symlinks, for tools which need it.
+"""
+import numpy as np
+import json
+import os
+import os.path
+import negativestore
+import imagecache
+
+# Name of the manifest within a folds folder.
+manifestname = 'folds.json'
+_imageextensions = ('.jpg', '.png', '.gif')
+
+def _relpath(path, folder):
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(folder))
+
+def negative_files(negfolder):
+    """ Indexes the png negatives written by negatives.py by stem, in a single listing
+        of their folder.
+    Returns:
+        A dict mapping each stem to the file names of its negatives, in order.
+    """
+    files = {}
+    for filename in os.listdir(negfolder):
+        stem, _, i = os.path.splitext(filename)[0].rpartition('_neg_')
+        if stem != '' and filename.endswith('.png') and i.isdigit():
+            files.setdefault(stem, []).append((int(i), filename))
+    return dict([(stem, [f for i, f in sorted(negs)]) for stem, negs in files.items()])
+
+def split(imagenames, k, seed=None):
+    """ Splits image names into k folds at random, the first folds getting one more
+        image when they cannot all have the same size.
+    Args:
+        imagenames (list): names to split.
+        k (int): number of folds, at least 2.
+        seed (int): seed of the random permutation, None for a random one.
+    Returns:
+        The list of names of each fold.
+    """
+    if k < 2:
+        raise ValueError("The number of folds must be at least 2.")
+    perm = np.random.RandomState(seed).permutation(len(imagenames))
+    permutednames = [imagenames[i] for i in perm]
+    minfoldsize, remainder = divmod(len(imagenames), k)
+    folds = []
+    idx = 0
+    for i in range(0, k):
+        foldsize = minfoldsize + (1 if i < remainder else 0)
+        folds.append(permutednames[idx:idx+foldsize])
+        idx += foldsize
+    return folds
+
+class FoldManifest:
+    def __init__(self, folds, positivesfolder, negativesfolder, seed=None):
+        """ Initializes a manifest.
+        Args:
+            folds (list): names of the positive images of each fold.
+            positivesfolder (str): folder of the positive images.
+            negativesfolder (str): folder of the negatives written by negatives.py.
+            seed (int): seed the folds were split with, for reference.
+        """
+        self.folds = folds
+        self.positivesfolder = positivesfolder
+        self.negativesfolder = negativesfolder
+        self.seed = seed
+        self.negindex = None
+        self.negfiles = None
+
+    @staticmethod
+    def build(k, positivesfolder, negativesfolder, annotationsource=None, seed=None):
+        """ Splits the positive images of a folder into folds.
+        Args:
+            annotationsource: AnnotationStore or JsonAnnotations, to only split the
+                annotated positives, or None to split all of them.
+        """
+        imagenames = sorted([f for f in os.listdir(positivesfolder)
+                             if f.endswith(_imageextensions)])
+        if annotationsource != None:
+            imagenames = [f for f in imagenames
+                          if annotationsource.hasboxes(os.path.splitext(f)[0])]
+        return FoldManifest(split(imagenames, k, seed), positivesfolder,
+                            negativesfolder, seed)
+
+    @staticmethod
+    def load(filename):
+        """ Loads a manifest written by save.
+        """
+        folder = os.path.dirname(filename)
+        manifestfile = open(filename)
+        data = json.load(manifestfile)
+        manifestfile.close()
+        return FoldManifest(data['folds'],
+                            os.path.normpath(os.path.join(folder,
+                                                          data['positivesfolder'])),
+                            os.path.normpath(os.path.join(folder,
+                                                          data['negativesfolder'])),
+                            data['seed'])
+
+    def save(self, filename):
+        """ Saves the manifest to a json file, with folders relative to it.
+        """
+        folder = os.path.dirname(filename)
+        manifestfile = open(filename, 'w')
+        json.dump({'k': len(self.folds), 'seed': self.seed,
+                   'positivesfolder': _relpath(self.positivesfolder, folder),
+                   'negativesfolder': _relpath(self.negativesfolder, folder),
+                   'folds': self.folds}, manifestfile)
+        manifestfile.close()
+
+    def __len__(self):
+        return len(self.folds)
+
+    def _indexnegatives(self):
+        """ Indexes the negatives by stem the first time they are needed.
+        """
+        if self.negativesfolder == None:
+            raise ValueError("The folds have no negatives folder.")
+        if self.negindex == None and self.negfiles == None:
+            self.negindex = negativestore.load(self.negativesfolder)
+            if self.negindex == None:
+                self.negfiles = negative_files(self.negativesfolder)
+
+    def stems(self, folds):
+        """ Stems of the positive images of some folds.
+        """
+        return [os.path.splitext(f)[0] for fold in folds for f in self.folds[fold]]
+
+    def complement(self, folds):
+        """ Indices of the folds not in the given ones, e.g. to train on when testing
+            on them.
+        """
+        return [i for i in range(0, len(self.folds)) if i not in folds]
+
+    def positives(self, folds):
+        """ Streams the positive images of some folds.
+        Returns:
+            An iterator of (stem, imagefilename) pairs.
+        """
+        for fold in folds:
+            for imagename in self.folds[fold]:
+                yield (os.path.splitext(imagename)[0],
+                       os.path.join(self.positivesfolder, imagename))
+
+    def negativefiles(self, folds):
+        """ Streams the file names of the png negatives of some folds.
+        Returns:
+            An iterator of (stem, negativefilename) pairs.
+        """
+        self._indexnegatives()
+        if self.negfiles == None:
+            raise ValueError("Negatives are stored in " + self.negativesfolder
+                             + ", not as individual files.")
+        for stem in self.stems(folds):
+            for filename in self.negfiles.get(stem, []):
+                yield stem, os.path.join(self.negativesfolder, filename)
+
+    def negatives(self, folds):
+        """ Streams the negative patches of some folds, whatever the way negatives.py
+            wrote them.
+        Returns:
+            An iterator of ((stem, i), patch) pairs.
+        """
+        self._indexnegatives()
+        if self.negindex != None:
+            for stem in self.stems(folds):
+                if stem in self.negindex.stemidx:
+                    for i, patch in enumerate(self.negindex.crops(stem)):
+                        yield (stem, i), patch
+            return
+        for stem in self.stems(folds):
+            for i, filename in enumerate(self.negfiles.get(stem, [])):
+                patch = imagecache.imread(os.path.join(self.negativesfolder, filename))
+                if patch is not None:
+                    yield (stem, i), patch
+
+    def negativeindex(self, folds):
+        """ Box index or patch store of the negatives of some folds, None if the
+            negatives were written as individual files.
+        """
+        self._indexnegatives()
+        if self.negindex == None:
+            return None
+        return self.negindex.subset(self.stems(folds))
+
+def export_symlinks(manifest, outfolder):
+    """ Writes the folds in the layout of makefolds.py: for each fold, a positives
+        folder of symlinks to its images, and a negatives folder of symlinks to its
+        negatives or the subset of the negatives index for it.
+    """
+    for fold in range(0, len(manifest)):
+        posoutfolder = os.path.join(outfolder, repr(fold), 'positives')
+        negoutfolder = os.path.join(outfolder, repr(fold), 'negatives')
+        for folder in [posoutfolder, negoutfolder]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        # Relative symlinks, so they play well with git
+        links = ([(path, posoutfolder) for stem, path in manifest.positives([fold])])
+        negindex = manifest.negativeindex([fold])
+        if negindex != None:
+            negativestore.save(negindex, negoutfolder)
+        else:
+            links += [(path, negoutfolder)
+                      for stem, path in manifest.negativefiles([fold])]
+        for path, folder in links:
+            symlinkpath = os.path.join(folder, os.path.basename(path))
+            if not os.path.lexists(symlinkpath):
+                os.symlink(os.path.relpath(path, folder), symlinkpath)
+
+def open_folds(path):
+    """ Opens folds from a manifest file, a folder containing one, or a folder written
+        by export_symlinks or older versions of makefolds.py. Only the positives of
+        the latter are available.
+    """
+    if os.path.isdir(path) and os.path.isfile(os.path.join(path, manifestname)):
+        path = os.path.join(path, manifestname)
+    if os.path.isfile(path):
+        return FoldManifest.load(path)
+    # Symlink layout: read the folds back from the positives folders
+    folds = []
+    positivesfolder = None
+    while os.path.isdir(os.path.join(path, repr(len(folds)), 'positives')):
+        posfolder = os.path.join(path, repr(len(folds)), 'positives')
+        imagenames = sorted([f for f in os.listdir(posfolder)
+                             if f.endswith(_imageextensions)])
+        if positivesfolder == None and imagenames != []:
+            positivesfolder = os.path.dirname(os.path.realpath(
+                    os.path.join(posfolder, imagenames[0])))
+        folds.append(imagenames)
+    if folds == []:
+        raise ValueError("No folds in " + path)
+    return FoldManifest(folds, positivesfolder, None)
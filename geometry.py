@@ -0,0 +1,204 @@
+""" Vectorized geometry of bounding boxes: areas, overlaps and intersection over union
+of many boxes at once, and greedy and soft non-maximum suppression.
+
+Boxes are (N,4) arrays of [ulx,uly,drx,dry] rows, the array form of the
+[[ulx,uly],[drx,dry]] bounding boxes of negatives.py. Coordinates are inclusive pixel
+coordinates, so a box covers (drx-ulx+1)*(dry-uly+1) pixels, as in the voc-dpm
+code.
+
+Functions named pairwise_* compare every box of a first array with every box of a
+second one, the others compare rows of two arrays of the same length one to one.
+Suppression functions take an optional group of each box, e.g. the index of the
+image it was detected in, so the detections of a whole batch of images are
+suppressed in one call without boxes of different groups suppressing each other.
+"""
+import numpy as np
+
+def toarray(bboxes):
+    """ Converts a list of [[ulx,uly],[drx,dry]] bounding boxes into an (N,4) integer
+        array of [ulx,uly,drx,dry] rows.
+    """
+    return np.array(bboxes, dtype=np.int64).reshape([-1, 4])
+
+def fromarray(boxarray):
+    """ Converts an (N,4) array of [ulx,uly,drx,dry] rows back into a list of
+        [[ulx,uly],[drx,dry]] bounding boxes with python numbers.
+    """
+    return [[[ulx,uly],[drx,dry]] for [ulx,uly,drx,dry] in boxarray.tolist()]
+
+def areas(boxes):
+    """ Number of pixels covered by each box, 0 for empty boxes.
+    """
+    return (np.maximum(boxes[:,2] - boxes[:,0] + 1, 0)
+            * np.maximum(boxes[:,3] - boxes[:,1] + 1, 0))
+
+def overlapping(boxes1, boxes2):
+    """ True for each pair of rows of boxes sharing at least one pixel, the array
+        version of negatives.overlapping.
+    """
+    return ~((boxes1[:,0] > boxes2[:,2]) | (boxes2[:,0] > boxes1[:,2]) |
+             (boxes1[:,1] > boxes2[:,3]) | (boxes2[:,1] > boxes1[:,3]))
+
+def intersection(boxes1, boxes2):
+    """ Intersection of each pair of rows of boxes, the array version of
+        negatives.intersection. Only meaningful for overlapping pairs.
+    """
+    return np.concatenate([np.maximum(boxes1[:,0:2], boxes2[:,0:2]),
+                           np.minimum(boxes1[:,2:4], boxes2[:,2:4])], axis=1)
+
+def iou(boxes1, boxes2):
+    """ Intersection over union of each pair of rows of boxes.
+    """
+    w = np.minimum(boxes1[:,2], boxes2[:,2]) - np.maximum(boxes1[:,0], boxes2[:,0]) + 1
+    h = np.minimum(boxes1[:,3], boxes2[:,3]) - np.maximum(boxes1[:,1], boxes2[:,1]) + 1
+    inter = (np.maximum(w, 0) * np.maximum(h, 0)).astype(np.float64)
+    return inter / np.maximum(areas(boxes1) + areas(boxes2) - inter, 1)
+
+def pairwise_overlapping(boxes1, boxes2):
+    """ (N,M) boolean matrix of the pairs of boxes sharing at least one pixel.
+    """
+    b1 = boxes1[:,np.newaxis,:]
+    b2 = boxes2[np.newaxis,:,:]
+    return ~((b1[:,:,0] > b2[:,:,2]) | (b2[:,:,0] > b1[:,:,2]) |
+             (b1[:,:,1] > b2[:,:,3]) | (b2[:,:,1] > b1[:,:,3]))
+
+def pairwise_intersection_areas(boxes1, boxes2):
+    """ (N,M) matrix of the number of pixels shared by each pair of boxes.
+    """
+    w = (np.minimum(boxes1[:,np.newaxis,2], boxes2[np.newaxis,:,2])
+         - np.maximum(boxes1[:,np.newaxis,0], boxes2[np.newaxis,:,0]) + 1)
+    h = (np.minimum(boxes1[:,np.newaxis,3], boxes2[np.newaxis,:,3])
+         - np.maximum(boxes1[:,np.newaxis,1], boxes2[np.newaxis,:,1]) + 1)
+    return np.maximum(w, 0) * np.maximum(h, 0)
+
+def pairwise_iou(boxes1, boxes2):
+    """ (N,M) matrix of the intersection over union of each pair of boxes.
+    """
+    inter = pairwise_intersection_areas(boxes1, boxes2).astype(np.float64)
+    union = areas(boxes1)[:,np.newaxis] + areas(boxes2)[np.newaxis,:] - inter
+    return inter / np.maximum(union, 1)
+
+def _separate(boxes, groups):
+    """ Offsets boxes so that boxes of different groups never overlap.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if groups is None or boxes.shape[0] == 0:
+        return boxes
+    span = boxes[:,2:4].max() - boxes[:,0:2].min() + 2
+    return boxes + (np.asarray(groups) * span)[:,np.newaxis]
+
+def nms(boxes, scores, overlap=0.5, groups=None, max_num=None, blocksize=64):
+    """ Greedy non-maximum suppression: boxes are visited in decreasing order of
+        score, and kept unless their overlap with an already kept box is larger than
+        the threshold.
+    Args:
+        boxes (array): (N,4) boxes.
+        scores (array): (N,) scores.
+        overlap (float): maximum intersection over union with a kept box.
+        groups (array): (N,) group of each box, None if all are in the same group.
+        max_num (int): maximum number of boxes to keep, None to keep all of them.
+        blocksize (int): number of boxes processed together. The best remaining
+            boxes are suppressed within a block, then the kept ones suppress all the
+            other remaining boxes in a single matrix.
+    Returns:
+        The indices of the kept boxes, in decreasing order of score, ties being kept
+        in their original order.
+    """
+    order = np.argsort(-np.asarray(scores), kind='mergesort')
+    boxes = _separate(boxes, groups)
+    keep = []
+    remaining = order
+    while remaining.size > 0 and (max_num == None or len(keep) < max_num):
+        # Greedy suppression within the block of the best remaining boxes, which
+        # none of the kept boxes suppress
+        block = remaining[0:blocksize]
+        blockiou = pairwise_iou(boxes[block], boxes[block]) > overlap
+        suppressed = np.zeros(block.size, dtype=np.bool_)
+        blockkeep = []
+        for i in range(0, block.size):
+            if not suppressed[i]:
+                blockkeep.append(i)
+                suppressed[i+1:] |= blockiou[i,i+1:]
+        blockkeep = block[blockkeep]
+        keep.extend(blockkeep.tolist())
+        # Then all the remaining boxes at once, so clusters of boxes around the same
+        # object are dropped as soon as the best one is kept
+        remaining = remaining[blocksize:]
+        if remaining.size > 0:
+            remaining = remaining[~np.any(pairwise_iou(boxes[remaining],
+                                                       boxes[blockkeep]) > overlap,
+                                          axis=1)]
+    return np.array(keep[0:max_num], dtype=np.int64)
+
+def soft_nms(boxes, scores, sigma=0.5, overlap=0.3, method='linear', minscore=0.001,
+             groups=None):
+    """ Soft non-maximum suppression as in Bodla et al., "Soft-NMS: Improving Object
+        Detection With One Line of Code": instead of removing the boxes overlapping a
+        kept box, their scores are decayed according to the overlap.
+    Args:
+        boxes (array): (N,4) boxes.
+        scores (array): (N,) scores, assumed positive.
+        sigma (float): width of the gaussian decay.
+        overlap (float): overlap above which scores are decayed, for linear decay.
+        method (str): 'linear' to multiply scores by 1 - iou above the overlap,
+            'gaussian' to multiply them by exp(-iou^2/sigma), or 'greedy' to set them
+            to 0 above the overlap, which amounts to nms.
+        minscore (float): boxes whose decayed score falls below it are dropped.
+        groups (array): (N,) group of each box, None if all are in the same group.
+    Returns:
+        The indices of the kept boxes and their decayed scores, in decreasing order of
+        decayed score.
+    """
+    if method not in ['linear', 'gaussian', 'greedy']:
+        raise ValueError("Unknown method " + repr(method))
+    boxes = _separate(boxes, groups)
+    remaining = np.arange(boxes.shape[0])
+    current = np.array(scores, dtype=np.float64)
+    remaining = remaining[current[remaining] >= minscore]
+    boxareas = areas(boxes)
+    keep = []
+    keptscores = []
+    while remaining.size > 0:
+        best = np.argmax(current[remaining])
+        i = remaining[best]
+        keep.append(i)
+        keptscores.append(current[i])
+        remaining = np.delete(remaining, best)
+        others = boxes[remaining]
+        w = (np.minimum(boxes[i,2], others[:,2])
+             - np.maximum(boxes[i,0], others[:,0]) + 1)
+        h = (np.minimum(boxes[i,3], others[:,3])
+             - np.maximum(boxes[i,1], others[:,1]) + 1)
+        inter = np.maximum(w, 0) * np.maximum(h, 0)
+        iou = inter / np.maximum(boxareas[i] + boxareas[remaining] - inter, 1)
+        if method == 'linear':
+            decay = np.where(iou > overlap, 1 - iou, 1)
+        elif method == 'gaussian':
+            decay = np.exp(-iou * iou / sigma)
+        else:
+            decay = np.where(iou > overlap, 0, 1)
+        current[remaining] *= decay
+        remaining = remaining[current[remaining] >= minscore]
+    return np.array(keep, dtype=np.int64), np.array(keptscores)
+
+def nms_detections(batch, overlap=0.5, max_num=None):
+    """ Greedy non-maximum suppression of the detections of a batch of images at
+        once, as returned by DPMObjectDetection.detectBatch.
+    Args:
+        batch (list): for each image, a list of (bbox, score) pairs.
+    Returns:
+        For each image, the kept (bbox, score) pairs in decreasing order of score.
+    """
+    counts = [len(detections) for detections in batch]
+    if sum(counts) == 0:
+        return [[] for detections in batch]
+    detections = [d for image in batch for d in image]
+    boxes = toarray([bbox for bbox, score in detections])
+    scores = np.array([score for bbox, score in detections], dtype=np.float64)
+    groups = np.repeat(np.arange(len(batch)), counts)
+    keep = nms(boxes, scores, overlap, groups)
+    kept = [[] for image in batch]
+    for k in keep.tolist():
+        if max_num == None or len(kept[groups[k]]) < max_num:
+            kept[groups[k]].append(detections[k])
+    return kept
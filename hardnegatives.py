@@ -0,0 +1,263 @@
+""" Mining of hard negatives, i.e. false positives of the current model on background
+patches, to train the next model with.
+
+The negative patches written by negatives.py are scanned at all scales through
+DPMObjectDetection.detectBatch, and the highest scoring detections are kept in a
+cache bounded in size, the lowest scoring ones being evicted first. Each mining round
+first rescores the cached negatives with the new model, then scans a bounded number
+of new patches, resuming where the previous round stopped, and only keeps detections
+scoring above the easiest cached negative once the cache is full. The cached
+negatives are cropped with some context, and written as small images for the next
+training iteration, so both mining and training costs grow with the size of the
+cache and not with the number of negative patches.
+"""
+import numpy as np
+import cv2
+import heapq
+import itertools
+import os
+import os.path
+import negatives as neg
+import negativestore
+import folds
+import imagecache
+
+def negative_patches(folder):
+    """ Negative patches written by negatives.py to a folder, whatever the output mode.
+    Returns:
+        An iterator of ((stem, i), patch) pairs, the i-th negative patch of each
+        source image.
+    """
+    index = negativestore.load(folder)
+    if index != None:
+        for stem in index.stems:
+            for i, patch in enumerate(index.crops(stem)):
+                yield (stem, i), patch
+        return
+    for stem, filenames in sorted(folds.negative_files(folder).items()):
+        for i, filename in enumerate(filenames):
+            patch = imagecache.imread(os.path.join(folder, filename))
+            if patch is not None:
+                yield (stem, i), patch
+
+class HardNegative:
+    def __init__(self, key, bbox, score, crop):
+        """ Initializes a hard negative.
+        Args:
+            key (tuple): (stem, i) key of the negative patch it was found in.
+            bbox (list): [[ulx,uly],[drx,dry]] detection in the patch.
+            score (float): score of the detection with the model that found it, or
+                of the best detection in the crop with the last model.
+            crop (array): crop of the patch around the detection.
+        """
+        self.key = key
+        self.bbox = bbox
+        self.score = score
+        self.crop = crop
+
+def _detection(negative):
+    """ Hashable identity of a hard negative, its patch and bounding box.
+    """
+    return negative.key, tuple(map(tuple, negative.bbox))
+
+class HardNegativeCache:
+    """ Bounded cache of the highest scoring hard negatives, as a heap of their scores
+        so the easiest one is evicted in logarithmic time. A detection is cached at
+        most once, however many times its patch is scanned.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.heap = []
+        self.counter = itertools.count()
+        # (key, bbox) of the cached negatives
+        self.detections = set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def full(self):
+        return len(self.heap) >= self.maxsize
+
+    def minscore(self):
+        """ Score a negative must beat to enter the full cache, -inf if not full.
+        """
+        return self.heap[0][0] if self.full() else -np.inf
+
+    def push(self, negative):
+        """ Adds a hard negative, evicting the lowest scoring one if the cache is full.
+        Returns:
+            True if and only if the negative was kept, False as well if the same
+            detection is already cached.
+        """
+        detection = _detection(negative)
+        if detection in self.detections:
+            return False
+        # The counter breaks ties between scores without comparing negatives
+        entry = (negative.score, next(self.counter), negative)
+        if not self.full():
+            heapq.heappush(self.heap, entry)
+        elif negative.score <= self.heap[0][0]:
+            return False
+        else:
+            score, c, evicted = heapq.heapreplace(self.heap, entry)
+            self.detections.discard(_detection(evicted))
+        self.detections.add(detection)
+        return True
+
+    def negatives(self):
+        """ Cached negatives, in decreasing order of score.
+        """
+        return [negative for score, c, negative in sorted(self.heap, reverse=True)]
+
+    def replace(self, negatives):
+        """ Replaces the content of the cache, e.g. after rescoring.
+        """
+        self.heap = []
+        self.detections = set()
+        for negative in negatives:
+            self.push(negative)
+
+class HardNegativeMiner:
+    def __init__(self, detector, cache, thresh=-1.0, context=0.5, batchsize=16,
+                 max_num=10):
+        """ Initializes the miner.
+        Args:
+            detector: DPMObjectDetection, or anything with the same detectBatch, with
+                the current model set.
+            cache (HardNegativeCache): cache to fill.
+            thresh (float): minimum score of hard negatives, e.g. -1 for the margin of
+                the latent SVM.
+            context (float): fraction of the size of a detection added on each side
+                when cropping it.
+            batchsize (int): number of patches given to detectBatch at once.
+            max_num (int): maximum number of detections per patch.
+        """
+        self.detector = detector
+        self.cache = cache
+        self.thresh = thresh
+        self.context = context
+        self.batchsize = batchsize
+        self.max_num = max_num
+        self.nbscanned = 0
+
+    def crop(self, patch, bbox):
+        """ Crop of a patch around a detection, with context.
+        """
+        [[ulx,uly],[drx,dry]] = bbox
+        mx = int(round(self.context * (drx - ulx + 1)))
+        my = int(round(self.context * (dry - uly + 1)))
+        rows, cols = patch.shape[0:2]
+        return np.array(patch[max(uly-my, 0):min(dry+my+1, rows),
+                              max(ulx-mx, 0):min(drx+mx+1, cols)])
+
+    def rescore(self):
+        """ Rescores the cached negatives with the current model, dropping the ones it
+            does not detect above the threshold anymore.
+        """
+        cached = self.cache.negatives()
+        rescored = []
+        for start in range(0, len(cached), self.batchsize):
+            batch = cached[start:start+self.batchsize]
+            detections = self.detector.detectBatch([n.crop for n in batch],
+                                                   self.thresh, 1)
+            for negative, ds in zip(batch, detections):
+                if ds != []:
+                    negative.score = ds[0][1]
+                    rescored.append(negative)
+        self.cache.replace(rescored)
+
+    def scan(self, patches, budget):
+        """ Scans new negative patches with the current model.
+        Args:
+            patches (iterator): ((stem, i), patch) pairs, e.g. from negative_patches.
+                Giving the same iterator to the next call resumes where this one
+                stopped.
+            budget (int): maximum number of patches to scan.
+        Returns:
+            The number of patches scanned, lower than the budget once the iterator is
+            exhausted.
+        """
+        nbscanned = 0
+        while nbscanned < budget:
+            batch = list(itertools.islice(patches,
+                                          min(self.batchsize, budget - nbscanned)))
+            if batch == []:
+                break
+            nbscanned += len(batch)
+            # Once the cache is full, only detections harder than the easiest cached
+            # negative are worth computing
+            thresh = max(self.thresh, self.cache.minscore())
+            detections = self.detector.detectBatch([patch for key, patch in batch],
+                                                   thresh, self.max_num)
+            for (key, patch), ds in zip(batch, detections):
+                for bbox, score in ds:
+                    if score > self.cache.minscore():
+                        self.cache.push(HardNegative(key, bbox, score,
+                                                     self.crop(patch, bbox)))
+        self.nbscanned += nbscanned
+        return nbscanned
+
+    def mine(self, patches, budget):
+        """ Runs a mining round: rescores the cache, then scans new patches.
+        Returns:
+            The number of patches scanned.
+        """
+        self.rescore()
+        return self.scan(patches, budget)
+
+def write_negatives(cache, folder):
+    """ Writes the crops of the cached negatives to a folder, replacing previous ones.
+    Returns:
+        The filenames of the crops, in decreasing order of score.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for filename in os.listdir(folder):
+        if filename.startswith('hardneg_'):
+            os.remove(os.path.join(folder, filename))
+    filenames = []
+    for rank, negative in enumerate(cache.negatives()):
+        stem, i = negative.key
+        filename = os.path.join(folder, 'hardneg_' + repr(rank) + '_'
+                                + neg.negative_filename(stem, i))
+        cv2.imwrite(filename, negative.crop)
+        filenames.append(filename)
+    return filenames
+
+def train_with_mining(detector, model, pos, negativesfolder, outputfolder, nbrounds,
+                      cachesize, budget, warp, nbiter, nbnegiter, maxnumexamples,
+                      overlap, numfp, cont, tag, C, thresh=-1.0):
+    """ Trains a model alternating hard negative mining and training iterations.
+    Args:
+        detector (DPMObjectDetection): detector to mine and train with.
+        model: initial model, set into the detector before the first round.
+        pos: positives, as given to trainDPMmodel.
+        negativesfolder (str): folder of negative patches written by negatives.py,
+            or a function without arguments returning a new iterator of
+            ((stem, i), patch) pairs, e.g. over the negatives of some folds.
+        outputfolder (str): folder to write the hard negatives of each round to.
+        nbrounds (int): number of mining and training rounds.
+        cachesize (int): maximum number of hard negatives.
+        budget (int): maximum number of new negative patches scanned per round.
+        thresh (float): minimum score of hard negatives.
+        See DPMObjectDetection.trainDPMmodel for the other arguments.
+    Returns:
+        The trained model.
+    """
+    if isinstance(negativesfolder, basestring):
+        patchsource = lambda: negative_patches(negativesfolder)
+    else:
+        patchsource = negativesfolder
+    detector.setModel(model)
+    miner = HardNegativeMiner(detector, HardNegativeCache(cachesize), thresh)
+    patches = patchsource()
+    for r in range(0, nbrounds):
+        if miner.mine(patches, budget) < budget:
+            # Start over from the first patches with the next model
+            patches = patchsource()
+        negfilenames = write_negatives(miner.cache, outputfolder)
+        # The hard negatives are small, so mining them in MATLAB is cheap
+        model = detector.trainDPMmodel(model, pos, negfilenames, warp, 0, nbiter,
+                                       nbnegiter, maxnumexamples, overlap, numfp,
+                                       cont, tag, C)
+    return model
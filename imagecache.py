@@ -0,0 +1,217 @@
+""" Cache of decoded images, to avoid decoding the same source jpegs every time a tool
+runs. Decoded images are kept:
+
+- on disk as npy files in acdconf.imagecachefolder, keyed by the path and
+  modification time of the image file, so they survive across runs and processes.
+  The folder is bounded to acdconf.imagecachediskbytes bytes: when a process goes
+  over it, the least recently used files are removed, until it is down to 3/4 of it.
+- in memory in a least recently used cache bounded to acdconf.imagecachebytes bytes.
+  Worker processes reading each image once, e.g. those of negatives.py, turn it off
+  with configure, so the memory does not grow with the number of workers.
+
+Images returned by the cache are shared, hence read-only: copy them before drawing
+on them.
+"""
+import numpy as np
+import cv2
+import collections
+import hashlib
+import os
+import os.path
+import tempfile
+import acdconf as conf
+
+# Names of the counters reported by ImageCache.stats.
+statnames = ['hits', 'diskhits', 'misses', 'bytessaved']
+
+class ImageCache:
+    def __init__(self, cachefolder=None, maxbytes=0, maxdiskbytes=None):
+        """ Initializes the cache.
+        Args:
+            cachefolder (str): folder to store decoded images in, None to disable the
+                on-disk cache.
+            maxbytes (int): maximum number of bytes of images kept in memory, 0 to
+                disable the in-memory cache.
+            maxdiskbytes (int): maximum number of bytes of the files of the on-disk
+                cache, None for no bound.
+        """
+        self.cachefolder = cachefolder
+        self.maxbytes = maxbytes
+        self.maxdiskbytes = maxdiskbytes
+        # Bytes of the on-disk cache, counted when first needed
+        self.diskbytes = None
+        self.nbbytes = 0
+        self.images = collections.OrderedDict()
+        self.counters = dict([(name, 0) for name in statnames])
+        if cachefolder != None and not os.path.isdir(cachefolder):
+            try:
+                os.makedirs(cachefolder)
+            except OSError:
+                # Another process may have created it in the meantime
+                pass
+
+    def key(self, filename):
+        """ Key of an image file, changing whenever the file is modified.
+        """
+        return (os.path.abspath(filename), os.path.getmtime(filename))
+
+    def diskfilename(self, key):
+        """ Name of the file the decoded image for a key is stored to.
+        """
+        return os.path.join(self.cachefolder,
+                            hashlib.sha1(repr(key)).hexdigest() + '.npy')
+
+    def remember(self, key, image):
+        """ Adds an image to the in-memory cache, evicting least recently used images
+            until it fits the byte budget.
+        """
+        if image.nbytes > self.maxbytes:
+            return
+        self.images[key] = image
+        self.nbbytes += image.nbytes
+        while self.nbbytes > self.maxbytes:
+            _, evicted = self.images.popitem(last=False)
+            self.nbbytes -= evicted.nbytes
+
+    def stored(self, nbytes):
+        """ Accounts for a file written to the on-disk cache, pruning the least
+            recently used files when over the budget.
+        """
+        if self.maxdiskbytes == None:
+            return
+        if self.diskbytes == None:
+            # Counts the new file along with the others
+            self.diskbytes = prune(self.cachefolder, None)
+        else:
+            self.diskbytes += nbytes
+        if self.diskbytes > self.maxdiskbytes:
+            self.diskbytes = prune(self.cachefolder, self.maxdiskbytes * 3 // 4)
+
+    def imread(self, filename):
+        """ Same as cv2.imread in color mode, going through the cache.
+        Returns:
+            The decoded image as a read-only array, or None if it could not be read.
+        """
+        if not os.path.isfile(filename):
+            self.counters['misses'] += 1
+            return None
+        key = self.key(filename)
+        image = self.images.pop(key, None)
+        if image is not None:
+            # Put it back as the most recently used image
+            self.images[key] = image
+            self.counters['hits'] += 1
+            self.counters['bytessaved'] += image.nbytes
+            return image
+        if self.cachefolder != None:
+            diskfilename = self.diskfilename(key)
+            try:
+                image = np.load(diskfilename)
+            except (IOError, OSError):
+                # Not cached, or pruned by another process in the meantime
+                image = None
+            if image is not None:
+                try:
+                    # Marks it as recently used for pruning
+                    os.utime(diskfilename, None)
+                except OSError:
+                    pass
+                image.flags.writeable = False
+                self.counters['diskhits'] += 1
+                self.counters['bytessaved'] += image.nbytes
+                self.remember(key, image)
+                return image
+        self.counters['misses'] += 1
+        image = cv2.imread(filename)
+        if image is None:
+            return None
+        image.flags.writeable = False
+        if self.cachefolder != None:
+            # Write to a temporary file first so concurrent readers never see a
+            # partially written image.
+            fd, tmpfilename = tempfile.mkstemp(dir=self.cachefolder, suffix='.tmp')
+            tmpfile = os.fdopen(fd, 'wb')
+            np.save(tmpfile, image)
+            tmpfile.close()
+            os.rename(tmpfilename, diskfilename)
+            self.stored(os.path.getsize(diskfilename))
+        self.remember(key, image)
+        return image
+
+    def stats(self):
+        """ Returns a copy of the hit/miss and bytes saved counters.
+        """
+        return dict(self.counters)
+
+    def report(self):
+        """ Human readable summary of the counters.
+        """
+        return report(self.counters)
+
+def report(stats):
+    """ Human readable summary of cache counters, e.g. summed across processes.
+    """
+    return ("image cache: " + repr(stats['hits']) + " memory hits, "
+            + repr(stats['diskhits']) + " disk hits, " + repr(stats['misses'])
+            + " misses, " + repr(stats['bytessaved'] / 1024**2) + "MB not decoded")
+
+def add_stats(stats1, stats2):
+    """ Sums two sets of cache counters.
+    """
+    return dict([(name, stats1[name] + stats2[name]) for name in statnames])
+
+def prune(cachefolder, maxbytes):
+    """ Removes the least recently used files of an on-disk cache until it fits a
+        budget.
+    Args:
+        cachefolder (str): folder of the cache.
+        maxbytes (int): maximum number of bytes of its files, None to only count
+            them.
+    Returns:
+        The number of bytes of the files left.
+    """
+    files = []
+    for filename in os.listdir(cachefolder):
+        if not filename.endswith('.npy'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cachefolder, filename))
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, filename))
+    nbbytes = sum([size for mtime, size, filename in files])
+    if maxbytes == None:
+        return nbbytes
+    for mtime, size, filename in sorted(files):
+        if nbbytes <= maxbytes:
+            break
+        try:
+            os.remove(os.path.join(cachefolder, filename))
+        except OSError:
+            # Removed by another process
+            pass
+        nbbytes -= size
+    return nbbytes
+
+defaultcache = None
+
+def configure(maxbytes=conf.imagecachebytes, cachefolder=conf.imagecachefolder,
+              maxdiskbytes=conf.imagecachediskbytes):
+    """ Replaces the cache shared by the whole process, e.g. without memory in a
+        worker process reading each image once.
+    """
+    global defaultcache
+    defaultcache = ImageCache(cachefolder, maxbytes, maxdiskbytes)
+    return defaultcache
+
+def getcache():
+    """ The cache configured in acdconf, shared by the whole process.
+    """
+    if defaultcache == None:
+        configure()
+    return defaultcache
+
+def imread(filename):
+    """ Reads an image through the default cache.
+    """
+    return getcache().imread(filename)
@@ -0,0 +1,303 @@
+""" Lightweight instrumentation of the stages of the pipeline: timers with latency
+histograms and bytes processed per stage, counters, and optional cProfile and
+tracemalloc captures.
+
+Instrumentation is off unless acdconf.instrument is True or the ACD_INSTRUMENT
+environment variable is set, to 1 or to the name of the summary file. When off,
+timer returns a shared object doing nothing and count returns at once, so
+instrumented code only pays a function call per stage. When on, the summary is
+written when the process exits, by default to acdconf.instrumentfolder/<script>.json
+after the script that ran. acdconf.profile or ACD_PROFILE=1 also profile the whole
+process with cProfile, writing the stats next to the summary and the slowest
+functions into it, and trace allocations with tracemalloc where it is available,
+i.e. on python 3. Peak resident memory is reported either way.
+
+Worker processes record into their own copy of the recorder: collect takes their
+records, e.g. to return them along with results, and merge adds them to the
+recorder of the parent process.
+
+Usage:
+
+with instrumentation.timer('negatives/decode') as t:
+    image = cv2.imread(filename)
+    t.nbytes = image.nbytes
+instrumentation.count('negatives/images')
+"""
+import atexit
+import cProfile
+import json
+import math
+import os
+import os.path
+import pstats
+import resource
+import StringIO
+import sys
+import threading
+import time
+import acdconf as conf
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Upper bound in seconds of the first bin of latency histograms, each following bin
+# doubling it.
+firstbin = 1e-6
+nbbins = 32
+
+class _NullTimer:
+    """ Timer doing nothing, shared by all stages when instrumentation is off.
+    """
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_nulltimer = _NullTimer()
+
+class _Timer:
+    def __init__(self, recorder, stage, nbytes):
+        self.recorder = recorder
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.record(self.stage, time.time() - self.start, self.nbytes)
+        return False
+
+def _newstage():
+    return {'count': 0, 'total': 0.0, 'min': float('inf'), 'max': 0.0, 'bytes': 0,
+            'histogram': [0] * nbbins}
+
+def _bin(seconds):
+    """ Histogram bin of a latency.
+    """
+    if seconds <= firstbin:
+        return 0
+    return min(int(math.ceil(math.log(seconds / firstbin, 2))), nbbins - 1)
+
+class Recorder:
+    """ Latencies, bytes and counters recorded by a process, safe to record to from
+        several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats == None:
+                stats = self.stages[stage] = _newstage()
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+            stats['bytes'] += nbytes
+            stats['histogram'][_bin(seconds)] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def collect(self):
+        """ Takes the records so far, leaving the recorder empty.
+        Returns:
+            The records, to give to merge.
+        """
+        with self.lock:
+            records = {'stages': self.stages, 'counters': self.counters}
+            self.stages = {}
+            self.counters = {}
+        return records
+
+    def merge(self, records):
+        """ Adds records taken from another recorder by collect.
+        """
+        with self.lock:
+            for stage, other in records['stages'].items():
+                stats = self.stages.get(stage)
+                if stats == None:
+                    stats = self.stages[stage] = _newstage()
+                for name in ['count', 'total', 'bytes']:
+                    stats[name] += other[name]
+                stats['min'] = min(stats['min'], other['min'])
+                stats['max'] = max(stats['max'], other['max'])
+                stats['histogram'] = [a + b for a, b in zip(stats['histogram'],
+                                                            other['histogram'])]
+            for name, n in records['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+def _percentile(histogram, fraction):
+    """ Upper bound of the bin of a percentile of the latencies of a histogram.
+    """
+    rank = fraction * sum(histogram)
+    cumulated = 0
+    for i, n in enumerate(histogram):
+        cumulated += n
+        if cumulated >= rank and n > 0:
+            return firstbin * 2 ** i
+    return 0.0
+
+def summarize(records):
+    """ Human and machine readable summary of records: for each stage, its number of
+        calls, total, mean, extreme and approximate percentile latencies, bytes
+        processed and throughput, and histogram as [upper bound, count] pairs of its
+        non-empty bins.
+    """
+    stages = {}
+    for stage, stats in records['stages'].items():
+        histogram = stats['histogram']
+        stages[stage] = {
+            'count': stats['count'],
+            'total': stats['total'],
+            'mean': stats['total'] / max(stats['count'], 1),
+            'min': stats['min'],
+            'max': stats['max'],
+            'p50': _percentile(histogram, 0.5),
+            'p90': _percentile(histogram, 0.9),
+            'p99': _percentile(histogram, 0.99),
+            'bytes': stats['bytes'],
+            'bytespersecond': stats['bytes'] / max(stats['total'], 1e-12),
+            'histogram': [[firstbin * 2 ** i, n] for i, n in enumerate(histogram)
+                          if n > 0]
+            }
+    return {'stages': stages, 'counters': dict(records['counters'])}
+
+recorder = None
+profiler = None
+summaryfilename = None
+
+def enabled():
+    return recorder != None
+
+def timer(stage, nbytes=0):
+    """ Context manager timing a stage. Bytes processed by the stage are given when
+        known in advance, or set to the nbytes attribute of the timer within the
+        block.
+    """
+    if recorder == None:
+        return _nulltimer
+    return _Timer(recorder, stage, nbytes)
+
+def count(name, n=1):
+    """ Increments a counter.
+    """
+    if recorder != None:
+        recorder.count(name, n)
+
+def collect():
+    """ Takes the records of this process, None if instrumentation is off.
+    """
+    if recorder == None:
+        return None
+    return recorder.collect()
+
+def merge(records):
+    """ Adds records collected in another process, if any.
+    """
+    if recorder != None and records != None:
+        recorder.merge(records)
+
+def reset():
+    """ Forgets the records of this process, e.g. those inherited by a forked worker.
+    """
+    if recorder != None:
+        recorder.reset()
+
+def _defaultfilename():
+    script = os.path.splitext(os.path.basename(sys.argv[0] if sys.argv else ''))[0]
+    return os.path.join(conf.instrumentfolder, (script or 'python') + '.json')
+
+def enable(filename=None, profile=False):
+    """ Turns instrumentation on for the rest of the process, writing the summary to
+        a file when it exits.
+    Args:
+        filename (str): summary file, acdconf.instrumentfolder/<script>.json by
+            default.
+        profile (bool): also profile with cProfile, and tracemalloc if available.
+    """
+    global recorder, profiler, summaryfilename
+    if recorder == None:
+        recorder = Recorder()
+        atexit.register(_saveatexit)
+    summaryfilename = filename if filename != None else _defaultfilename()
+    if profile and profiler == None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        if tracemalloc != None:
+            tracemalloc.start()
+
+def disable():
+    """ Turns instrumentation off, dropping the records without writing them.
+    """
+    global recorder, profiler
+    if profiler != None:
+        profiler.disable()
+        if tracemalloc != None:
+            tracemalloc.stop()
+    recorder = None
+    profiler = None
+
+def summary():
+    """ Summary of the records of this process, see summarize, along with its peak
+        memory and the captures of the profilers.
+    """
+    result = summarize({'stages': recorder.stages, 'counters': recorder.counters})
+    # ru_maxrss is in kilobytes on Linux
+    result['peakmemory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if profiler != None:
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(20)
+        result['profile'] = stream.getvalue().splitlines()
+        if tracemalloc != None:
+            result['tracemalloc'] = [str(s) for s in
+                                     tracemalloc.take_snapshot().statistics(
+                                         'lineno')[0:20]]
+        else:
+            result['tracemalloc'] = "unavailable on python " + sys.version.split()[0]
+    return result
+
+def save(filename=None):
+    """ Writes the summary of this process to a json file, and the cProfile stats
+        to the same file with a .prof extension when profiling.
+    """
+    if filename == None:
+        filename = summaryfilename
+    folder = os.path.dirname(filename)
+    if folder != '' and not os.path.isdir(folder):
+        os.makedirs(folder)
+    if profiler != None:
+        profiler.disable()
+        profiler.dump_stats(os.path.splitext(filename)[0] + '.prof')
+    summaryfile = open(filename, 'w')
+    json.dump(summary(), summaryfile, indent=4, sort_keys=True)
+    summaryfile.close()
+
+def _saveatexit():
+    # Workers of multiprocessing pools exit without running atexit handlers, so only
+    # the main process writes the summary
+    if recorder != None and (recorder.stages != {} or recorder.counters != {}):
+        save()
+
+def _fromenvironment():
+    variable = os.environ.get('ACD_INSTRUMENT', '')
+    if conf.instrument or variable not in ['', '0']:
+        enable(variable if variable not in ['', '0', '1'] else None,
+               conf.profile or os.environ.get('ACD_PROFILE', '') not in ['', '0'])
+
+_fromenvironment()
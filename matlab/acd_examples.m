@@ -0,0 +1,41 @@
+function examples = acd_examples(names, boxes)
+% examples = acd_examples(names, boxes)
+% Builds the pos or neg struct array of voc-dpm's train from the arrays of
+% dpmDetection.examples_tomatlab, as pymatlab only passes numeric arrays.
+%
+% names   (n, l) uint8 array of the image file names, padded with zeros
+% boxes   (m, 5) array of [image x1 y1 x2 y2] rows, one per positive box, with
+%         1-based image indices and pixel coordinates. Omitted for negatives.
+
+if nargin < 2
+  % Negatives, as pascal_data.m builds them
+  examples = struct('im', {}, 'flip', {}, 'dataid', {});
+  for i = 1:size(names, 1)
+    examples(i).im = imname(names, i);
+    examples(i).flip = false;
+    examples(i).dataid = i;
+  end
+  return;
+end
+
+% Positives, one per box as pascal_data.m builds them
+examples = struct('im', {}, 'x1', {}, 'y1', {}, 'x2', {}, 'y2', {}, ...
+                  'boxes', {}, 'flip', {}, 'trunc', {}, 'dataids', {}, ...
+                  'sizes', {});
+for j = 1:size(boxes, 1)
+  b = double(boxes(j, 2:5));
+  examples(j).im = imname(names, boxes(j, 1));
+  examples(j).x1 = b(1);
+  examples(j).y1 = b(2);
+  examples(j).x2 = b(3);
+  examples(j).y2 = b(4);
+  examples(j).boxes = b;
+  examples(j).flip = false;
+  examples(j).trunc = 0;
+  examples(j).dataids = j;
+  examples(j).sizes = (b(3) - b(1) + 1) * (b(4) - b(2) + 1);
+end
+
+function name = imname(names, i)
+row = names(i, :);
+name = char(row(row > 0));
@@ -13,7 +13,16 @@ import cv2
 import json
 import os.path
 import os
-import sys
+import argparse
+import itertools
+import multiprocessing as mp
+import acdconf as conf
+import negativestore
+import imagecache
+import folds
+import annotations
+import geometry
+import instrumentation as instr
 
 def boxarea(bbox):
     """ Returns the area of a bounding box, assuming it is well formed.
@@ -114,11 +123,109 @@ def negative_samples_fromboxes(imagebox, bboxes, debug=False):
             negatives += negative_samples_fromboxes(division, smallerBoxes)
         return negatives
 
-def negative_samples_boxes(image, bboxes):
+# Indices into a [ulx1,uly1,drx1,dry1,ulx2,uly2,drx2,dry2] row giving the 4 divisions
+# computed by divide, for the horizontal and vertical cuts respectively, and the -1/+1
+# offsets to add to them.
+_hcutidx = np.array([[0,1,4,3],[6,1,2,3],[4,7,6,3],[4,1,6,5]])
+_hcutoff = np.array([[0,0,-1,0],[1,0,0,0],[0,1,0,0],[0,0,0,-1]])
+_vcutidx = np.array([[0,1,2,5],[0,7,2,3],[6,5,2,7],[0,5,4,7]])
+_vcutoff = np.array([[0,0,0,-1],[0,1,0,0],[1,0,0,0],[0,0,-1,0]])
+
+def divide_array(bigboxes, smallboxes):
+    """ Array version of divide, dividing each of the (S,4) bigboxes around the
+        corresponding row of smallboxes. Returns an (S,4,4) array of divisions in the
+        same order as divide, and an (S,4) boolean mask of the non-empty ones.
+    """
+    w = (bigboxes[:,2] - bigboxes[:,0]).astype(np.float64)
+    h = (bigboxes[:,3] - bigboxes[:,1]).astype(np.float64)
+    bw = smallboxes[:,2] - smallboxes[:,0]
+    bh = smallboxes[:,3] - smallboxes[:,1]
+    both = np.concatenate([bigboxes, smallboxes], axis=1)
+    hcut = (bw / w < bh / h)[:,np.newaxis,np.newaxis]
+    divisions = np.where(hcut, both[:,_hcutidx] + _hcutoff, 
+                         both[:,_vcutidx] + _vcutoff)
+    areas = ((divisions[:,:,2] - divisions[:,:,0]) 
+             * (divisions[:,:,3] - divisions[:,:,1]))
+
+    return divisions, areas > 0
+
+def negative_samples_fromarray(imagebox, boxes):
+    """ Same as negative_samples_fromboxes, but with the image box as a
+        [ulx,uly,drx,dry] array and the bounding boxes as an (N,4) array. Instead of
+        recursing, processes the whole recursion tree one level at a time: each level
+        holds all the current boxes, and all (box, bounding box) pairs still to be
+        checked for them, so the overlap test, clipping and division are done for all
+        of them at once. Boxes are kept in depth first order, so the negatives come out
+        in the same order as the recursive version. Returns an (M,4) array of negative
+        boxes.
+    """
+    nodes = imagebox.reshape([1,4])
+    pairnodes = np.zeros(boxes.shape[0], dtype=np.int64)
+    pairboxes = boxes
+
+    while True:
+        # Only keep bounding boxes overlapping their node, clipped to it
+        pairbig = nodes[pairnodes]
+        overlapmask = geometry.overlapping(pairbig, pairboxes)
+        pairnodes = pairnodes[overlapmask]
+        if pairnodes.shape[0] == 0:
+            return nodes
+        pairboxes = geometry.intersection(pairboxes[overlapmask],
+                                          pairbig[overlapmask])
+        # Divide each node around its first, hence largest, bounding box. Nodes
+        # without any bounding box left are negatives, and are kept as they are.
+        isfirst = np.ones(pairnodes.shape[0], dtype=np.bool_)
+        isfirst[1:] = pairnodes[1:] != pairnodes[:-1]
+        dividednodes = pairnodes[isfirst]
+        divisions, nonempty = divide_array(nodes[dividednodes], pairboxes[isfirst])
+        children = np.zeros([nodes.shape[0], 4, 4], dtype=np.int64)
+        children[:,0,:] = nodes
+        childmask = np.zeros([nodes.shape[0], 4], dtype=np.bool_)
+        childmask[:,0] = True
+        children[dividednodes] = divisions
+        childmask[dividednodes] = nonempty
+        # Each division inherits the remaining bounding boxes of its parent
+        parents = np.repeat(np.arange(nodes.shape[0]), childmask.sum(axis=1))
+        restnodes = pairnodes[~isfirst]
+        restboxes = pairboxes[~isfirst]
+        restcounts = np.bincount(restnodes, minlength=nodes.shape[0])
+        nodes = children[childmask]
+        reststarts = np.cumsum(restcounts) - restcounts
+        childcounts = restcounts[parents]
+        childstarts = np.cumsum(childcounts) - childcounts
+        restidx = (np.repeat(reststarts[parents] - childstarts, childcounts)
+                   + np.arange(childcounts.sum()))
+        pairnodes = np.repeat(np.arange(nodes.shape[0]), childcounts)
+        pairboxes = restboxes[restidx]
+
+# Engines available to negative_samples_boxes.
+engines = ['python', 'numpy']
+
+def negative_samples_boxes(image, bboxes, engine='python'):
+    """ Computes the negative sample boxes of an image, i.e. the largest background
+        patches not overlapping any of the bounding boxes.
+    Args:
+        image (array): image to compute negatives for.
+        bboxes (list): bounding boxes of the characters, as [[ulx,uly],[drx,dry]].
+        engine (str): 'python' for the recursion on lists of boxes, 'numpy' for the
+            version working on arrays of boxes. Both return the same boxes, numpy
+            only pays off for images with more than about 50 bounding boxes (see
+            scripts/benchnegatives.py).
+    Returns:
+        The negative boxes as a list of [[ulx,uly],[drx,dry]].
+    """
     rows, cols = image.shape[0:2]
     imagebox = [[0,0],[cols-1,rows-1]]
     sortedboxes = sorted(bboxes, key=boxarea, reverse=True)
-    negativeboxes = negative_samples_fromboxes(imagebox, sortedboxes)
+    if engine == 'python':
+        negativeboxes = negative_samples_fromboxes(imagebox, sortedboxes)
+    elif engine == 'numpy':
+        negativeboxes = geometry.fromarray(
+            negative_samples_fromarray(geometry.toarray(imagebox)[0],
+                                       geometry.toarray(sortedboxes)))
+    else:
+        raise ValueError("Unknown engine " + repr(engine) + ", should be one of "
+                         + repr(engines))
     
     return negativeboxes
 
@@ -127,31 +234,259 @@ def subimage(image,bbox):
     
     return image[uly:dry,ulx:drx,:]
 
-def negative_samples(image,bboxes):
-    negativeboxes = negative_samples_boxes(image,bboxes)
+def negative_samples(image,bboxes,engine='python'):
+    negativeboxes = negative_samples_boxes(image,bboxes,engine)
     
     return map(lambda bbox: subimage(image,bbox), negativeboxes)
 
-if __name__ == "__main__":
-    if sys.argv < 4:
-        raise ValueError("Please enter 3 folder names")
-    imagefilenames = [f for f in sorted(os.listdir(sys.argv[1]), key=str.lower) 
-                      if f.endswith('.jpg')]
+def negative_filename(stem, i):
+    """ Name of the file the i-th negative of an image is written to. Written in png
+        to avoid further loss in data (original images are jpeg for practicality).
+    """
+    return stem + '_neg_' + repr(i) + '.png'
+
+def load_manifest(manifestfilename):
+    """ Loads a manifest of images already processed by batch_negatives. The manifest
+        is a file with one json entry per line, appended to as images are processed,
+        so it survives crashes. Later entries for a stem override earlier ones.
+    Returns:
+        A dict mapping each stem to its latest entry.
+    """
+    manifest = {}
+    if not os.path.isfile(manifestfilename):
+        return manifest
+    manifestfile = open(manifestfilename)
+    for line in manifestfile:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Last line may be truncated if we crashed while writing it
+            continue
+        manifest[entry['stem']] = entry
+    manifestfile.close()
+
+    return manifest
+
+# Output modes of batch_negatives.
+outputmodes = ['png', 'boxes', 'memmap']
 
+def _initworker():
+    # Workers start without the records they inherit from this process, and read
+    # each image once, so they only cache images on disk
+    instr.reset()
+    imagecache.configure(maxbytes=0)
+
+def image_negatives((imagefilename, bboxes, outputfolder, engine, mode)):
+    """ Computes the negatives of a single image. Top level function so it can be sent
+        to worker processes. In png mode, the negatives are written to the output
+        folder, removing any stale negatives from a previous run.
+    Returns:
+        A dict with the number of negatives, and their boxes in boxes mode or the
+        patches themselves in memmap mode, along with the image cache counters.
+    """
+    cache = imagecache.getcache()
+    cachestats = cache.stats()
+    with instr.timer('negatives/decode') as t:
+        image = cache.imread(imagefilename)
+        t.nbytes = image.nbytes if image is not None else 0
+    cachestats = dict([(name, cache.stats()[name] - cachestats[name])
+                       for name in imagecache.statnames])
+    stem = os.path.splitext(os.path.basename(imagefilename))[0]
+    with instr.timer('negatives/boxes'):
+        negativeboxes = negative_samples_boxes(image, bboxes, engine)
+    instr.count('negatives/images')
+    instr.count('negatives/negatives', len(negativeboxes))
+    if mode == 'boxes':
+        return {'negatives': len(negativeboxes), 'boxes': negativeboxes,
+                'cachestats': cachestats, 'instrumentation': instr.collect()}
+    with instr.timer('negatives/crop'):
+        negatives = map(lambda bbox: subimage(image,bbox), negativeboxes)
+    if mode == 'memmap':
+        return {'negatives': len(negatives), 'crops': negatives,
+                'cachestats': cachestats, 'instrumentation': instr.collect()}
+    i = 0
+    for negative in negatives:
+        with instr.timer('negatives/encode', negative.nbytes):
+            cv2.imwrite(os.path.join(outputfolder, negative_filename(stem, i)),
+                        negative)
+        i += 1
+    # Remove negatives left over from a previous run with more of them
+    stale = os.path.join(outputfolder, negative_filename(stem, i))
+    while os.path.isfile(stale):
+        os.remove(stale)
+        i += 1
+        stale = os.path.join(outputfolder, negative_filename(stem, i))
+
+    return {'negatives': len(negatives), 'cachestats': cachestats,
+            'instrumentation': instr.collect()}
+
+def _remove_other_outputs(outputfolder, mode):
+    """ Removes the negatives written to a folder in other modes than the given one.
+    """
+    filenames = []
+    if mode != 'png':
+        filenames += sum(folds.negative_files(outputfolder).values(), [])
+    if mode != 'boxes':
+        filenames.append(negativestore.boxindexname)
+    if mode != 'memmap':
+        filenames += [negativestore.patchindexname, negativestore.patchdataname]
+    for filename in filenames:
+        if os.path.isfile(os.path.join(outputfolder, filename)):
+            os.remove(os.path.join(outputfolder, filename))
+
+def _compact(store, entries, manifestfilename):
+    """ Rewrites the data file of a patch store without its unreferenced data, along
+        with the manifest locating the patches of each entry in it.
+    Returns:
+        The store of the rewritten data file.
+    """
+    compacted = store.compact(store.datafilename + '.tmp')
+    for i, entry in enumerate(entries):
+        entry['patches'] = compacted.patchtable[
+            compacted.offsets[i]:compacted.offsets[i+1]].tolist()
+    manifestfile = open(manifestfilename + '.tmp', 'w')
+    for entry in entries:
+        manifestfile.write(json.dumps(entry) + '\n')
+    manifestfile.close()
+    # Without a manifest, a crash before both files are replaced redoes all images
+    # instead of reading patches at offsets of the other data file
+    os.remove(manifestfilename)
+    os.rename(compacted.datafilename, store.datafilename)
+    os.rename(manifestfilename + '.tmp', manifestfilename)
+    return negativestore.PatchStore(compacted.stems, compacted.offsets,
+                                    compacted.patchtable, store.datafilename)
+
+def batch_negatives(imagesfolder, annotationspath, outputfolder, nbworkers=1,
+                    manifestfilename=None, engine='python', mode='png',
+                    maxslack=conf.patchstoreslack):
+    """ Computes the negatives of all jpeg images in a folder, spreading images across
+        a pool of worker processes. Each processed image is recorded in a manifest
+        along with the modification times of its image and bounding boxes, so images
+        whose inputs did not change since the last run are skipped. Negatives written
+        in another mode by an earlier run are removed.
+    Args:
+        imagesfolder (str): folder containing the source jpeg images.
+        annotationspath (str): folder containing the <stem>_bb.json files, or
+            annotations.AnnotationStore file.
+        outputfolder (str): folder to write the negatives to.
+        nbworkers (int): number of worker processes, 1 to process in this one.
+        manifestfilename (str): manifest file, outputfolder/manifest.json by default.
+        engine (str): engine to use for negative_samples_boxes.
+        mode (str): 'png' to write each negative to its own png file, 'boxes' to only
+            write a negativestore.BoxIndex of the negative boxes, 'memmap' to pack all
+            negatives into a negativestore.PatchStore.
+        maxslack (float): fraction of the data file of the patch store left
+            unreferenced by images processed again, beyond which it is rewritten
+            without it.
+    Returns:
+        The number of images processed and skipped.
+    """
+    if not mode in outputmodes:
+        raise ValueError("Unknown mode " + repr(mode) + ", should be one of "
+                         + repr(outputmodes))
+    if manifestfilename == None:
+        manifestfilename = os.path.join(outputfolder, 'manifest.json')
+    manifest = load_manifest(manifestfilename)
+    annotationsource = annotations.open_annotations(annotationspath)
+    imagefilenames = [f for f in sorted(os.listdir(imagesfolder), key=str.lower) 
+                      if f.endswith('.jpg')]
+    # Only keep images whose image or bounding boxes changed since the manifest
+    # entry was written, or which were written in another mode
+    todo = []
     for imagefilename in imagefilenames:
-        print "processing " + imagefilename
-        # Load image and bounding boxes
-        image = cv2.imread(os.path.join(sys.argv[1], imagefilename))
         stem = os.path.splitext(imagefilename)[0]
-        bboxesfile = open(os.path.join(sys.argv[2], stem + '_bb.json'))
-        bboxes = json.load(bboxesfile)
-        bboxesfile.close()
-        # Compute the negatives, and write the negatives to the output files
-        negatives = negative_samples(image, bboxes)
-        i = 0
-        for negative in negatives:
-            # writing in png to avoid further loss in data (original images are jpeg
-            # for practicality)
-            cv2.imwrite(os.path.join(sys.argv[3], stem + '_neg_' + repr(i) + '.png'),
-                        negative)
-            i += 1
+        imagepath = os.path.join(imagesfolder, imagefilename)
+        bboxesmtime = annotationsource.mtime(stem)
+        if bboxesmtime == None:
+            raise ValueError("No bounding boxes for " + imagefilename)
+        entry = {
+            'stem': stem,
+            'image': imagepath,
+            'mode': mode,
+            'imagemtime': os.path.getmtime(imagepath),
+            'bboxesmtime': bboxesmtime
+            }
+        previous = manifest.get(stem)
+        if (previous != None 
+            and previous.get('mode', 'png') == mode
+            and previous['imagemtime'] == entry['imagemtime']
+            and previous['bboxesmtime'] == entry['bboxesmtime']):
+            continue
+        todo.append((entry, (imagepath, annotationsource.boxes(stem), outputfolder,
+                             engine, mode)))
+    annotationsource.close()
+    pool = None
+    results = None
+    if nbworkers > 1:
+        pool = mp.Pool(nbworkers, _initworker)
+        # imap streams results back in order as soon as they are available
+        results = pool.imap(image_negatives, [args for entry, args in todo])
+    else:
+        results = itertools.imap(image_negatives, [args for entry, args in todo])
+    manifestfile = open(manifestfilename, 'a')
+    patchwriter = None
+    if mode == 'memmap':
+        patchwriter = negativestore.PatchStoreWriter(
+            os.path.join(outputfolder, negativestore.patchdataname))
+    cachestats = dict([(name, 0) for name in imagecache.statnames])
+    try:
+        for (entry, args), result in itertools.izip(todo, results):
+            print "processed " + entry['stem']
+            cachestats = imagecache.add_stats(cachestats, result.pop('cachestats'))
+            instr.merge(result.pop('instrumentation'))
+            if mode == 'memmap':
+                # Patches of redone images are appended, the old ones are left
+                # unreferenced in the data file until it is compacted
+                crops = result.pop('crops')
+                with instr.timer('negatives/store',
+                                 sum([crop.nbytes for crop in crops])):
+                    result['patches'] = patchwriter.write(crops)
+            entry.update(result)
+            manifestfile.write(json.dumps(entry) + '\n')
+            manifestfile.flush()
+            manifest[entry['stem']] = entry
+    finally:
+        manifestfile.close()
+        if patchwriter != None:
+            patchwriter.close()
+        if pool != None:
+            pool.terminate()
+    print imagecache.report(cachestats)
+    # Write the index of all the images from the manifest
+    entries = [manifest[os.path.splitext(f)[0]] for f in imagefilenames]
+    if mode == 'boxes':
+        negativestore.save(negativestore.BoxIndex.fromentries(entries), outputfolder)
+    elif mode == 'memmap':
+        store = negativestore.PatchStore.fromentries(
+            entries, os.path.join(outputfolder, negativestore.patchdataname))
+        if store.unreferenced() > maxslack:
+            store = _compact(store, entries, manifestfilename)
+        negativestore.save(store, outputfolder)
+    _remove_other_outputs(outputfolder, mode)
+
+    return len(todo), len(imagefilenames) - len(todo)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates negative samples from images and bounding boxes.")
+    parser.add_argument('imagesfolder')
+    parser.add_argument('annotations', 
+                        help="folder of _bb.json files or annotations store file")
+    parser.add_argument('outputfolder')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument('--manifest', default=None,
+                        help="manifest file, outputfolder/manifest.json by default")
+    parser.add_argument('--engine', choices=engines, default='python')
+    parser.add_argument('--mode', choices=outputmodes, default='png',
+                        help="png files per negative, or a single box index or "
+                        + "memory-mapped patch store")
+    parser.add_argument('--max-slack', type=float, default=conf.patchstoreslack,
+                        help="fraction of the patch store left unreferenced by "
+                        + "images processed again beyond which it is rewritten")
+    args = parser.parse_args()
+    processed, skipped = batch_negatives(args.imagesfolder, args.annotations,
+                                         args.outputfolder, args.workers,
+                                         args.manifest, args.engine, args.mode,
+                                         args.max_slack)
+    print "processed " + repr(processed) + " images, skipped " + repr(skipped)
@@ -0,0 +1,252 @@
+""" Compact storage for negative samples, as an alternative to writing each negative
+patch to its own png file. Two formats are supported:
+
+- a box index, storing only the negative boxes of each source image in a single npz
+  file. Patches are cropped lazily from the source images when needed.
+- a patch store, packing all patches into one raw uint8 file which is memory-mapped
+  when reading, along with an npz offset table locating each patch in it.
+
+Both are keyed by the stem of the source images, and can be restricted to a subset
+of the stems, e.g. to build k-fold cross validation folds.
+"""
+import numpy as np
+import os.path
+import imagecache
+
+# File names of the indexes within a negatives folder.
+boxindexname = 'boxes.npz'
+patchindexname = 'patches.npz'
+patchdataname = 'patches.bin'
+
+def _relpath(path, folder):
+    """ Path relative to a folder, so indexes can be moved along with their data.
+    """
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(folder))
+
+def _offsets(counts):
+    """ Offsets of consecutive segments of the given lengths, with the total at the
+        end.
+    """
+    return np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+
+class BoxIndex:
+    """ Negative boxes of a set of source images.
+    """
+    def __init__(self, stems, imagefilenames, offsets, boxes):
+        """ Initializes the index from the stems of the source images, the full path to
+            each of them, and the (M,4) array of [ulx,uly,drx,dry] boxes of all images,
+            the boxes of the i-th stem being boxes[offsets[i]:offsets[i+1]].
+        """
+        self.stems = list(stems)
+        self.imagefilenames = list(imagefilenames)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.boxarray = np.asarray(boxes, dtype=np.int32).reshape([-1,4])
+        self.stemidx = dict([(stem, i) for i, stem in enumerate(self.stems)])
+
+    @staticmethod
+    def fromentries(entries):
+        """ Builds an index from a list of entries with stem, image and boxes fields,
+            the latter in the [[ulx,uly],[drx,dry]] format.
+        """
+        boxes = [np.array(entry['boxes'], dtype=np.int32).reshape([-1,4])
+                 for entry in entries]
+        return BoxIndex([entry['stem'] for entry in entries],
+                        [entry['image'] for entry in entries],
+                        _offsets([b.shape[0] for b in boxes]),
+                        np.concatenate(boxes) if boxes != [] else [])
+
+    @staticmethod
+    def load(filename):
+        """ Loads an index written by save.
+        """
+        folder = os.path.dirname(filename)
+        data = np.load(filename)
+        return BoxIndex(data['stems'].tolist(),
+                        [os.path.normpath(os.path.join(folder, f))
+                         for f in data['imagefilenames'].tolist()],
+                        data['offsets'], data['boxes'])
+
+    def save(self, filename):
+        """ Saves the index to a npz file, with image paths relative to it.
+        """
+        folder = os.path.dirname(filename)
+        np.savez(filename,
+                 stems=np.array(self.stems, dtype=np.str_),
+                 imagefilenames=np.array([_relpath(f, folder)
+                                          for f in self.imagefilenames],
+                                         dtype=np.str_),
+                 offsets=self.offsets,
+                 boxes=self.boxarray)
+
+    def __len__(self):
+        return len(self.stems)
+
+    def boxes(self, stem):
+        """ Negative boxes of a source image, as [[ulx,uly],[drx,dry]].
+        """
+        i = self.stemidx[stem]
+        return [[[ulx,uly],[drx,dry]] for [ulx,uly,drx,dry]
+                in self.boxarray[self.offsets[i]:self.offsets[i+1]].tolist()]
+
+    def crops(self, stem, image=None):
+        """ Negative patches of a source image, cropped from it. The image is loaded
+            from disk unless it is given.
+        """
+        if image is None:
+            image = imagecache.imread(self.imagefilenames[self.stemidx[stem]])
+        return [image[uly:dry,ulx:drx,:] for [[ulx,uly],[drx,dry]]
+                in self.boxes(stem)]
+
+    def subset(self, stems):
+        """ Index restricted to the given stems, ignoring the ones it does not contain.
+        """
+        idxs = [self.stemidx[stem] for stem in stems if stem in self.stemidx]
+        boxes = [self.boxarray[self.offsets[i]:self.offsets[i+1]] for i in idxs]
+        return BoxIndex([self.stems[i] for i in idxs],
+                        [self.imagefilenames[i] for i in idxs],
+                        _offsets([b.shape[0] for b in boxes]),
+                        np.concatenate(boxes) if boxes != [] else [])
+
+class PatchStoreWriter:
+    """ Appends patches to the raw data file of a patch store.
+    """
+    def __init__(self, datafilename):
+        self.datafile = open(datafilename, 'ab')
+        self.datafile.seek(0, os.SEEK_END)
+
+    def write(self, patches):
+        """ Appends patches to the data file.
+        Returns:
+            A list of [offset, rows, cols, channels] entries locating them.
+        """
+        entries = []
+        for patch in patches:
+            patch = np.ascontiguousarray(patch, dtype=np.uint8)
+            if patch.ndim == 2:
+                patch = patch[:,:,np.newaxis]
+            rows, cols, channels = patch.shape
+            entries.append([self.datafile.tell(), rows, cols, channels])
+            self.datafile.write(patch.tostring())
+        self.datafile.flush()
+        return entries
+
+    def close(self):
+        self.datafile.close()
+
+class PatchStore:
+    """ Negative patches of a set of source images packed into a single memory-mapped
+        file. Patches are returned as read-only views into it, without copying.
+    """
+    def __init__(self, stems, offsets, patches, datafilename):
+        """ Initializes the store from the stems of the source images, the (P,4) array of
+            [offset, rows, cols, channels] of all patches in the data file, the patches
+            of the i-th stem being patches[offsets[i]:offsets[i+1]].
+        """
+        self.stems = list(stems)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.patchtable = np.asarray(patches, dtype=np.int64).reshape([-1,4])
+        self.datafilename = datafilename
+        self.stemidx = dict([(stem, i) for i, stem in enumerate(self.stems)])
+        self.data = None
+        if os.path.getsize(datafilename) > 0:
+            self.data = np.memmap(datafilename, dtype=np.uint8, mode='r')
+
+    @staticmethod
+    def fromentries(entries, datafilename):
+        """ Builds a store from a list of entries with stem and patches fields, the
+            latter as returned by PatchStoreWriter.write.
+        """
+        patches = [np.array(entry['patches'], dtype=np.int64).reshape([-1,4])
+                   for entry in entries]
+        return PatchStore([entry['stem'] for entry in entries],
+                          _offsets([p.shape[0] for p in patches]),
+                          np.concatenate(patches) if patches != [] else [],
+                          datafilename)
+
+    @staticmethod
+    def load(filename):
+        """ Loads an offset table written by save, and maps its data file.
+        """
+        data = np.load(filename)
+        datafilename = os.path.join(os.path.dirname(filename),
+                                    str(data['datafilename']))
+        return PatchStore(data['stems'].tolist(), data['offsets'], data['patches'],
+                          os.path.normpath(datafilename))
+
+    def save(self, filename):
+        """ Saves the offset table to a npz file, with the path to the data file
+            relative to it.
+        """
+        np.savez(filename,
+                 stems=np.array(self.stems, dtype=np.str_),
+                 offsets=self.offsets,
+                 patches=self.patchtable,
+                 datafilename=np.array(_relpath(self.datafilename,
+                                                os.path.dirname(filename))))
+
+    def __len__(self):
+        return len(self.stems)
+
+    def crops(self, stem):
+        """ Negative patches of a source image, as views into the data file.
+        """
+        i = self.stemidx[stem]
+        return [self.data[offset:offset+rows*cols*channels].reshape(
+                    [rows, cols, channels])
+                for [offset, rows, cols, channels]
+                in self.patchtable[self.offsets[i]:self.offsets[i+1]].tolist()]
+
+    def unreferenced(self):
+        """ Fraction of the data file not referenced by the patches of the store, e.g.
+            patches of images processed again since.
+        """
+        size = os.path.getsize(self.datafilename)
+        if size == 0:
+            return 0.
+        referenced = np.sum(np.prod(self.patchtable[:,1:4], axis=1))
+        return 1. - float(referenced) / size
+
+    def compact(self, datafilename):
+        """ Copies the patches of the store to a new data file, leaving out the data
+            they do not reference.
+        Returns:
+            The store of the copied patches.
+        """
+        if os.path.isfile(datafilename):
+            os.remove(datafilename)
+        writer = PatchStoreWriter(datafilename)
+        try:
+            entries = [{'stem': stem, 'patches': writer.write(self.crops(stem))}
+                       for stem in self.stems]
+        finally:
+            writer.close()
+        return PatchStore.fromentries(entries, datafilename)
+
+    def subset(self, stems):
+        """ Store restricted to the given stems, sharing the same data file.
+        """
+        idxs = [self.stemidx[stem] for stem in stems if stem in self.stemidx]
+        patches = [self.patchtable[self.offsets[i]:self.offsets[i+1]] for i in idxs]
+        return PatchStore([self.stems[i] for i in idxs],
+                          _offsets([p.shape[0] for p in patches]),
+                          np.concatenate(patches) if patches != [] else [],
+                          self.datafilename)
+
+def load(folder):
+    """ Loads the negatives index of a folder, if there is one.
+    Returns:
+        A BoxIndex or PatchStore, or None if the folder contains neither.
+    """
+    if os.path.isfile(os.path.join(folder, patchindexname)):
+        return PatchStore.load(os.path.join(folder, patchindexname))
+    if os.path.isfile(os.path.join(folder, boxindexname)):
+        return BoxIndex.load(os.path.join(folder, boxindexname))
+    return None
+
+def save(index, folder):
+    """ Saves a BoxIndex or PatchStore to a folder, under the name load expects.
+    """
+    if isinstance(index, PatchStore):
+        index.save(os.path.join(folder, patchindexname))
+    else:
+        index.save(os.path.join(folder, boxindexname))
@@ -0,0 +1,77 @@
+""" Benchmark of the evaluation of detections of evaluation.py on synthetic datasets,
+    up to 100k detections, against detection by detection matching as in the VOC
+    devkit.
+"""
+import sys
+import os.path
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import evaluation
+import geometry
+
+def synthetic_dataset(rng, nbimages, nbdetections, rows=600, cols=800):
+    """ Generates images of 1 to 3 characters, each with ground truth boxes and
+        nbdetections detections in total, a fraction of them around the boxes.
+    """
+    characters = ['character_' + repr(c) for c in range(0, 20)]
+    groundtruth = {}
+    detections = {}
+    perimage = nbdetections // nbimages
+    for i in range(0, nbimages):
+        stem = characters[i % len(characters)].replace('_', '') + '_' + repr(i)
+        nbboxes = rng.randint(1, 4)
+        ul = np.stack([rng.randint(0, cols - 200, nbboxes),
+                       rng.randint(0, rows - 200, nbboxes)], axis=1)
+        boxes = np.concatenate([ul, ul + rng.randint(40, 200, [nbboxes, 2])], axis=1)
+        groundtruth[stem] = geometry.fromarray(boxes)
+        dets = np.concatenate([ul, ul + rng.randint(10, 200, [nbboxes, 2])],
+                              axis=1)[rng.randint(0, nbboxes, perimage)]
+        dets += rng.randint(-20, 20, dets.shape)
+        detections[stem] = zip(geometry.fromarray(dets), rng.randn(perimage).tolist())
+    return detections, groundtruth
+
+def loop_evaluate(detections, groundtruth, minoverlap=0.5):
+    """ Detection by detection matching in decreasing order of score.
+    """
+    flat = sorted([(score, stem, bbox) for stem, ds in detections.items()
+                   for bbox, score in ds], reverse=True)
+    matched = dict([(stem, [False] * len(bs)) for stem, bs in groundtruth.items()])
+    truepositives = []
+    for score, stem, bbox in flat:
+        ious = geometry.pairwise_iou(geometry.toarray([bbox]),
+                                     geometry.toarray(groundtruth[stem]))[0]
+        j = np.argmax(ious)
+        tp = ious[j] >= minoverlap and not matched[stem][j]
+        if tp:
+            matched[stem][j] = True
+        truepositives.append(tp)
+    precision, recall = evaluation.precision_recall(
+        [score for score, stem, bbox in flat], truepositives,
+        sum([len(bs) for bs in groundtruth.values()]))
+    return evaluation.average_precision(precision, recall)
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.RandomState(0)
+    print "%10s %8s %8s %10s %12s %14s %10s" % (
+        'detections', 'images', 'AP', 'loop (s)', 'evaluate (s)', 'per char (s)',
+        'match (s)')
+    for nbdetections, nbimages in [(1000, 100), (10000, 1000), (100000, 5000)]:
+        detections, groundtruth = synthetic_dataset(rng, nbimages, nbdetections)
+        t = lambda f: min(timeit.repeat(f, number=1, repeat=repeat))
+        ap = evaluation.evaluate(detections, groundtruth)['ap']
+        tloop = float('nan')
+        if nbdetections <= 10000:
+            assert abs(loop_evaluate(detections, groundtruth) - ap) < 1e-9
+            tloop = t(lambda: loop_evaluate(detections, groundtruth))
+        tevaluate = t(lambda: evaluation.evaluate(detections, groundtruth))
+        tcharacters = t(lambda: evaluation.evaluate_characters(detections,
+                                                               groundtruth))
+        # Matching alone, on already flattened arrays
+        s = evaluation.EvaluationSet(detections, groundtruth)
+        tmatch = t(lambda: evaluation.match(s.detimages, s.detboxes, s.scores,
+                                            s.gtimages, s.gtboxes))
+        print "%10d %8d %8.4f %10.4f %12.4f %14.4f %10.4f" % (
+            nbdetections, nbimages, ap, tloop, tevaluate, tcharacters, tmatch)
@@ -0,0 +1,64 @@
+""" Benchmark of the non-maximum suppression of geometry.py on synthetic detections,
+    up to 10k candidates per image, against box by box greedy suppression.
+"""
+import sys
+import os.path
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import geometry
+
+def synthetic_detections(rng, n, rows=1200, cols=1600, nbobjects=20):
+    """ Generates n candidate boxes clustered around random objects, as detectors
+        return them, with random scores. Most of them are suppressed.
+    """
+    centers = rng.randint(0, min(rows, cols), [nbobjects, 2])
+    sizes = rng.randint(40, 300, [nbobjects, 2])
+    objects = rng.randint(0, nbobjects, n)
+    ul = centers[objects] + rng.randint(-30, 30, [n, 2])
+    dr = ul + sizes[objects] + rng.randint(-20, 20, [n, 2])
+    return np.concatenate([ul, dr], axis=1), rng.randn(n)
+
+def spread_detections(rng, n, rows=1200, cols=1600):
+    """ Generates n small boxes spread uniformly over the image, most of which are
+        kept.
+    """
+    ul = np.stack([rng.randint(0, cols, n), rng.randint(0, rows, n)], axis=1)
+    return np.concatenate([ul, ul + rng.randint(5, 40, [n, 2])], axis=1), rng.randn(n)
+
+def loop_nms(boxes, scores, overlap):
+    """ Greedy suppression comparing each box with the remaining ones at a time.
+    """
+    order = np.argsort(-scores, kind='mergesort')
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        iou = geometry.pairwise_iou(boxes[[i]], boxes[order[1:]])[0]
+        order = order[1:][iou <= overlap]
+    return keep
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.RandomState(0)
+    print "%8s %8s %8s %10s %10s %10s %12s %12s" % (
+        'boxes', 'layout', 'kept', 'loop (s)', 'nms (s)', 'soft (s)', 'batch x8 (s)',
+        'iou (s)')
+    for n in [100, 1000, 3000, 10000]:
+        for layout, generator in [('cluster', synthetic_detections),
+                                  ('spread', spread_detections)]:
+            boxes, scores = generator(rng, n)
+            keep = geometry.nms(boxes, scores, 0.3)
+            assert keep.tolist() == loop_nms(boxes, scores, 0.3)
+            t = lambda f: min(timeit.repeat(f, number=1, repeat=repeat))
+            tloop = t(lambda: loop_nms(boxes, scores, 0.3))
+            tnms = t(lambda: geometry.nms(boxes, scores, 0.3))
+            tsoft = t(lambda: geometry.soft_nms(boxes, scores - scores.min() + 1e-3,
+                                                method='gaussian'))
+            # 8 images of n/8 candidates each, suppressed in one call
+            groups = np.arange(n) % 8
+            tbatch = t(lambda: geometry.nms(boxes, scores, 0.3, groups))
+            tiou = t(lambda: geometry.pairwise_iou(boxes[0:1000], boxes))
+            print "%8d %8s %8d %10.4f %10.4f %10.4f %12.4f %12.4f" % (
+                n, layout, keep.size, tloop, tnms, tsoft, tbatch, tiou)
@@ -0,0 +1,23 @@
+""" Benchmark of the feature pyramid build time of featpyramid.py against image size.
+"""
+import sys
+import os.path
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import featpyramid as fp
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.RandomState(0)
+    builder = fp.PyramidBuilder(cachesize=0)
+    print "%12s %8s %10s %12s" % ('size', 'levels', 'time (s)', 'Mpixels/s')
+
+    for rows, cols in [(120, 160), (240, 320), (480, 640), (768, 1024), 
+                       (1200, 1600), (2000, 3000)]:
+        image = rng.randint(0, 256, [rows, cols, 3]).astype(np.uint8)
+        nblevels = len(builder.build(image))
+        t = min(timeit.repeat(lambda: builder.build(image), number=1, repeat=repeat))
+        print "%12s %8d %10.4f %12.3f" % (repr(rows) + 'x' + repr(cols), nblevels, t,
+                                          rows * cols / t / 1e6)
@@ -0,0 +1,58 @@
+""" Benchmark of the identification of detections of dpmidentification.py against the
+    number of characters, scoring all the models over one pyramid per image, against
+    identifying with each model on its own as one detector per character would.
+"""
+import sys
+import os.path
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import benchmarks
+import dpmidentification as dpmi
+import dpmscoring as dpms
+
+def synthetic_model(rng):
+    """ Model shaped as those voc-dpm trains: two mirrored components, each with an
+        8x6 root and 8 parts of 6x6 cells.
+    """
+    components = []
+    for c in range(0, 2):
+        parts = [dpms.Part(rng.randn(6, 6, 31) * 0.1,
+                           (rng.randint(0, 7), rng.randint(0, 11)),
+                           [0.1, 0, 0.1, 0]) for p in range(0, 8)]
+        components.append(dpms.Component(rng.randn(8, 6, 31) * 0.1, parts,
+                                         rng.randn()))
+    return dpms.DPMModel(components)
+
+def separately(models, image, bboxes):
+    """ Identification with each model on its own, building its pyramid every time.
+    """
+    return np.concatenate([dpmi.identify(index, index.pyramidbuilder().build(image),
+                                         bboxes)
+                           for index in [dpmi.ModelIndex([m], ['c']) for m in models]],
+                          axis=1)
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.RandomState(0)
+    image = benchmarks.synthetic_image(rng, 480, 640)
+    bboxes = [[[40, 60], [199, 299]], [[300, 100], [419, 259]],
+              [[420, 200], [619, 459]]]
+    allmodels = [synthetic_model(rng) for c in range(0, 20)]
+    print "%10s %12s %12s %10s %14s" % ('characters', 'index (s)', 'separate (s)',
+                                        'speedup', 'vs 1 character')
+    tone = None
+    for nbcharacters in [1, 2, 5, 10, 20]:
+        models = allmodels[0:nbcharacters]
+        index = dpmi.ModelIndex(models, range(0, nbcharacters))
+        builder = index.pyramidbuilder()
+        identify = lambda: dpmi.identify(index, builder.build(image), bboxes)
+        assert np.allclose(identify(), separately(models, image, bboxes))
+        t = lambda f: min(timeit.repeat(f, number=1, repeat=repeat))
+        tindex = t(identify)
+        tseparate = t(lambda: separately(models, image, bboxes))
+        if tone == None:
+            tone = tindex
+        print "%10d %12.4f %12.4f %10.2f %14.2f" % (
+            nbcharacters, tindex, tseparate, tseparate / tindex, tindex / tone)
@@ -0,0 +1,31 @@
+""" Benchmark of the engines of negatives.negative_samples_boxes on synthetic images
+    with a growing number of random bounding boxes.
+"""
+import sys
+import os.path
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import negatives as neg
+from benchmarks import synthetic_boxes
+
+if __name__ == "__main__":
+    rows, cols = 1200, 1600
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.RandomState(0)
+    image = np.zeros([rows, cols, 3], dtype=np.uint8)
+    print "%8s %8s %12s %12s %8s" % ('boxes', 'negs', 'python (s)', 'numpy (s)', 
+                                     'speedup')
+
+    for nbboxes in [1, 2, 5, 10, 20, 50, 100, 200, 500]:
+        bboxes = synthetic_boxes(rng, rows, cols, nbboxes)
+        times = {}
+        for engine in neg.engines:
+            times[engine] = min(timeit.repeat(
+                lambda: neg.negative_samples_boxes(image, bboxes, engine=engine),
+                number=1, repeat=repeat))
+        nbnegs = len(neg.negative_samples_boxes(image, bboxes))
+        print "%8d %8d %12.5f %12.5f %8.2f" % (nbboxes, nbnegs, times['python'], 
+                                               times['numpy'],
+                                               times['python'] / times['numpy'])
@@ -0,0 +1,48 @@
+""" Learns cascade thresholds for a model from the positives of some folds written by
+makefolds.py, then reports the speedup and recall loss of cascade detection against
+exhaustive detection on the positives of other folds.
+"""
+import sys
+import os.path
+import argparse
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dpmscoring as dpms
+import cascade
+import annotations
+import instrumentation as instr
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model', help="model exported by dpmscoring.savemodel")
+    parser.add_argument('foldsfolder',
+                        help="fold manifest or output folder of makefolds.py")
+    parser.add_argument('annotations', help="bounding boxes folder or store")
+    parser.add_argument('output', help="json file to write the cascade to")
+    parser.add_argument('--calibrate', type=int, nargs='+', default=[0],
+                        help="folds to learn thresholds from")
+    parser.add_argument('--evaluate', type=int, nargs='*', default=[1],
+                        help="folds to compare detection on")
+    parser.add_argument('--thresh', type=float, default=-0.5)
+    parser.add_argument('--recall', type=float, default=1.0,
+                        help="fraction of positives each stage keeps")
+    parser.add_argument('--radius', type=int, default=4)
+    parser.add_argument('--max-num', type=int, default=10)
+    args = parser.parse_args()
+    model = dpms.loadmodel(args.model)
+    annotationsource = annotations.open_annotations(args.annotations)
+    with instr.timer('cascade/calibrate'):
+        c = cascade.calibrate(
+            model, cascade.fold_positives(args.foldsfolder, args.calibrate,
+                                          annotationsource),
+            args.thresh, args.recall, radius=args.radius)
+    cascade.savecascade(c, args.output)
+    if args.evaluate != []:
+        with instr.timer('cascade/compare'):
+            report = cascade.compare(
+                model, c, cascade.fold_positives(args.foldsfolder, args.evaluate,
+                                                 annotationsource),
+                args.thresh, args.max_num)
+        print json.dumps(report, indent=4, sort_keys=True)
+    annotationsource.close()
@@ -0,0 +1,81 @@
+""" Runs k-fold cross validation over folds written by makefolds.py, one worker process
+per fold, and reports the average precision, times and peak memory of each fold.
+By default, the given models are evaluated as they are with the native detector,
+sharing feature pyramids between folds through a folder. With --mine, each fold
+trains its model with hard negative mining on the negatives of the other folds,
+through its own MATLAB session.
+"""
+import sys
+import os.path
+import argparse
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import acdconf as conf
+import crossvalidation as cv
+import dpmDetection as dpmd
+import folds
+import annotations
+import instrumentation as instr
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('folds', help="fold manifest or output folder of makefolds.py")
+    parser.add_argument('annotations', help="bounding boxes folder or store")
+    parser.add_argument('models', nargs='+',
+                        help="model to start every fold from, or one per fold")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="number of folds run at once, all CPUs by default")
+    parser.add_argument('--features', default=conf.featurecachefolder,
+                        help="folder of the feature pyramids shared by the folds")
+    parser.add_argument('--no-precompute', action='store_true',
+                        help="compute pyramids while running folds instead")
+    parser.add_argument('--thresh', type=float, default=-1.0)
+    parser.add_argument('--max-num', type=int, default=10)
+    parser.add_argument('--minoverlap', type=float, default=0.5)
+    parser.add_argument('--mine', metavar='OUTPUT', default=None,
+                        help="train with hard negative mining through MATLAB, "
+                        + "writing the hard negatives of each fold to OUTPUT")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--cache-size', type=int, default=2000)
+    parser.add_argument('--budget', type=int, default=1000)
+    parser.add_argument('--C', type=float, default=0.001)
+    parser.add_argument('--tag', default='cv')
+    parser.add_argument('--output', default=None, help="json file for the report")
+    args = parser.parse_args()
+    manifest = folds.open_folds(args.folds)
+    models = args.models[0] if len(args.models) == 1 else args.models
+    if isinstance(models, list) and len(models) != len(manifest):
+        parser.error("expected 1 or " + repr(len(manifest)) + " models")
+    annotationsource = annotations.open_annotations(args.annotations)
+    backendfactory = None
+    trainer = None
+    if args.mine != None:
+        # Same parameters as the last training step of voc-dpm's pascal_train
+        backendfactory = dpmd.MatlabBackend
+        trainer = cv.MiningTrainer(args.mine, args.rounds, args.cache_size,
+                                   args.budget, 0, 1, 10, 24000, 0.7, 0, False,
+                                   args.tag, args.C)
+    validation = cv.CrossValidation(manifest, annotationsource, models,
+                                    backendfactory, trainer, args.features,
+                                    thresh=args.thresh, max_num=args.max_num,
+                                    minoverlap=args.minoverlap)
+    annotationsource.close()
+    if args.mine == None and not args.no_precompute:
+        with instr.timer('crossvalidation/precompute'):
+            nbimages = validation.precompute(args.processes)
+        print "precomputed " + repr(nbimages) + " images"
+    with instr.timer('crossvalidation/run'):
+        report = validation.run(nbprocesses=args.processes)
+    for result in report['folds']:
+        line = ("fold " + repr(result['fold']) + ": AP " + "%.4f" % result['ap']
+                + ", " + "%.1f" % result['walltime'] + "s")
+        if result['peakmemory'] != None:
+            line += ", peak memory " + repr(result['peakmemory'] / 1024**2) + "MB"
+        print line
+    print ("mean AP " + "%.4f" % report['meanap'] + ", " + "%.1f" % report['walltime']
+           + "s in total, peak memory " + repr(report['peakmemory'] / 1024**2) + "MB")
+    if args.output != None:
+        outputfile = open(args.output, 'w')
+        json.dump(report, outputfile, indent=4, sort_keys=True)
+        outputfile.close()
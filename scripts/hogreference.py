@@ -0,0 +1,128 @@
+""" Generates the reference HOG features test_featpyramid.py checks featpyramid.py
+    against, with a literal, loop by loop transcription of voc-dpm's features.cc.
+    Slow, only meant to be run on the small test images.
+"""
+import sys
+import os
+import os.path
+import math
+import numpy as np
+
+uu = [1.0000, 0.9397, 0.7660, 0.500, 0.1736, -0.1736, -0.5000, -0.7660, -0.9397]
+vv = [0.0000, 0.3420, 0.6428, 0.8660, 0.9848, 0.9848, 0.8660, 0.6428, 0.3420]
+eps = 0.0001
+
+def reference_features(image, sbin):
+    """ features.cc on a BGR uint8 image, without the truncation feature.
+    """
+    im = image[:,:,::-1].astype(np.float64)
+    dims = im.shape
+    blocks = [int(round(float(dims[0]) / sbin)), int(round(float(dims[1]) / sbin))]
+    hist = np.zeros([18, blocks[0], blocks[1]])
+    norm = np.zeros([blocks[0], blocks[1]])
+    out = [max(blocks[0]-2, 0), max(blocks[1]-2, 0), 31]
+    feat = np.zeros(out)
+    visible = [blocks[0]*sbin, blocks[1]*sbin]
+
+    for x in range(1, visible[1]-1):
+        for y in range(1, visible[0]-1):
+            sx = min(x, dims[1]-2)
+            sy = min(y, dims[0]-2)
+            # channel with the largest gradient
+            dy = im[sy+1,sx,0] - im[sy-1,sx,0]
+            dx = im[sy,sx+1,0] - im[sy,sx-1,0]
+            v = dx*dx + dy*dy
+            for c in [1, 2]:
+                dyc = im[sy+1,sx,c] - im[sy-1,sx,c]
+                dxc = im[sy,sx+1,c] - im[sy,sx-1,c]
+                vc = dxc*dxc + dyc*dyc
+                if vc > v:
+                    v = vc
+                    dx = dxc
+                    dy = dyc
+            # snap to one of 18 orientations
+            best_dot = 0
+            best_o = 0
+            for o in range(0, 9):
+                dot = uu[o]*dx + vv[o]*dy
+                if dot > best_dot:
+                    best_dot = dot
+                    best_o = o
+                elif -dot > best_dot:
+                    best_dot = -dot
+                    best_o = o+9
+            # add to 4 histograms around pixel using bilinear interpolation
+            xp = (x+0.5)/sbin - 0.5
+            yp = (y+0.5)/sbin - 0.5
+            ixp = int(math.floor(xp))
+            iyp = int(math.floor(yp))
+            vx0 = xp-ixp
+            vy0 = yp-iyp
+            vx1 = 1.0-vx0
+            vy1 = 1.0-vy0
+            v = math.sqrt(v)
+            if ixp >= 0 and iyp >= 0:
+                hist[best_o,iyp,ixp] += vx1*vy1*v
+            if ixp+1 < blocks[1] and iyp >= 0:
+                hist[best_o,iyp,ixp+1] += vx0*vy1*v
+            if ixp >= 0 and iyp+1 < blocks[0]:
+                hist[best_o,iyp+1,ixp] += vx1*vy0*v
+            if ixp+1 < blocks[1] and iyp+1 < blocks[0]:
+                hist[best_o,iyp+1,ixp+1] += vx0*vy0*v
+    # compute energy in each block by summing over orientations
+    for o in range(0, 9):
+        norm += (hist[o] + hist[o+9]) ** 2
+    # compute features
+    for x in range(0, out[1]):
+        for y in range(0, out[0]):
+            def blocknorm(by, bx):
+                return 1.0 / math.sqrt(norm[by,bx] + norm[by+1,bx] + norm[by,bx+1]
+                                       + norm[by+1,bx+1] + eps)
+            n1 = blocknorm(y+1, x+1)
+            n2 = blocknorm(y, x+1)
+            n3 = blocknorm(y+1, x)
+            n4 = blocknorm(y, x)
+            t = [0, 0, 0, 0]
+            # contrast-sensitive features
+            for o in range(0, 18):
+                src = hist[o,y+1,x+1]
+                h = [min(src*n, 0.2) for n in [n1, n2, n3, n4]]
+                feat[y,x,o] = 0.5 * sum(h)
+                t = [tk + hk for tk, hk in zip(t, h)]
+            # contrast-insensitive features
+            for o in range(0, 9):
+                src = hist[o,y+1,x+1] + hist[o+9,y+1,x+1]
+                h = [min(src*n, 0.2) for n in [n1, n2, n3, n4]]
+                feat[y,x,18+o] = 0.5 * sum(h)
+            # texture features
+            for k in range(0, 4):
+                feat[y,x,27+k] = 0.2357 * t[k]
+    return feat
+
+def test_images():
+    """ Small synthetic test images: noise, and a smooth pattern with ties between
+        channels and flat areas.
+    """
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, 256, [45, 61, 3]).astype(np.uint8)
+    ys, xs = np.mgrid[0:50, 0:37]
+    pattern = np.zeros([50, 37, 3], dtype=np.uint8)
+    pattern[:,:,0] = (xs * 5) % 256
+    pattern[:,:,1] = (xs * 5) % 256
+    pattern[:,:,2] = np.where((xs - 18) ** 2 + (ys - 25) ** 2 < 150, 200, 0)
+    return [noise, pattern]
+
+# Cell sizes the reference features are computed for.
+sbins = [4, 8]
+
+if __name__ == "__main__":
+    outfilename = (sys.argv[1] if len(sys.argv) > 1 else
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                'testdata', 'hog_reference.npz'))
+    arrays = {}
+    for i, image in enumerate(test_images()):
+        arrays['image_' + repr(i)] = image
+        for sbin in sbins:
+            arrays['feat_' + repr(i) + '_' + repr(sbin)] = reference_features(image,
+                                                                              sbin)
+    np.savez_compressed(outfilename, **arrays)
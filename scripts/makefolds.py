@@ -2,68 +2,45 @@
     Actually splits the positive samples, then takes generated negative samples 
     from the chosen positive ones ONLY. This is important, as negatives from other
     folds may end up in the test data at some point.
+    The folds are written as a manifest, folds.json in the output folder, which
+    training and evaluation code reads the positives and negatives of each fold from,
+    see folds.py. With --symlinks, each fold also gets a folder of symlinks to its
+    positives, and to its negatives or the subset of the negatives index for them.
+    If an annotations folder or store is given, only annotated positives are split.
 """
 import sys
 import os
 import os.path
-import numpy as np
-import math
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import folds
+import annotations
+import instrumentation as instr
 
 if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        raise ValueError("""
-Please give a number of folds, input positive and negative folders, 
-and an output folder.""");
-    k = int(sys.argv[1]) # yeah I know I know
-    if k < 2:
-        raise ValueError("The number of folds must be at least 2.")
-    posfolder = sys.argv[2]
-    negfolder = sys.argv[3]
-    outfolder = sys.argv[4]
-    # Create the output subfolders if they don't already exist
-    for i in range(0,k):
-        try:
-            # Create one folder for positives and negatives separately
-            os.makedirs(os.path.join(outfolder, repr(i), 'positives'))
-            os.makedirs(os.path.join(outfolder, repr(i), 'negatives'))
-        except OSError:
-            # makedirs throws an OSError when the folder already exists
-            pass
-    # Compute a random permutation of all the image files in the positive folder
-    imagenames = [f for f in os.listdir(posfolder) 
-                  if f.endswith(('.jpg','.png', '.gif'))]
-    perm = np.random.permutation(len(imagenames))
-    permutednames = [imagenames[i] for i in perm]
-    # Compute the size of each slice.
-    minfoldsize = int(math.floor(len(imagenames) / k))
-    remainder = len(imagenames) - k * minfoldsize
-    foldsizes = [minfoldsize] * k
-    # Just add 1 to the remainder first folds.
-    for i in range(0,remainder):
-        foldsizes[i] = foldsizes[i] + 1
-    # Fill up the folds.
-    foldidx = 0
-    idx = 0
-    for foldsize in foldsizes:
-        # For each image in the fold, create a symlink in the folder to avoid
-        # copying data.
-        posoutfolder = os.path.join(outfolder, repr(foldidx), 'positives')
-        negoutfolder = os.path.join(outfolder, repr(foldidx), 'negatives')
-        for imgname in permutednames[idx:idx+foldsize]:
-            # Carefully make the symlink with a relative path, so it plays well with git
-            posinpath = os.path.relpath(os.path.join(posfolder, imgname), posoutfolder)
-            possymlinkpath = os.path.join(posoutfolder, imgname)
-            if not os.path.isfile(possymlinkpath):
-                os.symlink(posinpath, possymlinkpath)
-            # Now similarly make symlinks to negative samples
-            posstem = os.path.splitext(imgname)[0]
-            negativefiles = [f for f in os.listdir(negfolder)
-                             if f.startswith(posstem + '_')]
-            for negativefile in negativefiles:
-                negimpath = os.path.relpath(os.path.join(negfolder, negativefile),
-                                            negoutfolder)
-                negsymlinkpath = os.path.join(negoutfolder, negativefile)
-                if not os.path.isfile(negsymlinkpath):
-                    os.symlink(negimpath, negsymlinkpath)
-        idx = idx + foldsize
-        foldidx = foldidx + 1
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('k', type=int, help="number of folds")
+    parser.add_argument('positives', help="folder of positive images")
+    parser.add_argument('negatives', help="folder of negatives from negatives.py")
+    parser.add_argument('output', help="folder to write the folds to")
+    parser.add_argument('annotations', nargs='?', default=None,
+                        help="bounding boxes folder or annotations store")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="seed of the random split, random by default")
+    parser.add_argument('--symlinks', action='store_true',
+                        help="also write a folder of symlinks per fold")
+    args = parser.parse_args()
+    annotationsource = None
+    if args.annotations != None:
+        annotationsource = annotations.open_annotations(args.annotations)
+    with instr.timer('folds/build'):
+        manifest = folds.FoldManifest.build(args.k, args.positives, args.negatives,
+                                            annotationsource, args.seed)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    with instr.timer('folds/save'):
+        manifest.save(os.path.join(args.output, folds.manifestname))
+    if args.symlinks:
+        with instr.timer('folds/symlinks'):
+            folds.export_symlinks(manifest, args.output)
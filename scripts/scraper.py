@@ -1,12 +1,42 @@
 """ Scraper of images for deviantArt's RSS feed.
+
+fanartScraper downloads and reviews images one at a time. scrapeQueries does the
+same for many search queries at once through a single pooled HTTP session:
+- feeds and images are downloaded by a bounded pool of threads, the next candidates
+  being prefetched while the current one is reviewed, across queries.
+- images are decoded straight from the downloaded bytes, and only written to disk
+  once accepted.
+- each decision is appended to a journal per query in the output folder, so
+  scraping can be interrupted and resumed without reviewing images again.
+- images near duplicate of one already in the output folder, according to a
+  duplicates.HashIndex of it, are skipped without being reviewed.
 """
 import cv2
+import numpy as np
 import feedparser as fp
 import re
 import urllib
 import requests
 import json
+import os
 import os.path
+import argparse
+import collections
+import sys
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import acdconf as conf
+import duplicates
+import instrumentation as instr
+
+rssBaseUrl = 'http://backend.deviantart.com/rss.xml'
+typeToExt = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/svg+xml': 'svg'
+    }
 
 def fanartScraper(searchString, nbImages, sortBy, outputFolder):
     """ Scrapes fanart images out of deviantArt, writing them to a specific folder.
@@ -22,17 +52,14 @@ def fanartScraper(searchString, nbImages, sortBy, outputFolder):
             feed.
         RuntimeError: when the rss feed provides unexpected data.
     """
-    rssUrl = ('http://backend.deviantart.com/rss.xml?type=deviation&q='
-              + urllib.quote_plus('boost:' + sortBy + ' ' + searchString + ' in:fanart/manga'))
-    feed = fp.parse(rssUrl)
+    feed = fp.parse(feedUrl(searchString, sortBy))
     
     # Then scrape each entry individually into image and json files.
     if len(feed.entries) < nbImages:
         raise ValueError("Cannot scrape " + nbImages 
                          + " because the feed only contains " + len(feed.entries))
     # Set the base filename for both json and image files
-    baseFilename = reduce(lambda word, rest: word + '_' + rest,
-                          re.sub("[^\w]", " ", searchString).split())
+    baseFilename = queryBaseFilename(searchString)
     currentImageIdx = 0
     currentEntryIdx = 0
 
@@ -52,12 +79,6 @@ def fanartScraper(searchString, nbImages, sortBy, outputFolder):
         resp = requests.get(currentEntry.media_content[0]['url'])
         fileExtension = None
         contentType = resp.headers['content-type']
-        typeToExt = {
-            'image/jpeg': 'jpg',
-            'image/png': 'png',
-            'image/gif': 'gif',
-            'image/svg+xml': 'svg'
-            }
         try:
             fileExtension = typeToExt[contentType]
         except KeyError:
@@ -93,7 +114,228 @@ def fanartScraper(searchString, nbImages, sortBy, outputFolder):
             os.remove(imageFilename)
         currentEntryIdx += 1
 
+def feedUrl(searchString, sortBy, baseUrl=rssBaseUrl):
+    """ Url of the deviantArt RSS feed for a search query.
+    """
+    return (baseUrl + '?type=deviation&q='
+            + urllib.quote_plus('boost:' + sortBy + ' ' + searchString
+                                + ' in:fanart/manga'))
+
+def queryBaseFilename(searchString):
+    """ Base filename of the images of a search query, its words separated by _.
+    """
+    return reduce(lambda word, rest: word + '_' + rest,
+                  re.sub("[^\w]", " ", searchString).split())
+
+def makeSession(nbWorkers):
+    """ HTTP session keeping enough connections alive for nbWorkers threads.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=nbWorkers,
+                                            pool_maxsize=nbWorkers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetchFeed(session, url):
+    """ Downloads and parses an RSS feed.
+    """
+    with instr.timer('scraper/feed') as t:
+        resp = session.get(url)
+        resp.raise_for_status()
+        t.nbytes = len(resp.content)
+    return fp.parse(resp.content)
+
+def downloadImage(session, url):
+    """ Downloads an image and decodes it in memory.
+    Returns:
+        The file extension, raw bytes and decoded BGR image, None if opencv cannot
+        decode it. The extension is None if the url is not an image.
+    """
+    with instr.timer('scraper/download') as t:
+        resp = session.get(url)
+        resp.raise_for_status()
+        t.nbytes = len(resp.content)
+    fileExtension = typeToExt.get(resp.headers.get('content-type'))
+    if fileExtension == None:
+        return None, resp.content, None
+    with instr.timer('scraper/decode', len(resp.content)):
+        image = cv2.imdecode(np.frombuffer(resp.content, dtype=np.uint8),
+                             cv2.IMREAD_COLOR)
+    return fileExtension, resp.content, image
+
+def cv2Reviewer(image, entry):
+    """ Asks the user whether an image shows the right character, with y or n keys.
+    """
+    pressedKey = -1
+    yesCode = ord('y')
+    noCode = ord('n')
+    cv2.namedWindow("image", cv2.WINDOW_NORMAL)
+    while pressedKey != yesCode and pressedKey != noCode:
+        try:
+            cv2.imshow("image", image)
+            pressedKey = cv2.waitKey(0)
+        except:
+            print "image cannot be displayed"
+            pressedKey = noCode
+    return pressedKey == yesCode
+
+class Journal:
+    """ Decisions taken on the entries of a search query, appended to a json lines
+        file as they are taken.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.decisions = {}
+        self.nbAccepted = 0
+        if os.path.isfile(filename):
+            journalFile = open(filename)
+            for line in journalFile:
+                if line.strip() != '':
+                    self._remember(json.loads(line))
+            journalFile.close()
+
+    def _remember(self, record):
+        self.decisions[record['url']] = record
+        if record['decision'] == 'yes':
+            self.nbAccepted += 1
+
+    def decided(self, url):
+        return url in self.decisions
+
+    def record(self, url, decision, filename=None):
+        """ Records the decision for an image url: 'yes', 'no', 'skipped' if it is
+            not an image opencv can decode, or 'duplicate' if it is a near duplicate
+            of an image file, then given as filename.
+        """
+        record = {'url': url, 'decision': decision, 'filename': filename}
+        journalFile = open(self.filename, 'a')
+        journalFile.write(json.dumps(record) + '\n')
+        journalFile.close()
+        self._remember(record)
+
+def _freeFileStem(outputFolder, baseFilename, index):
+    """ First stem with index or more not used by any image in the output folder.
+    """
+    while True:
+        fileStem = os.path.join(outputFolder, baseFilename + '_' + repr(index))
+        if not any([os.path.isfile(fileStem + '.' + ext)
+                    for ext in typeToExt.values()]):
+            return fileStem
+        index += 1
+
+def scrapeQueries(searchStrings, nbImages, sortBy, outputFolder, reviewer=cv2Reviewer,
+                  nbWorkers=4, prefetch=8, baseUrl=rssBaseUrl, session=None,
+                  index=None):
+    """ Scrapes fanart images for many search queries, downloading them concurrently
+        while they are reviewed one at a time.
+    Args:
+        searchStrings (list): search queries to submit to deviantArt.
+        nbImages (int): number of images to accept per query.
+        sortBy (str): how deviantArt sorts the results, see fanartScraper.
+        outputFolder (str): folder to write the images, json info files and journals
+            to.
+        reviewer (function): function of a decoded image and its feed entry returning
+            True to keep it, asking the user by default.
+        nbWorkers (int): maximum number of concurrent downloads.
+        prefetch (int): number of images downloaded ahead of the reviewer.
+        baseUrl (str): url of the RSS feed.
+        session (requests.Session): session to download with, a new pooled one by
+            default.
+        index (duplicates.HashIndex): index of the output folder, to skip near
+            duplicates of its images with. Accepted images are added to it.
+    Returns:
+        The number of images accepted for each query, including previous runs.
+    """
+    if session == None:
+        session = makeSession(nbWorkers)
+    pool = ThreadPool(nbWorkers)
+    # All feeds are downloaded in the background while the first ones are reviewed
+    feeds = [pool.apply_async(fetchFeed, (session, feedUrl(q, sortBy, baseUrl)))
+             for q in searchStrings]
+    journals = [Journal(os.path.join(outputFolder, queryBaseFilename(q) + '.journal'))
+                for q in searchStrings]
+
+    def candidates():
+        for searchString, feed, journal in zip(searchStrings, feeds, journals):
+            for entry in feed.get().entries:
+                if journal.nbAccepted >= nbImages:
+                    break
+                url = entry.media_content[0]['url']
+                if not journal.decided(url):
+                    yield searchString, journal, entry, url
+
+    stream = candidates()
+    pending = collections.deque()
+    def fill():
+        for candidate in stream:
+            pending.append((candidate, pool.apply_async(downloadImage,
+                                                        (session, candidate[3]))))
+            if len(pending) >= prefetch:
+                return
+    try:
+        fill()
+        while len(pending) > 0:
+            (searchString, journal, entry, url), download = pending.popleft()
+            # Keep downloading while the reviewer decides
+            fill()
+            if journal.nbAccepted >= nbImages:
+                continue
+            try:
+                fileExtension, content, image = download.get()
+            except requests.RequestException as e:
+                # Not journaled, so it is tried again next time
+                print "could not download " + url + ": " + repr(e)
+                continue
+            if image is None:
+                journal.record(url, 'skipped')
+                continue
+            if index != None:
+                h = duplicates.phash(image)
+                near = index.near(h)
+                if near != []:
+                    journal.record(url, 'duplicate', near[0][1])
+                    continue
+            if reviewer(image, entry):
+                fileStem = _freeFileStem(outputFolder, queryBaseFilename(searchString),
+                                         journal.nbAccepted)
+                imageFile = open(fileStem + '.' + fileExtension, 'wb')
+                imageFile.write(content)
+                imageFile.close()
+                # Write the entire entry to a json file for exhaustiveness
+                jsonFile = open(fileStem + '.json', 'w')
+                json.dump(entry, jsonFile, indent = 4, default = repr)
+                jsonFile.close()
+                imageFilename = os.path.basename(fileStem + '.' + fileExtension)
+                journal.record(url, 'yes', imageFilename)
+                if index != None:
+                    index.add(imageFilename, h,
+                              os.path.getmtime(fileStem + '.' + fileExtension))
+            else:
+                journal.record(url, 'no')
+    finally:
+        pool.terminate()
+    return [journal.nbAccepted for journal in journals]
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrapes fanart from deviantArt.")
+    parser.add_argument('--output', default=conf.imagesfolder,
+                        help="folder of the source images, the one of "
+                        + "duplicates.py by default")
+    parser.add_argument('--nb-images', type=int, default=50)
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help="number of concurrent downloads")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="number of images downloaded ahead of the review")
+    parser.add_argument('--sequential', action='store_true',
+                        help="download and review images one at a time")
+    parser.add_argument('--hash-index', default=conf.hashindexfile,
+                        help="file to keep the perceptual hashes of the output "
+                        + "folder in, to skip near duplicates, the one of "
+                        + "duplicates.py by default")
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="review near duplicates of existing images too")
+    args = parser.parse_args()
     characterNames = [
         'asuka langley',
         'rei ayanami',
@@ -117,6 +359,21 @@ if __name__ == "__main__":
         'motoko kusanagi'
         ]
     
-    for name in characterNames:
-        print "scraping images for " + name + "..."
-        fanartScraper(name, 50, 'popular', os.path.join('..', 'chardetect', 'images'))
+    if args.sequential:
+        for name in characterNames:
+            print "scraping images for " + name + "..."
+            fanartScraper(name, args.nb_images, 'popular', args.output)
+    else:
+        index = None
+        if not args.no_dedup:
+            hashindexfile = args.hash_index
+            index = duplicates.open_index(args.output, hashindexfile)
+        try:
+            nbAccepted = scrapeQueries(characterNames, args.nb_images, 'popular',
+                                       args.output, nbWorkers=args.workers,
+                                       prefetch=args.prefetch, index=index)
+        finally:
+            if index != None:
+                index.save(hashindexfile)
+        for name, nb in zip(characterNames, nbAccepted):
+            print name + ": " + repr(nb) + " images"
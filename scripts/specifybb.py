@@ -3,7 +3,10 @@ import sys
 import os
 import os.path
 import numpy as np
-import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import imagecache
+import annotations
 
 class BBDrawing:
     def __init__(self, image):
@@ -48,8 +51,10 @@ class BBDrawing:
         return self.image
         
 if __name__ == "__main__":
-    if sys.argv < 3:
-        raise ValueError("Please input 2 folder names.")
+    if len(sys.argv) < 3:
+        raise ValueError("Please input an image folder name, and a bounding boxes "
+                         + "folder name or annotations store file.")
+    annotationsource = annotations.open_annotations(sys.argv[2])
     imageFilenames = [f for f in sorted(os.listdir(sys.argv[1]), 
                                         key=lambda s: s.lower())
                       if f.endswith(('.jpg', '.png', '.gif'))]
@@ -59,12 +64,11 @@ if __name__ == "__main__":
     for imageFilename in imageFilenames:
         stem = os.path.splitext(imageFilename)[0]
         print stem
-        outFilename = os.path.join(sys.argv[2], stem + '_bb.json')
-        # if json file already writtenm skip the image
-        if os.path.isfile(outFilename):
+        # if bounding boxes already written, skip the image
+        if annotationsource.hasboxes(stem):
             continue
-        image = cv2.imread(os.path.join(sys.argv[1], imageFilename))
-        if image == None or image.shape[0] == 0:
+        image = imagecache.imread(os.path.join(sys.argv[1], imageFilename))
+        if image is None or image.shape[0] == 0:
             print "error opening!"
             continue;
         # let the user draw the bounding boxes
@@ -77,7 +81,7 @@ if __name__ == "__main__":
             cv2.imshow(windowName, bbdrawing.getimage())
             keycode = cv2.waitKey(1000/60)
             bbdrawing.onKey(keycode)
-        # write the bounding boxes to a json file
-        outFile = open(outFilename, 'w')
-        json.dump(bbdrawing.bbs, outFile)
-        outFile.close()
+        # write the bounding boxes
+        annotationsource.setboxes(stem, bbdrawing.bbs)
+    annotationsource.close()
+    print imagecache.getcache().report()
@@ -0,0 +1,303 @@
+""" Detection of characters in videos, e.g. anime episodes, and streams of images.
+
+Frames are decoded by a reader thread, from a video with OpenCV's VideoCapture or
+from the images of a folder in order of their names, into a bounded queue: when
+detection falls behind, the reader blocks until there is room in the queue again, so
+at most acdconf.streamqueuesize decoded frames are held in memory however long the
+stream. Frames are taken from the queue in micro-batches spread across the backends
+of a DPMObjectDetection.
+
+Most frames of a static shot are the same picture up to noise and compression, so
+frames are compared to the last detected one by their perceptual hashes, see
+duplicates.py: a frame within acdconf.sceneradius bits of it reuses its detections
+instead of being detected again, up to acdconf.maxreuse frames in a row so slowly
+moving shots are detected again regularly. A scene change, i.e. a cut or a large
+motion, makes the frame detected.
+
+Detections are written as json lines in the format of evaluation.save_detections,
+one line per frame in order as soon as its batch is detected, with boxes in the
+format of the _bb.json files. Frames of a video are named <video stem>_<frame index>.
+
+python streaming.py model.dpm episode.mkv detections.json
+"""
+import argparse
+import os
+import os.path
+import Queue
+import sys
+import threading
+import time
+import cv2
+import acdconf as conf
+import dpmDetection as dpmd
+import dpmscoring as dpms
+import duplicates
+import evaluation
+import instrumentation as instr
+
+_imageextensions = ('.jpg', '.png', '.gif')
+
+def folder_frames(folder):
+    """ Frames of the images of a folder, in order of their file names.
+    Returns:
+        An iterator of (stem, image) pairs, with BGR images.
+    """
+    filenames = sorted([f for f in os.listdir(folder)
+                        if f.lower().endswith(_imageextensions)])
+    for filename in filenames:
+        image = cv2.imread(os.path.join(folder, filename))
+        if image is None:
+            raise IOError("Cannot read image " + filename)
+        yield os.path.splitext(filename)[0], image
+
+def video_frames(filename, step=1):
+    """ Frames of a video decoded with OpenCV.
+    Args:
+        filename (str): video file, or any source VideoCapture opens.
+        step (int): only every step-th frame is returned.
+    Returns:
+        An iterator of (stem, image) pairs, with BGR images.
+    """
+    capture = cv2.VideoCapture(filename)
+    if not capture.isOpened():
+        raise IOError("Cannot open video " + filename)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        index = 0
+        while True:
+            # Skipped frames are still decoded, as seeking is not exact in most
+            # codecs
+            if index % step == 0:
+                ok, frame = capture.read()
+            else:
+                ok = capture.grab()
+            if not ok:
+                break
+            if index % step == 0:
+                yield stem + '_' + '%06d' % index, frame
+            index += 1
+    finally:
+        capture.release()
+
+def open_frames(source, step=1):
+    """ Frames of a folder of images, see folder_frames, or of a video, see
+        video_frames.
+    """
+    if os.path.isdir(source):
+        return folder_frames(source)
+    return video_frames(source, step)
+
+def _put(queue, item, stop):
+    """ Puts an item into a bounded queue, waiting for room until stopped.
+    Returns:
+        False if stopped before the item could be put.
+    """
+    try:
+        queue.put_nowait(item)
+        return True
+    except Queue.Full:
+        instr.count('streaming/stalls')
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def prefetch(frames, queuesize=conf.streamqueuesize):
+    """ Decodes frames ahead in a thread, at most queuesize of them at a time.
+    Args:
+        frames (iterator): frames to decode, e.g. from open_frames.
+        queuesize (int): maximum number of decoded frames waiting to be taken.
+    Returns:
+        An iterator of the same frames. Errors of the decoding are raised by it.
+    """
+    queue = Queue.Queue(queuesize)
+    stop = threading.Event()
+    def read():
+        error = None
+        try:
+            iterator = iter(frames)
+            while True:
+                with instr.timer('streaming/decode'):
+                    item = next(iterator, None)
+                if item == None or not _put(queue, (item, None), stop):
+                    break
+        except Exception:
+            error = sys.exc_info()
+        _put(queue, (None, error), stop)
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item == None:
+                break
+            yield item
+        if error != None:
+            raise error[0], error[1], error[2]
+    finally:
+        # Unblocks the reader when the consumer stops early
+        stop.set()
+
+class SceneTracker:
+    """ Tells which frames of a stream continue the shot of the last detected one,
+        by the hamming distance between their perceptual hashes.
+    """
+    def __init__(self, radius=conf.sceneradius, maxreuse=conf.maxreuse):
+        """ Initializes the tracker.
+        Args:
+            radius (int): maximum hamming distance between the hashes of frames of
+                the same shot, negative to detect every frame.
+            maxreuse (int): maximum number of frames in a row continuing a shot.
+        """
+        self.radius = radius
+        self.maxreuse = maxreuse
+        self.hash = None
+        self.reused = 0
+
+    def same(self, frame):
+        """ Whether a frame continues the shot of the last detected frame. Otherwise
+            the frame is the one detected next.
+        """
+        h = duplicates.phash(frame)
+        if (self.hash != None and self.reused < self.maxreuse
+            and duplicates.hamming(h, self.hash) <= self.radius):
+            self.reused += 1
+            return True
+        self.hash = h
+        self.reused = 0
+        return False
+
+def _detectbatch(detector, batch, last, thresh, max_num):
+    """ Detects the frames of a batch which do not continue a shot, the others
+        reusing the detections of the last detected frame before them.
+    """
+    images = [frame for stem, frame, same in batch if not same]
+    with instr.timer('streaming/batch'):
+        results = iter(detector.detectBatch(images, thresh, max_num)
+                       if images != [] else [])
+    output = []
+    for stem, frame, same in batch:
+        if not same:
+            last = next(results)
+        output.append((stem, list(last), same))
+    return output, last
+
+def detect_stream(detector, frames, thresh, max_num,
+                  batchsize=conf.streambatchsize, queuesize=conf.streamqueuesize,
+                  tracker=None):
+    """ Detects objects in a stream of frames, see the module documentation.
+    Args:
+        detector (dpmDetection.DPMObjectDetection): detector with a model set.
+        frames (iterator): (stem, image) pairs, e.g. from open_frames.
+        thresh (float): minimum score of detections.
+        max_num (int): maximum number of detections per frame.
+        batchsize (int): number of frames taken from the queue at once.
+        queuesize (int): maximum number of decoded frames waiting for detection.
+        tracker (SceneTracker): decides which frames reuse earlier detections, one
+            with the parameters of acdconf by default.
+    Returns:
+        An iterator of (stem, detections, reused) triples in the order of the frames,
+        with detections as lists of (bbox, score) pairs in decreasing score order,
+        and reused True for frames which were not detected.
+    """
+    if tracker == None:
+        tracker = SceneTracker()
+    last = []
+    batch = []
+    for stem, frame in prefetch(frames, queuesize):
+        batch.append((stem, frame, tracker.same(frame)))
+        if len(batch) >= batchsize:
+            output, last = _detectbatch(detector, batch, last, thresh, max_num)
+            batch = []
+            for result in output:
+                yield result
+    if batch != []:
+        output, last = _detectbatch(detector, batch, last, thresh, max_num)
+        for result in output:
+            yield result
+
+def report(stats):
+    """ Human readable summary of the throughput of a stream.
+    """
+    return (repr(stats['frames']) + " frames in " + '%.1f' % stats['seconds']
+            + "s, " + '%.2f' % stats['fps'] + " frames/s, "
+            + repr(stats['detected']) + " detected, " + repr(stats['reused'])
+            + " reused")
+
+def _stats(frames, reused, seconds):
+    return {'frames': frames, 'detected': frames - reused, 'reused': reused,
+            'seconds': seconds, 'fps': frames / max(seconds, 1e-12)}
+
+def run_stream(detector, frames, outputfile, thresh, max_num,
+               batchsize=conf.streambatchsize, queuesize=conf.streamqueuesize,
+               tracker=None, reportinterval=None, reportfile=sys.stderr):
+    """ Detects objects in a stream of frames, see detect_stream, writing their
+        detections as json lines.
+    Args:
+        outputfile (file): file to write a line of detections per frame to, flushed
+            after each batch of frames.
+        reportinterval (float): seconds between reports of the throughput so far,
+            None for no reports.
+        reportfile (file): file to write the reports to.
+    Returns:
+        The throughput of the stream, a dictionary of the numbers of frames,
+        detected and reused frames, seconds and frames per second.
+    """
+    start = time.time()
+    lastreport = start
+    nbframes = 0
+    nbreused = 0
+    for stem, detections, reused in detect_stream(detector, frames, thresh, max_num,
+                                                  batchsize, queuesize, tracker):
+        outputfile.write(evaluation.detections_entry(stem, detections))
+        nbframes += 1
+        nbreused += int(reused)
+        if nbframes % batchsize == 0:
+            outputfile.flush()
+        now = time.time()
+        if reportinterval != None and now - lastreport >= reportinterval:
+            reportfile.write(report(_stats(nbframes, nbreused, now - start)) + '\n')
+            lastreport = now
+    outputfile.flush()
+    instr.count('streaming/frames', nbframes)
+    instr.count('streaming/reused', nbreused)
+    return _stats(nbframes, nbreused, time.time() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detects characters in a video or a folder of frames, writing "
+        + "the detections of each frame as json lines.")
+    parser.add_argument('model', help="native model file, see dpmscoring.py")
+    parser.add_argument('source', help="video file or folder of images")
+    parser.add_argument('output', help="json lines file of detections, - for stdout")
+    parser.add_argument('--thresh', type=float, default=-0.5)
+    parser.add_argument('--max-num', type=int, default=10)
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of backends to detect with")
+    parser.add_argument('--step', type=int, default=1,
+                        help="only detect every step-th frame of a video")
+    parser.add_argument('--batchsize', type=int, default=conf.streambatchsize)
+    parser.add_argument('--queuesize', type=int, default=conf.streamqueuesize)
+    parser.add_argument('--radius', type=int, default=conf.sceneradius,
+                        help="maximum hamming distance between the hashes of frames "
+                        + "of a shot, negative to detect every frame")
+    parser.add_argument('--maxreuse', type=int, default=conf.maxreuse)
+    parser.add_argument('--report', type=float, default=10,
+                        help="seconds between throughput reports")
+    args = parser.parse_args()
+    detector = dpmd.DPMObjectDetection(args.workers, dpms.NativeBackend)
+    outputfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        detector.setModel(dpms.loadmodel(args.model))
+        stats = run_stream(detector, open_frames(args.source, args.step), outputfile,
+                           args.thresh, args.max_num, args.batchsize, args.queuesize,
+                           SceneTracker(args.radius, args.maxreuse), args.report)
+    finally:
+        detector.close()
+        if outputfile != sys.stdout:
+            outputfile.close()
+    sys.stderr.write(report(stats) + '\n')
@@ -0,0 +1,79 @@
+""" Unit tests for annotations.py.
+"""
+import annotations
+import unittest
+import os
+import os.path
+import json
+import tempfile
+import shutil
+
+class TestAnnotations(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.bboxesfolder = os.path.join(self.tmpfolder, 'boundingboxes')
+        self.metadatafolder = os.path.join(self.tmpfolder, 'metadata')
+        os.makedirs(self.bboxesfolder)
+        os.makedirs(self.metadatafolder)
+        self.bboxes = {
+            'rei_ayanami_0': [[[10,20],[30,40]], [[0,0],[5,5]]],
+            'rei_ayanami_1': [],
+            'monkey_d_luffy_0': [[[1,2],[3,4]]]
+            }
+        for stem, bboxes in self.bboxes.items():
+            jsonfile = open(os.path.join(self.bboxesfolder, stem + '_bb.json'), 'w')
+            json.dump(bboxes, jsonfile)
+            jsonfile.close()
+            jsonfile = open(os.path.join(self.metadatafolder, stem + '.json'), 'w')
+            json.dump({'title': stem}, jsonfile)
+            jsonfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpfolder)
+
+    def test_open(self):
+        self.assertTrue(isinstance(annotations.open_annotations(self.bboxesfolder),
+                                   annotations.JsonAnnotations))
+        # Missing stores are only created when asked to
+        filename = os.path.join(self.tmpfolder, 'a.sqlite')
+        self.assertRaises(IOError, annotations.open_annotations, filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertRaises(IOError, annotations.open_annotations,
+                          os.path.join(self.tmpfolder, 'missing', 'boundingboxes'))
+        store = annotations.open_annotations(filename, create=True)
+        store.setboxes('lain_0', [[[1,1],[2,2]]])
+        store.close()
+        store = annotations.open_annotations(filename)
+        self.assertEqual(store.allboxes(), {'lain_0': [[[1,1],[2,2]]]})
+        store.close()
+
+    def test_store(self):
+        store = annotations.AnnotationStore(os.path.join(self.tmpfolder, 'a.sqlite'))
+        self.assertEqual(store.importjson(self.bboxesfolder, self.metadatafolder), 
+                         (3, 3))
+        jsonannotations = annotations.JsonAnnotations(self.bboxesfolder, 
+                                                      self.metadatafolder)
+        # Both should give back the same annotations
+        for source in [store, jsonannotations]:
+            self.assertEqual(source.allboxes(), self.bboxes)
+            for stem, bboxes in self.bboxes.items():
+                self.assertEqual(source.boxes(stem), bboxes)
+                self.assertEqual(source.metadata(stem), {'title': stem})
+                self.assertEqual(source.mtime(stem), jsonannotations.mtime(stem))
+            self.assertEqual(source.characters(), ['monkey d luffy', 'rei ayanami'])
+            self.assertEqual(source.stems('rei ayanami'), 
+                             ['rei_ayanami_0', 'rei_ayanami_1'])
+            self.assertFalse(source.hasboxes('lain_0'))
+            self.assertEqual(source.boxes('lain_0'), None)
+        store.setboxes('lain_0', [[[1,1],[2,2]]])
+        self.assertEqual(store.boxes('lain_0'), [[[1,1],[2,2]]])
+        # Exporting should give back the json layout with the new boxes
+        exportfolder = os.path.join(self.tmpfolder, 'export')
+        os.makedirs(exportfolder)
+        store.exportjson(exportfolder)
+        store.close()
+        self.assertEqual(annotations.JsonAnnotations(exportfolder).allboxes(),
+                         dict(self.bboxes.items() + [('lain_0', [[[1,1],[2,2]]])]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+""" Unit tests for benchmarks.py.
+"""
+import benchmarks
+import unittest
+import numpy as np
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generators(self):
+        for seed in [0, 1]:
+            boxes = benchmarks.synthetic_boxes(np.random.RandomState(seed), 100, 150,
+                                               20)
+            self.assertEqual(boxes, benchmarks.synthetic_boxes(
+                np.random.RandomState(seed), 100, 150, 20))
+            for [[ulx,uly],[drx,dry]] in boxes:
+                self.assertTrue(0 <= ulx <= drx < 150 and 0 <= uly <= dry < 100)
+        image = benchmarks.synthetic_image(np.random.RandomState(0), 60, 80)
+        self.assertEqual((image.shape, image.dtype), ((60, 80, 3), np.uint8))
+
+    def test_run_compare(self):
+        report = benchmarks.run(['negative_samples_boxes', 'folds'], repeat=1,
+                                quick=True)
+        self.assertEqual(sorted(report['results'].keys()),
+                         sorted(['negative_samples_boxes/' + engine + '/boxes=' + n
+                                 for engine in ['python', 'numpy']
+                                 for n in ['1', '10', '50']]
+                                + ['folds/images=100', 'folds/images=1000']))
+        self.assertTrue(report['environment']['quick'])
+        slower = {'results': dict([(name, dict(result))
+                                   for name, result in report['results'].items()])}
+        slower['results']['folds/images=100']['min'] *= 1.5
+        slower['results']['folds/images=1000']['min'] *= 1.05
+        del slower['results']['negative_samples_boxes/numpy/boxes=1']
+        rows, regressions = benchmarks.compare(report, slower, 0.1)
+        self.assertEqual(len(rows), len(report['results']) - 1)
+        self.assertEqual(regressions, ['folds/images=100'])
+        rows, regressions = benchmarks.compare(slower, report, 0.1)
+        self.assertEqual(regressions, [])
+
+if __name__ == '__main__':
+    unittest.main()
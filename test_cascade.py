@@ -0,0 +1,92 @@
+""" Unit tests for cascade.py.
+"""
+import cascade
+import dpmscoring as dpms
+import test_dpmscoring
+import unittest
+import numpy as np
+import os.path
+import tempfile
+import shutil
+
+def template_model(image):
+    """ Model whose root and parts are made of the features of the middle of an
+        image, so it detects it there.
+    """
+    model = dpms.DPMModel([dpms.Component(np.zeros([5, 4, 31]), [], 0)], 8, 2)
+    pyramid = model.pyramidbuilder().build(image)
+    y, x = 7, 9
+    root = pyramid.feat[2][y:y+5, x:x+4]
+    partfeat = pyramid.feat[0]
+    py, px = 2 * y - pyramid.pady, 2 * x - pyramid.padx
+    parts = [dpms.Part(partfeat[py+ay:py+ay+3, px+ax:px+ax+2] / 2, (ax, ay),
+                       [0.5, 0, 0.5, 0])
+             for ax, ay in [(0, 0), (4, 2), (2, 6)]]
+    model.components = [dpms.Component(root, parts, -1)]
+    ulx, uly = (x - pyramid.padx) * 8, (y - pyramid.pady) * 8
+    return model, [[ulx, uly], [ulx + 4 * 8 - 1, uly + 5 * 8 - 1]]
+
+class TestCascade(unittest.TestCase):
+    def test_no_pruning(self):
+        # Without thresholds and with a radius covering the maps, the cascade scores
+        # all locations exactly
+        rng = np.random.RandomState(1)
+        model = test_dpmscoring.random_model(rng)
+        rootfeat = rng.randn(8, 7, 31)
+        partfeat = rng.randn(16, 14, 31)
+        c = cascade.Cascade([[-np.inf] * 3, [-np.inf]], radius=16)
+        for expected, actual in zip(dpms.score_level(model, rootfeat, partfeat, 3, 2),
+                                    c.score_level(model, rootfeat, partfeat, 3, 2)):
+            self.assertTrue(np.array_equal(np.isinf(expected), np.isinf(actual)))
+            finite = np.isfinite(expected)
+            self.assertTrue(np.allclose(expected[finite], actual[finite]))
+
+    def test_pruning(self):
+        rng = np.random.RandomState(1)
+        model = test_dpmscoring.random_model(rng)
+        rootfeat = rng.randn(8, 7, 31)
+        partfeat = rng.randn(16, 14, 31)
+        exhaustive = dpms.score_level(model, rootfeat, partfeat, 3, 2)
+        t = np.median(exhaustive[0][np.isfinite(exhaustive[0])])
+        c = cascade.Cascade([[-np.inf, -np.inf, t], [-np.inf]], radius=16)
+        pruned = c.score_level(model, rootfeat, partfeat, 3, 2)
+        kept = exhaustive[0] >= t
+        self.assertTrue(np.allclose(pruned[0][kept], exhaustive[0][kept]))
+        self.assertTrue(np.all(np.isinf(pruned[0][~kept])))
+
+    def test_calibrate_compare(self):
+        rng = np.random.RandomState(2)
+        image = rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+        model, box = template_model(image)
+        c = cascade.calibrate(model, [(image, [box])], thresh=0)
+        self.assertTrue(np.all(np.isfinite(c.thresholds[0])))
+        self.assertEqual(len(c.thresholds[0]), 4)
+        # Partial scores only grow with parts matching the image
+        self.assertTrue(np.all(np.diff(c.thresholds[0]) > 0))
+        exhaustive = dpms.detect(model, model.pyramidbuilder().build(image), 0, 1)
+        self.assertEqual(exhaustive[0][0], box)
+        report = cascade.compare(model, c, [(image, [box])], 0, 1)
+        self.assertEqual(report['exhaustiverecall'], 1)
+        self.assertEqual(report['recallloss'], 0)
+        # Through the backend
+        backend = dpms.NativeBackend(cascade=c)
+        backend.loadmodel(model)
+        detections = backend.detect(image, 0, 1)
+        self.assertEqual(detections[0][0], box)
+        self.assertAlmostEqual(detections[0][1], exhaustive[0][1])
+
+    def test_save_load(self):
+        c = cascade.Cascade([[-np.inf, 1.5, 2], [0.5]], radius=3)
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpfolder, 'cascade.json')
+            cascade.savecascade(c, filename)
+            loaded = cascade.loadcascade(filename)
+        finally:
+            shutil.rmtree(tmpfolder)
+        self.assertEqual(loaded.radius, 3)
+        for expected, actual in zip(c.thresholds, loaded.thresholds):
+            self.assertTrue(np.array_equal(expected, actual))
+
+if __name__ == '__main__':
+    unittest.main()
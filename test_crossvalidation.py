@@ -0,0 +1,88 @@
+""" Unit tests for crossvalidation.py.
+"""
+import crossvalidation as cv
+import dpmscoring as dpms
+import folds
+import annotations
+import negatives as neg
+import test_cascade
+import unittest
+import cv2
+import functools
+import json
+import os
+import os.path
+import numpy as np
+import tempfile
+import shutil
+
+def scanning_trainer(detector, model, manifest, trainfolds, positives, fold):
+    """ Trainer scanning the negatives of the training folds as mining would, without
+        changing the model.
+    """
+    detector.setModel(model)
+    detector.detectBatch([patch for key, patch in manifest.negatives(trainfolds)],
+                         0, 1)
+    return model
+
+class TestCrossValidation(unittest.TestCase):
+    def test_run(self):
+        rng = np.random.RandomState(2)
+        image = rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+        model, box = test_cascade.template_model(image)
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            positivesfolder, negativesfolder, bboxesfolder, featurefolder = [
+                os.path.join(tmpfolder, f)
+                for f in ['positives', 'negatives', 'bboxes', 'features']]
+            for folder in [positivesfolder, negativesfolder, bboxesfolder]:
+                os.makedirs(folder)
+            source = annotations.JsonAnnotations(bboxesfolder)
+            for i in range(0, 3):
+                stem = 'img_' + repr(i)
+                noise = rng.randint(-2, 3, image.shape)
+                cv2.imwrite(os.path.join(positivesfolder, stem + '.png'),
+                            np.clip(image + noise, 0, 255).astype(np.uint8))
+                source.setboxes(stem, [box])
+                cv2.imwrite(os.path.join(negativesfolder,
+                                         neg.negative_filename(stem, 0)),
+                            rng.randint(0, 256, [60, 80, 3]).astype(np.uint8))
+            manifest = folds.FoldManifest.build(3, positivesfolder, negativesfolder,
+                                                source, seed=0)
+            validation = cv.CrossValidation(manifest, source, model,
+                                            trainer=scanning_trainer,
+                                            featurefolder=featurefolder, thresh=0,
+                                            max_num=3)
+            self.assertEqual(validation.precompute(3), 6)
+            stored = sorted(os.listdir(featurefolder))
+            self.assertEqual(len([f for f in stored if f.endswith('.json')]), 6)
+            report = validation.run(nbprocesses=3)
+            # Native backends cannot train, which is told before running any fold
+            trainer = cv.MiningTrainer(tmpfolder, 1, 10, 10, 0, 1, 1, 100, 0.7, 0,
+                                       False, 'cv', 0.001)
+            for factory in [None, dpms.NativeBackend,
+                            functools.partial(dpms.NativeBackend, 1)]:
+                self.assertRaises(ValueError, cv.CrossValidation, manifest, source,
+                                  model, factory, trainer)
+            # Folds only read the pyramids computed beforehand
+            self.assertEqual(sorted(os.listdir(featurefolder)), stored)
+            self.assertEqual([r['fold'] for r in report['folds']], [0, 1, 2])
+            for result in report['folds']:
+                self.assertEqual(result['ap'], 1)
+                self.assertEqual((result['nbimages'], result['nbboxes']), (1, 1))
+                self.assertTrue(result['peakmemory'] > 0)
+                self.assertTrue(result['walltime'] >= result['traintime'] > 0)
+            self.assertEqual(report['meanap'], 1)
+            # Same results in this process, without the feature folder
+            validation.featurefolder = None
+            inprocess = validation.run([1], nbprocesses=1)
+            self.assertEqual(inprocess['folds'][0]['nbdetections'],
+                             report['folds'][1]['nbdetections'])
+            # whose peak memory is only known for the whole process
+            self.assertEqual(inprocess['folds'][0]['peakmemory'], None)
+            self.assertTrue(0 < inprocess['peakmemory'] <= cv.peak_memory())
+        finally:
+            shutil.rmtree(tmpfolder)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+""" Unit tests for dpmDetection.py, using the stub backend.
+"""
+import dpmDetection as dpm
+import dpmscoring as dpms
+import unittest
+import numpy as np
+import os.path
+import time
+
+class TestDPMObjectDetection(unittest.TestCase):
+    def test_detect_batch(self):
+        backends = []
+        def factory():
+            backends.append(dpm.StubBackend(delay=0.05))
+            return backends[-1]
+        detector = dpm.DPMObjectDetection(4, factory)
+        self.assertRaises(ValueError, detector.detectObject, 
+                          np.zeros([10,10,3]), 0, 1)
+        detector.setModel('model')
+        images = [np.full([10 + i, 20, 3], i, dtype=np.uint8) for i in range(0,16)]
+        start = time.time()
+        detections = detector.detectBatch(images, 0, 1)
+        elapsed = time.time() - start
+        detector.close()
+        # Results in order, model loaded once per backend, work spread across all
+        # of them.
+        self.assertEqual(detections, 
+                         [[([[0,0],[19,9+i]], float(i))] for i in range(0,16)])
+        self.assertEqual([b.nbloads for b in backends], [1] * 4)
+        self.assertEqual(sum([b.nbdetections for b in backends]), 16)
+        self.assertTrue(elapsed < 16 * 0.05 / 2)
+
+    def test_thresh_max_num(self):
+        detector = dpm.DPMObjectDetection(
+            1, lambda: dpm.StubBackend(lambda image, model: [
+                    ([[0,0],[1,1]], 0.5), ([[0,0],[2,2]], 2.), 
+                    ([[0,0],[3,3]], 1.), ([[0,0],[4,4]], -1.)]))
+        detector.setModel('model')
+        self.assertEqual(detector.detectObject(np.zeros([5,5,3]), 0, 2),
+                         [([[0,0],[2,2]], 2.), ([[0,0],[3,3]], 1.)])
+        detector.close()
+
+    def test_train_native(self):
+        # Native backends cannot train
+        detector = dpm.DPMObjectDetection(1, dpms.NativeBackend)
+        self.assertRaises(ValueError, detector.trainDPMmodel, 'model', [], [], 0, 0,
+                          1, 1, 100, 0.7, 0, False, 'tag', 0.001)
+        detector.close()
+
+    def test_save_model(self):
+        # Stub models cannot be saved
+        detector = dpm.DPMObjectDetection(1, dpm.StubBackend)
+        self.assertRaises(ValueError, detector.saveModel, 'model.dpm')
+        detector.setModel('model')
+        self.assertRaises(ValueError, detector.saveModel, 'model.dpm')
+        detector.close()
+
+    def test_examples_tomatlab(self):
+        names, boxes = dpm.examples_tomatlab(
+            [('a.png', [[[0,1],[9,19]], [[4,4],[6,7]]]), ('/data/bc.jpg', [])])
+        self.assertEqual(names.dtype, np.uint8)
+        self.assertEqual([n.tostring().rstrip('\0') for n in names],
+                         [os.path.abspath('a.png'), '/data/bc.jpg'])
+        self.assertEqual(boxes.tolist(), [[1, 1, 2, 10, 20], [1, 5, 5, 7, 8]])
+        names, boxes = dpm.examples_tomatlab(['/n/neg_0.png', '/n/neg_10.png'])
+        self.assertEqual(names.shape, (2, 13))
+        self.assertEqual(boxes.shape, (0, 5))
+
+    def test_matlab_train(self):
+        # Training through a session only puts numpy arrays into it, as pymatlab
+        # requires, the examples being assembled into structs by acd_examples
+        class Session:
+            def __init__(self):
+                self.values = {}
+                self.commands = []
+            def putvalue(self, name, value):
+                self.values[name] = value
+            def run(self, command):
+                self.commands.append(command)
+            def getvalue(self, name):
+                return 'nmodel'
+        session = Session()
+        class Module:
+            session_factory = staticmethod(lambda: session)
+        mlb = dpm.mlb
+        dpm.mlb = Module
+        try:
+            backend = dpm.MatlabBackend()
+        finally:
+            dpm.mlb = mlb
+        self.assertTrue("addpath('" + dpm.matlabfolder + "')" in session.commands)
+        self.assertTrue(os.path.isfile(os.path.join(dpm.matlabfolder,
+                                                    'acd_examples.m')))
+        nmodel = backend.train(np.zeros(3), [('/p/a.png', [[[0,1],[9,19]]])],
+                               ['/n/neg_0.png'], 0, 0, 1, 10, 24000, 0.7, 0, False,
+                               "it's", 0.001)
+        self.assertEqual(nmodel, 'nmodel')
+        for name, value in session.values.items():
+            self.assertTrue(isinstance(value, np.ndarray), name)
+        self.assertEqual(session.values['posboxes'].tolist(), [[1, 1, 2, 10, 20]])
+        self.assertTrue('pos = acd_examples(posnames, posboxes);' in session.commands)
+        self.assertTrue('neg = acd_examples(negnames);' in session.commands)
+        self.assertTrue("tag = 'it''s';" in session.commands)
+
+    def test_detections_frommatlab(self):
+        ds = np.array([[1, 2, 10, 20, 1, 0.5], [5, 5, 7, 8, 1, 1.5]])
+        self.assertEqual(dpm.detections_frommatlab(ds, 5),
+                         [([[4,4],[6,7]], 1.5), ([[0,1],[9,19]], 0.5)])
+        self.assertEqual(dpm.detections_frommatlab(np.zeros([0,5]), 5), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+""" Unit tests for dpmidentification.py.
+"""
+import dpmidentification as dpmi
+import dpmscoring as dpms
+import test_cascade
+import test_dpmscoring
+import unittest
+import numpy as np
+import os.path
+import tempfile
+import shutil
+
+class TestDPMIdentification(unittest.TestCase):
+    def test_score_level(self):
+        # Models with roots and parts of different sizes, scored together
+        rng = np.random.RandomState(0)
+        models = [test_dpmscoring.random_model(rng) for i in range(0, 3)]
+        models[1].components[0].root = rng.randn(6, 2, 31)
+        models[2].components[1].parts = [dpms.Part(rng.randn(5, 4, 31), (1, 3),
+                                                   [0.2, 0.1, 0.7, -0.3])]
+        index = dpmi.ModelIndex(models, ['a', 'b', 'c'])
+        rootfeat = rng.randn(9, 8, 31)
+        partfeat = rng.randn(18, 16, 31)
+        scores = index.score_level(rootfeat, partfeat, 3, 2)
+        r = 0
+        for model in models:
+            for expected in dpms.score_level(model, rootfeat, partfeat, 3, 2):
+                actual = scores[r]
+                r += 1
+                rows, cols = expected.shape
+                self.assertTrue(np.all(np.isinf(actual[rows:])))
+                self.assertTrue(np.all(np.isinf(actual[:,cols:])))
+                actual = actual[0:rows,0:cols]
+                self.assertTrue(np.array_equal(np.isinf(expected), np.isinf(actual)))
+                finite = np.isfinite(expected)
+                self.assertTrue(np.allclose(expected[finite], actual[finite]))
+        self.assertEqual(r, scores.shape[0])
+
+    def test_identify(self):
+        rng = np.random.RandomState(2)
+        images = [rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+                  for i in range(0, 3)]
+        templates = [test_cascade.template_model(image) for image in images]
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            for name, (model, box) in zip(['asuka_langley', 'rei_ayanami', 'lain'],
+                                          templates):
+                dpms.savemodel(model, os.path.join(tmpfolder, name + '.dpm'))
+            identification = dpmi.DPMCharacterIdentification(tmpfolder)
+            self.assertEqual(identification.index.labels,
+                             ['asuka langley', 'lain', 'rei ayanami'])
+            canvas = np.zeros([200, 440, 3], dtype=np.uint8)
+            canvas[0:160,0:200] = images[0]
+            canvas[40:200,240:440] = images[1]
+            box = templates[0][1]
+            detections = [(box, 1.0),
+                          ([[box[0][0] + 240, box[0][1] + 40],
+                            [box[1][0] + 240, box[1][1] + 40]], 0.5)]
+            rankings = identification.identify(canvas, detections)
+        finally:
+            shutil.rmtree(tmpfolder)
+        self.assertEqual(rankings[0][0][0], 'asuka langley')
+        self.assertEqual(rankings[1][0][0], 'rei ayanami')
+        self.assertEqual([len(r) for r in rankings], [3, 3])
+        scores = [score for label, score in rankings[0]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        # Same score as the template model alone
+        model = templates[0][0]
+        expected = dpms.detect(model, model.pyramidbuilder().build(canvas), -np.inf, 1)
+        self.assertAlmostEqual(rankings[0][0][1], expected[0][1], places=4)
+        self.assertEqual(dpmi.labeled(detections, rankings),
+                         [(box, 1.0, 'asuka langley'),
+                          (detections[1][0], 0.5, 'rei ayanami')])
+
+if __name__ == '__main__':
+    unittest.main()
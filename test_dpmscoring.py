@@ -0,0 +1,188 @@
+""" Unit tests for dpmscoring.py.
+"""
+import dpmscoring as dpms
+import dpmDetection as dpmd
+import featpyramid as fp
+import unittest
+import numpy as np
+import os
+import os.path
+import pickle
+import tempfile
+import shutil
+
+def random_model(rng, nbparts=2):
+    parts = [dpms.Part(rng.randn(3, 2, 31), (rng.randint(0, 4), rng.randint(0, 4)),
+                       [rng.uniform(0.1, 1), rng.randn(), 
+                        rng.uniform(0.1, 1), rng.randn()])
+             for i in range(0, nbparts)]
+    return dpms.DPMModel([dpms.Component(rng.randn(4, 3, 31), parts, rng.randn()),
+                          dpms.Component(rng.randn(3, 3, 31), [], rng.randn())],
+                         sbin=8, interval=2)
+
+class TestDPMScoring(unittest.TestCase):
+    def test_convolve(self):
+        rng = np.random.RandomState(0)
+        feat = rng.randn(12, 9, 31)
+        filters = [rng.randn(3, 2, 31), rng.randn(4, 4, 31), rng.randn(3, 2, 31),
+                   rng.randn(13, 2, 31)]
+        for method in ['direct', 'fft']:
+            responses = dpms.convolve(feat, filters, method)
+            for filt, response in zip(filters, responses):
+                h, w = filt.shape[0:2]
+                self.assertEqual(response.shape, (max(13-h, 0), max(10-w, 0)))
+                for y in range(0, response.shape[0]):
+                    for x in range(0, response.shape[1]):
+                        self.assertAlmostEqual(response[y,x],
+                                               np.sum(feat[y:y+h,x:x+w] * filt))
+
+    def test_dt(self):
+        rng = np.random.RandomState(0)
+        score = rng.randn(7, 11) * 5
+        defcost = [0.3, -0.5, 1.2, 0.7]
+        m, ix, iy = dpms.dt2d(score, defcost)
+        for y in range(0, 7):
+            for x in range(0, 11):
+                py, px = np.mgrid[0:7, 0:11]
+                dx, dy = px - x, py - y
+                values = (score - defcost[0] * dx**2 - defcost[1] * dx
+                          - defcost[2] * dy**2 - defcost[3] * dy)
+                self.assertAlmostEqual(m[y,x], values.max())
+                self.assertAlmostEqual(values[iy[y,x], ix[y,x]], values.max())
+
+    def test_score_level(self):
+        rng = np.random.RandomState(1)
+        model = random_model(rng)
+        rootfeat = rng.randn(8, 7, 31)
+        partfeat = rng.randn(16, 14, 31)
+        padx, pady = 3, 2
+        scores = dpms.score_level(model, rootfeat, partfeat, padx, pady)
+        component = model.components[0]
+        root = dpms.convolve(rootfeat, [component.root])[0]
+        parts = dpms.convolve(partfeat, [p.filter for p in component.parts])
+        for y in range(0, root.shape[0]):
+            for x in range(0, root.shape[1]):
+                expected = root[y,x] + component.bias
+                for part, response in zip(component.parts, parts):
+                    # The upper left corner of the root is at (2y-pady, 2x-padx) in
+                    # the part map
+                    ay = 2*y - pady + part.anchor[1]
+                    ax = 2*x - padx + part.anchor[0]
+                    if not (0 <= ay < response.shape[0]
+                            and 0 <= ax < response.shape[1]):
+                        expected = -np.inf
+                        break
+                    py, px = np.mgrid[0:response.shape[0], 0:response.shape[1]]
+                    dx, dy = px - ax, py - ay
+                    expected += np.max(response - part.defcost[0] * dx**2 
+                                       - part.defcost[1] * dx
+                                       - part.defcost[2] * dy**2 
+                                       - part.defcost[3] * dy)
+                self.assertAlmostEqual(scores[0][y,x], expected)
+
+    def test_detect_template(self):
+        # A root filter made of the features of a part of the image should find it
+        rng = np.random.RandomState(2)
+        image = rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+        model = dpms.DPMModel([dpms.Component(np.zeros([5, 4, 31]), [], 0)], 8, 2)
+        pyramid = model.pyramidbuilder().build(image)
+        level = 2
+        self.assertEqual(pyramid.scales[level], 1)
+        y, x = 7, 9
+        model.components[0].root = pyramid.feat[level][y:y+5, x:x+4]
+        detections = dpms.detect(model, pyramid, -np.inf, 1)
+        [[ulx,uly],[drx,dry]], score = detections[0]
+        self.assertEqual([ulx,uly], [(x - pyramid.padx) * 8, (y - pyramid.pady) * 8])
+        self.assertEqual([drx,dry], [ulx + 4 * 8 - 1, uly + 5 * 8 - 1])
+        # Same through the backend, in parallel and with fft
+        backend = dpms.NativeBackend(2, 'fft')
+        backend.loadmodel(model)
+        self.assertEqual(backend.detect(image, -np.inf, 1)[0][0], 
+                         detections[0][0])
+        backend.close()
+        # Same with the model saved and mapped by the workers
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            detector = dpmd.DPMObjectDetection(1, lambda: dpms.NativeBackend(2))
+            detector.setModel(model)
+            filename = os.path.join(tmpfolder, 'model.dpm')
+            detector.saveModel(filename)
+            detector.setModel(filename)
+            self.assertEqual(detector.detectObject(image, -np.inf, 1)[0][0],
+                             detections[0][0])
+            detector.close()
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_detect_parts(self):
+        # A model whose root is blank and whose parts are made of the features of
+        # the image at known placements should find the root they are anchored to
+        rng = np.random.RandomState(2)
+        image = rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+        model = dpms.DPMModel([dpms.Component(np.zeros([6, 8, 31]), [], 0)], 8, 2)
+        pyramid = model.pyramidbuilder().build(image)
+        self.assertEqual((pyramid.padx, pyramid.pady), (7, 5))
+        self.assertEqual((pyramid.scales[2], pyramid.scales[0]), (1, 2))
+        y, x = 8, 11
+        partfeat = pyramid.feat[0]
+        parts = []
+        for ax, ay in [(0, 0), (6, 3), (12, 8)]:
+            py, px = 2 * y - pyramid.pady + ay, 2 * x - pyramid.padx + ax
+            parts.append(dpms.Part(partfeat[py:py+3,px:px+3], (ax, ay),
+                                   [10, 0, 10, 0]))
+        model.components[0].parts = parts
+        [(bbox, score)] = dpms.detect(model, pyramid, -np.inf, 1)
+        self.assertEqual(bbox, [[(x - pyramid.padx) * 8, (y - pyramid.pady) * 8],
+                                [(x - pyramid.padx) * 8 + 63,
+                                 (y - pyramid.pady) * 8 + 47]])
+        self.assertEqual(bbox, [[32, 24], [95, 71]])
+
+    def test_save_load(self):
+        rng = np.random.RandomState(3)
+        model = random_model(rng)
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpfolder, 'model.dpm')
+            dpms.savemodel(model, filename)
+            loaded = dpms.loadmodel(filename)
+            inmemory = dpms.loadmodel(filename, mmap=False)
+            # Weights are mapped read-only, and workers map the file in turn
+            root = loaded.components[0].root
+            self.assertEqual(root.dtype, np.float32)
+            self.assertFalse(root.flags.writeable)
+            self.assertTrue(inmemory.components[0].root.flags.writeable)
+            self.assertTrue(len(pickle.dumps(loaded, 2)) < 1000)
+            unpickled = pickle.loads(pickle.dumps(loaded, 2))
+            self.assertTrue(pickle.loads(pickle.dumps(loaded, 2)).components
+                            is unpickled.components)
+            self.assertTrue(len(pickle.dumps(inmemory, 2)) > root.nbytes)
+            # Workers refuse a file replaced since the model was mapped
+            pickled = pickle.dumps(loaded, 2)
+            otherfilename = os.path.join(tmpfolder, 'other.dpm')
+            dpms.savemodel(random_model(rng), otherfilename)
+            os.rename(otherfilename, filename)
+            dpms._mappedmodels.clear()
+            self.assertRaises(IOError, pickle.loads, pickled)
+            # Models of the previous format still load
+            npzfilename = os.path.join(tmpfolder, 'model.npz')
+            np.savez(npzfilename, sbin=8, interval=2, nbcomponents=1,
+                     comp0_root=model.components[1].root,
+                     comp0_bias=model.components[1].bias, comp0_nbparts=0)
+            legacy = dpms.loadmodel(npzfilename)
+            self.assertTrue(np.array_equal(legacy.components[0].root,
+                                           model.components[1].root))
+            feat = rng.randn(10, 10, 31)
+            partfeat = rng.randn(20, 20, 31)
+            expected = dpms.score_level(model, feat, partfeat, 2, 2)
+            for other in [loaded, inmemory, unpickled]:
+                for e, actual in zip(expected,
+                                     dpms.score_level(other, feat, partfeat, 2, 2)):
+                    self.assertTrue(np.array_equal(np.isinf(e), np.isinf(actual)))
+                    finite = np.isfinite(e)
+                    self.assertTrue(np.allclose(e[finite], actual[finite], rtol=1e-5,
+                                                atol=1e-4))
+        finally:
+            shutil.rmtree(tmpfolder)
+
+if __name__ == '__main__':
+    unittest.main()
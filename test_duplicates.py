@@ -0,0 +1,85 @@
+""" Unit tests for duplicates.py.
+"""
+import duplicates
+import unittest
+import cv2
+import numpy as np
+import os
+import os.path
+import tempfile
+import shutil
+
+def artwork(seed, rows=300, cols=400):
+    """ Smooth random image standing for an artwork.
+    """
+    rng = np.random.RandomState(seed)
+    noise = rng.randint(0, 256, [rows // 5, cols // 5, 3]).astype(np.uint8)
+    return cv2.resize(cv2.GaussianBlur(noise, (0, 0), 3), (cols, rows))
+
+class TestDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpfolder)
+
+    def test_phash(self):
+        image = artwork(0)
+        h = duplicates.phash(image)
+        self.assertTrue(0 <= h < 2**64)
+        jpeg = cv2.imdecode(cv2.imencode('.jpg', image,
+                                         [cv2.IMWRITE_JPEG_QUALITY, 40])[1], 1)
+        for copy in [cv2.resize(image, (200, 150)), jpeg,
+                     cv2.convertScaleAbs(image, alpha=1.1, beta=10)]:
+            self.assertTrue(duplicates.hamming(h, duplicates.phash(copy)) <= 4)
+        for seed in range(1, 10):
+            self.assertTrue(duplicates.hamming(h, duplicates.phash(artwork(seed)))
+                            > 16)
+
+    def test_bktree(self):
+        rng = np.random.RandomState(0)
+        # Hashes in a few tight clusters, plus random ones
+        centers = [int(c) for c in rng.randint(0, 2**62, 10)]
+        hashes = [c ^ (1 << int(rng.randint(0, 64))) ^ (1 << int(rng.randint(0, 64)))
+                  for c in centers for i in range(0, 20)]
+        hashes += [int(h) for h in rng.randint(0, 2**62, 300)]
+        tree = duplicates.BKTree()
+        for i, h in enumerate(hashes):
+            tree.add(h, i)
+        self.assertEqual(len(tree), len(hashes))
+        for radius in [0, 3, 8, 20]:
+            for query in hashes[0:400:37]:
+                expected = sorted([(duplicates.hamming(query, h), i)
+                                   for i, h in enumerate(hashes)
+                                   if duplicates.hamming(query, h) <= radius])
+                self.assertEqual(tree.search(query, radius), expected)
+
+    def test_index_clusters(self):
+        images = {
+            'a_0.png': artwork(0),
+            'a_1.jpg': cv2.resize(artwork(0), (300, 225)),
+            'a_2.png': cv2.convertScaleAbs(artwork(0), alpha=0.9, beta=5),
+            'b_0.png': artwork(1),
+            'b_1.jpg': artwork(1),
+            'c_0.png': artwork(2)
+            }
+        for filename, image in images.items():
+            cv2.imwrite(os.path.join(self.tmpfolder, filename), image)
+        hashfile = os.path.join(self.tmpfolder, 'cache', 'phash.json')
+        index = duplicates.open_index(self.tmpfolder, hashfile)
+        self.assertEqual(len(index), 6)
+        self.assertEqual(index.clusters(),
+                         [['a_0.png', 'a_1.jpg', 'a_2.png'], ['b_0.png', 'b_1.jpg']])
+        self.assertEqual(index.near(duplicates.phash(artwork(2)))[0], (0, 'c_0.png'))
+        # Only modified and new images are hashed again
+        cv2.imwrite(os.path.join(self.tmpfolder, 'c_0.png'), artwork(1))
+        os.utime(os.path.join(self.tmpfolder, 'c_0.png'), (0, 1))
+        os.remove(os.path.join(self.tmpfolder, 'a_2.png'))
+        index = duplicates.HashIndex(self.tmpfolder)
+        self.assertTrue(index.load(hashfile))
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.clusters(),
+                         [['b_0.png', 'b_1.jpg', 'c_0.png'], ['a_0.png', 'a_1.jpg']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+""" Unit tests for evaluation.py.
+"""
+import evaluation
+import geometry
+import test_geometry
+import unittest
+import numpy as np
+import os.path
+import tempfile
+import shutil
+
+def reference_match(detections, bboxes, minoverlap):
+    """ Detection by detection matching of one image, as in the VOC devkit.
+    """
+    matched = [False] * len(bboxes)
+    truepositives = []
+    for bbox, score in sorted(detections, key=lambda d: -d[1]):
+        ious = [geometry.pairwise_iou(geometry.toarray([bbox]),
+                                      geometry.toarray([b]))[0,0] for b in bboxes]
+        j = int(np.argmax(ious)) if ious != [] else -1
+        if j >= 0 and ious[j] >= minoverlap and not matched[j]:
+            matched[j] = True
+            truepositives.append((score, True))
+        else:
+            truepositives.append((score, False))
+    return truepositives
+
+def random_dataset(rng, nbimages, nbdetections):
+    """ Ground truth boxes and detections around them, with labels named after the
+        characters of the images.
+    """
+    groundtruth = {}
+    detections = {}
+    for i in range(0, nbimages):
+        stem = ['alice', 'bob', 'carol'][i % 3] + '_' + repr(i)
+        groundtruth[stem] = geometry.fromarray(test_geometry.random_boxes(
+            rng, rng.randint(0, 4)))
+        boxes = test_geometry.random_boxes(rng, nbdetections)
+        for k, bbox in enumerate(groundtruth[stem]):
+            # Some close detections, competing for the same boxes
+            boxes[k] = np.array(bbox).ravel() + rng.randint(-3, 4, 4)
+            boxes[-k-1] = np.array(bbox).ravel() + rng.randint(-3, 4, 4)
+        detections[stem] = [(bbox, float(score)) for bbox, score
+                            in zip(geometry.fromarray(boxes),
+                                   rng.randint(0, 50, nbdetections))]
+    return detections, groundtruth
+
+class TestEvaluation(unittest.TestCase):
+    def test_match(self):
+        rng = np.random.RandomState(0)
+        detections, groundtruth = random_dataset(rng, 30, 8)
+        evalset = evaluation.EvaluationSet(detections, groundtruth)
+        truepositives, matched = evaluation.match(
+            evalset.detimages, evalset.detboxes, evalset.scores, evalset.gtimages,
+            evalset.gtboxes, 0.5)
+        self.assertTrue(np.array_equal(truepositives, matched >= 0))
+        self.assertEqual(np.unique(matched[truepositives]).size,
+                         np.sum(truepositives))
+        for i, stem in enumerate(evalset.stems):
+            mask = evalset.detimages == i
+            # Equal scores are visited in their original order by both
+            expected = reference_match(detections[stem], groundtruth[stem], 0.5)
+            order = np.argsort(-evalset.scores[mask], kind='mergesort')
+            self.assertEqual(truepositives[mask][order].tolist(),
+                             [tp for score, tp in expected])
+            self.assertTrue(np.all(evalset.gtimages[matched[mask & truepositives]]
+                                   == i))
+
+    def test_average_precision(self):
+        precision, recall = evaluation.precision_recall([3, 2, 1],
+                                                        [True, True, False], 2)
+        self.assertEqual(evaluation.average_precision(precision, recall), 1)
+        self.assertEqual(evaluation.average_precision(
+            *evaluation.precision_recall([], [], 2)), 0)
+        # Precision 1 at recall 1/2, then 2/3 at recall 1
+        precision, recall = evaluation.precision_recall([1, 3, 2],
+                                                        [True, True, False], 2)
+        self.assertTrue(np.allclose(precision, [1, 0.5, 2. / 3]))
+        self.assertTrue(np.allclose(recall, [0.5, 0.5, 1]))
+        self.assertAlmostEqual(evaluation.average_precision(precision, recall),
+                               0.5 + 0.5 * 2. / 3)
+        self.assertAlmostEqual(evaluation.average_precision(precision, recall,
+                                                            'voc2007'),
+                               (6 + 5 * 2. / 3) / 11)
+        # Missed boxes cap recall
+        self.assertAlmostEqual(evaluation.average_precision(
+            *evaluation.precision_recall([1], [True], 4)), 0.25)
+
+    def test_evaluate_characters(self):
+        rng = np.random.RandomState(1)
+        detections, groundtruth = random_dataset(rng, 30, 5)
+        results = evaluation.evaluate_characters(detections, groundtruth)
+        self.assertEqual(sorted(results.keys()), ['alice', 'bob', 'carol'])
+        for character, result in results.items():
+            stems = [s for s in groundtruth if s.startswith(character)]
+            expected = evaluation.evaluate(
+                dict([(s, detections[s]) for s in stems]),
+                dict([(s, groundtruth[s]) for s in stems]))
+            self.assertEqual(result['ap'], expected['ap'])
+            self.assertEqual(result['nbpositives'],
+                             sum([len(groundtruth[s]) for s in stems]))
+        # Detections labeled with the wrong character are false positives
+        labeled = dict([(stem, [(bbox, score, 'alice') for bbox, score in ds])
+                        for stem, ds in detections.items()])
+        results = evaluation.evaluate_characters(labeled, groundtruth)
+        self.assertEqual(results['bob']['nbdetections'], 0)
+        self.assertEqual(results['bob']['ap'], 0)
+        self.assertEqual(results['alice']['nbdetections'], 30 * 5)
+        self.assertTrue(results['alice']['ap'] < evaluation.evaluate_characters(
+            detections, groundtruth)['alice']['ap'])
+
+    def test_save_load(self):
+        detections = {'alice_0': [([[1,2],[3,4]], 2.5, 'alice'),
+                                  ([[0,0],[9,9]], -1.0, 'bob')],
+                      'bob_1': []}
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpfolder, 'detections.jsonl')
+            evaluation.save_detections(detections, filename)
+            loaded = evaluation.load_detections(filename)
+        finally:
+            shutil.rmtree(tmpfolder)
+        self.assertEqual(loaded, detections)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+""" Unit tests for featpyramid.py.
+"""
+import featpyramid as fp
+import unittest
+import numpy as np
+import os
+import os.path
+import tempfile
+import shutil
+
+# Generated by scripts/hogreference.py.
+referencefilename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testdata', 'hog_reference.npz')
+
+class TestFeatPyramid(unittest.TestCase):
+    def test_features_reference(self):
+        reference = np.load(referencefilename)
+        hog = fp.HOGComputer()
+        # Same computer for all images and cell sizes, to check reusing buffers does
+        # not mess up results.
+        for i in range(0,2):
+            image = reference['image_' + repr(i)]
+            for sbin in [4, 8]:
+                expected = reference['feat_' + repr(i) + '_' + repr(sbin)]
+                feat = hog.features(image, sbin)
+                self.assertEqual(feat.shape, expected.shape)
+                self.assertTrue(np.allclose(feat, expected, rtol=1e-7, atol=1e-10))
+
+    def test_pyramid(self):
+        rng = np.random.RandomState(0)
+        image = rng.randint(0, 256, [120, 160, 3]).astype(np.uint8)
+        builder = fp.PyramidBuilder(sbin=8, interval=4, padx=2, pady=3)
+        pyramid = builder.build(image)
+        # 1 + floor(log2(120/40) * 4) scales after the first octave
+        self.assertEqual(len(pyramid), 7 + 4)
+        self.assertTrue(np.allclose(pyramid.scales[0:5], 
+                                    [2, 2**0.75, 2**0.5, 2**0.25, 1]))
+        self.assertTrue(np.all(np.diff(pyramid.scales) < 0))
+        level = pyramid.feat[4]
+        self.assertEqual(level.shape, (15 - 2 + 2 * 4, 20 - 2 + 2 * 3, 31))
+        self.assertTrue(np.array_equal(level[4:-4,3:-3], fp.features(image, 8)))
+        self.assertEqual(np.abs(level[0:4]).sum(), 0)
+        # Second build of the same image comes from the cache
+        self.assertTrue(builder.build(image.copy()) is pyramid)
+        self.assertEqual((builder.hits, builder.misses), (1, 1))
+        # Memory estimate, up to rounding of the sizes of the scaled images
+        featbytes = sum([f.nbytes for f in pyramid.feat])
+        workbytes = fp.workbytesperpixel * image.shape[0] * image.shape[1]
+        self.assertTrue(abs(builder.nbbytes(120, 160) - workbytes - featbytes)
+                        < 0.02 * featbytes)
+
+    def test_store(self):
+        rng = np.random.RandomState(0)
+        image = rng.randint(0, 256, [90, 120, 3]).astype(np.uint8)
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            store = fp.PyramidStore(tmpfolder)
+            builder = fp.PyramidBuilder(sbin=8, interval=4, padx=2, pady=3,
+                                        cachesize=0, store=store)
+            expected = builder.build(image)
+            # Another builder, e.g. in another process, loads it from the store
+            other = fp.PyramidBuilder(sbin=8, interval=4, padx=2, pady=3,
+                                      cachesize=0, store=fp.PyramidStore(tmpfolder))
+            pyramid = other.build(image.copy())
+            self.assertEqual(other.store.hits, 1)
+            self.assertEqual(len(pyramid), len(expected))
+            self.assertTrue(np.array_equal(pyramid.scales, expected.scales))
+            self.assertEqual(pyramid.imsize, expected.imsize)
+            for f, e in zip(pyramid.feat, expected.feat):
+                self.assertTrue(np.array_equal(f, e))
+                self.assertFalse(f.flags.writeable)
+            # Pyramids with another padding are stored separately
+            padded = fp.PyramidBuilder(sbin=8, interval=4, padx=3, pady=3,
+                                       cachesize=0, store=store)
+            self.assertEqual(padded.build(image).feat[0].shape[1],
+                             expected.feat[0].shape[1] + 2)
+            self.assertEqual(len(os.listdir(tmpfolder)), 4)
+        finally:
+            shutil.rmtree(tmpfolder)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+""" Unit tests for folds.py.
+"""
+import folds
+import negatives as neg
+import test_negatives
+import unittest
+import cv2
+import json
+import os
+import os.path
+import numpy as np
+import tempfile
+import shutil
+
+class TestFolds(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.imagesfolder, self.bboxesfolder, outfolder = (
+            test_negatives.TestNegatives('make_dataset').make_dataset(self.tmpfolder,
+                                                                      7))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpfolder)
+
+    def test_split(self):
+        names = ['img_' + repr(i) for i in range(0, 11)]
+        split = folds.split(names, 3, seed=4)
+        self.assertEqual([len(f) for f in split], [4, 4, 3])
+        self.assertEqual(sorted(sum(split, [])), sorted(names))
+        self.assertEqual(folds.split(names, 3, seed=4), split)
+        self.assertNotEqual(folds.split(names, 3, seed=5), split)
+        self.assertRaises(ValueError, folds.split, names, 1)
+
+    def test_manifest(self):
+        stems = ['img_' + repr(i) for i in range(0, 7)]
+        for mode in neg.outputmodes:
+            negfolder = os.path.join(self.tmpfolder, 'negatives_' + mode)
+            os.makedirs(negfolder)
+            neg.batch_negatives(self.imagesfolder, self.bboxesfolder, negfolder,
+                                mode=mode)
+            manifest = folds.FoldManifest.build(3, self.imagesfolder, negfolder,
+                                                seed=0)
+            filename = os.path.join(self.tmpfolder, 'folds_' + mode, 'folds.json')
+            os.makedirs(os.path.dirname(filename))
+            manifest.save(filename)
+            loaded = folds.open_folds(os.path.dirname(filename))
+            self.assertEqual(loaded.folds, manifest.folds)
+            self.assertEqual(loaded.seed, 0)
+            self.assertEqual(os.path.abspath(loaded.negativesfolder),
+                             os.path.abspath(negfolder))
+            self.assertEqual(sorted(loaded.stems(range(0, 3))), stems)
+            # Positives and negatives of each fold only come from its images
+            for fold in range(0, 3):
+                foldstems = loaded.stems([fold])
+                positives = list(loaded.positives([fold]))
+                self.assertEqual([stem for stem, f in positives], foldstems)
+                self.assertTrue(all([os.path.isfile(f) for stem, f in positives]))
+                negatives = list(loaded.negatives([fold]))
+                self.assertTrue(len(negatives) >= len(foldstems))
+                for (stem, i), patch in negatives:
+                    self.assertTrue(stem in foldstems)
+                    image = cv2.imread(os.path.join(self.imagesfolder,
+                                                    stem + '.jpg'))
+                    bboxesfile = open(os.path.join(self.bboxesfolder,
+                                                   stem + '_bb.json'))
+                    bboxes = json.load(bboxesfile)
+                    bboxesfile.close()
+                    self.assertTrue(np.array_equal(
+                            patch, neg.negative_samples(image, bboxes)[i]))
+            self.assertEqual(loaded.complement([1]), [0, 2])
+
+    def test_export_symlinks(self):
+        negfolder = os.path.join(self.tmpfolder, 'negatives')
+        os.makedirs(negfolder)
+        neg.batch_negatives(self.imagesfolder, self.bboxesfolder, negfolder)
+        manifest = folds.FoldManifest.build(2, self.imagesfolder, negfolder, seed=1)
+        outfolder = os.path.join(self.tmpfolder, 'folds')
+        folds.export_symlinks(manifest, outfolder)
+        for fold in range(0, 2):
+            posfolder = os.path.join(outfolder, repr(fold), 'positives')
+            self.assertEqual(sorted(os.listdir(posfolder)),
+                             sorted(manifest.folds[fold]))
+            negatives = sorted(os.listdir(os.path.join(outfolder, repr(fold),
+                                                       'negatives')))
+            self.assertEqual(negatives, sorted([os.path.basename(f) for stem, f
+                                                in manifest.negativefiles([fold])]))
+        # The symlink layout can be read back, positives only
+        legacy = folds.open_folds(outfolder)
+        self.assertEqual([sorted(f) for f in legacy.folds],
+                         [sorted(f) for f in manifest.folds])
+        self.assertEqual(os.path.realpath(legacy.positivesfolder),
+                         os.path.realpath(self.imagesfolder))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+""" Unit tests for geometry.py.
+"""
+import geometry
+import negatives as neg
+import unittest
+import numpy as np
+
+def random_boxes(rng, n, size=100):
+    ul = rng.randint(0, size, [n, 2])
+    return np.concatenate([ul, ul + rng.randint(0, size // 2, [n, 2])], axis=1)
+
+def reference_nms(boxes, scores, overlap):
+    """ Box by box greedy suppression.
+    """
+    keep = []
+    for i in np.argsort(-scores, kind='mergesort'):
+        if all([geometry.pairwise_iou(boxes[[i]], boxes[[k]])[0,0] <= overlap
+                for k in keep]):
+            keep.append(i)
+    return keep
+
+class TestGeometry(unittest.TestCase):
+    def test_pairwise(self):
+        rng = np.random.RandomState(0)
+        boxes1 = random_boxes(rng, 30)
+        boxes2 = random_boxes(rng, 20)
+        overlaps = geometry.pairwise_overlapping(boxes1, boxes2)
+        inter = geometry.pairwise_intersection_areas(boxes1, boxes2)
+        iou = geometry.pairwise_iou(boxes1, boxes2)
+        bboxes1 = geometry.fromarray(boxes1)
+        bboxes2 = geometry.fromarray(boxes2)
+        for i in range(0, 30):
+            for j in range(0, 20):
+                overlapping = neg.overlapping(bboxes1[i], bboxes2[j])
+                self.assertEqual(overlaps[i,j], overlapping)
+                self.assertEqual(inter[i,j] > 0, overlapping)
+                if overlapping:
+                    [[ulx,uly],[drx,dry]] = neg.intersection(bboxes1[i], bboxes2[j])
+                    self.assertEqual(inter[i,j], (drx - ulx + 1) * (dry - uly + 1))
+                union = (geometry.areas(boxes1[[i]]) + geometry.areas(boxes2[[j]])
+                         - inter[i,j])
+                self.assertAlmostEqual(iou[i,j], inter[i,j] / float(union[0]))
+        # Row by row versions agree with the diagonal
+        self.assertTrue(np.array_equal(
+            geometry.overlapping(boxes1[0:20], boxes2), np.diag(overlaps)))
+        self.assertTrue(np.allclose(geometry.iou(boxes1[0:20], boxes2), np.diag(iou)))
+
+    def test_nms(self):
+        rng = np.random.RandomState(1)
+        for n, blocksize in [(0, 4), (1, 4), (50, 4), (300, 7), (300, 256)]:
+            boxes = random_boxes(rng, n)
+            # Some ties, to check they are kept in order
+            scores = rng.randint(0, 20, n).astype(np.float64)
+            keep = geometry.nms(boxes, scores, 0.3, blocksize=blocksize)
+            self.assertEqual(keep.tolist(), reference_nms(boxes, scores, 0.3))
+            self.assertEqual(geometry.nms(boxes, scores, 0.3, max_num=5).tolist(),
+                             keep[0:5].tolist())
+
+    def test_batch(self):
+        # Suppressing a batch in one call is the same as image by image
+        rng = np.random.RandomState(2)
+        batch = []
+        for n in [10, 0, 40, 25]:
+            batch.append([(bbox, float(score)) for bbox, score
+                          in zip(geometry.fromarray(random_boxes(rng, n)),
+                                 rng.rand(n))])
+        kept = geometry.nms_detections(batch, 0.4, max_num=8)
+        for detections, imagekept in zip(batch, kept):
+            if detections == []:
+                self.assertEqual(imagekept, [])
+                continue
+            boxes = geometry.toarray([bbox for bbox, score in detections])
+            scores = np.array([score for bbox, score in detections])
+            expected = geometry.nms(boxes, scores, 0.4, max_num=8)
+            self.assertEqual(imagekept, [detections[k] for k in expected])
+
+    def test_soft_nms(self):
+        rng = np.random.RandomState(3)
+        boxes = random_boxes(rng, 200)
+        scores = rng.rand(200)
+        # Greedy decay amounts to nms
+        keep, kept = geometry.soft_nms(boxes, scores, overlap=0.3, method='greedy',
+                                       minscore=1e-9)
+        self.assertEqual(sorted(keep.tolist()),
+                         sorted(geometry.nms(boxes, scores, 0.3).tolist()))
+        for method in ['linear', 'gaussian']:
+            keep, kept = geometry.soft_nms(boxes, scores, method=method)
+            self.assertTrue(np.all(np.diff(kept) <= 0))
+            self.assertTrue(np.all(kept <= scores[keep]))
+            self.assertEqual(len(set(keep.tolist())), keep.size)
+        # Boxes of different groups do not decay each other
+        keep, kept = geometry.soft_nms(np.tile(boxes[0:1], [3, 1]), [0.9, 0.8, 0.7],
+                                       method='gaussian', groups=[0, 1, 2])
+        self.assertTrue(np.allclose(kept, [0.9, 0.8, 0.7]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+""" Unit tests for hardnegatives.py, using the stub detection backend.
+"""
+import hardnegatives as hn
+import dpmDetection as dpm
+import negatives as neg
+import unittest
+import numpy as np
+import cv2
+import os
+import os.path
+import tempfile
+import shutil
+
+def square_detector(image, model):
+    """ Detects the bright square of an image, scoring its brightness minus the
+        model, a number.
+    """
+    ys, xs = np.nonzero(image[:,:,0] > 0)
+    if ys.size == 0:
+        return []
+    return [([[int(xs.min()), int(ys.min())], [int(xs.max()), int(ys.max())]],
+             image[ys[0],xs[0],0] / 255. - model)]
+
+def square_patch(brightness):
+    patch = np.zeros([60, 80, 3], dtype=np.uint8)
+    patch[20:30,30:40] = brightness
+    return patch
+
+class TestHardNegatives(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.detector = dpm.DPMObjectDetection(
+            2, lambda: dpm.StubBackend(square_detector))
+        self.detector.setModel(0.0)
+
+    def tearDown(self):
+        self.detector.close()
+        shutil.rmtree(self.tmpfolder)
+
+    def test_cache(self):
+        cache = hn.HardNegativeCache(3)
+        self.assertEqual(cache.minscore(), -np.inf)
+        for i, score in enumerate([0.5, 0.1, 0.9, 0.3, 0.7, 0.2]):
+            cache.push(hn.HardNegative(('a', i), [[0,0],[9,9]], score, None))
+        self.assertEqual([n.score for n in cache.negatives()], [0.9, 0.7, 0.5])
+        self.assertEqual(cache.minscore(), 0.5)
+        self.assertFalse(cache.push(hn.HardNegative(('b', 0), [[0,0],[9,9]], 0.4,
+                                                    None)))
+        # A detection already cached is not pushed again, unless evicted
+        self.assertFalse(cache.push(hn.HardNegative(('a', 2), [[0,0],[9,9]], 1.0,
+                                                    None)))
+        self.assertTrue(cache.push(hn.HardNegative(('a', 2), [[1,1],[9,9]], 1.0,
+                                                   None)))
+        self.assertTrue(cache.push(hn.HardNegative(('a', 0), [[0,0],[9,9]], 0.8,
+                                                   None)))
+        self.assertEqual([n.key for n in cache.negatives()],
+                         [('a', 2), ('a', 2), ('a', 0)])
+
+    def test_mine(self):
+        # Negative patches as written by negatives.py, each with a square
+        brightness = np.random.RandomState(0).permutation(np.arange(10, 250, 10))
+        for i, b in enumerate(brightness):
+            cv2.imwrite(os.path.join(self.tmpfolder,
+                                     neg.negative_filename('img_' + repr(i), 0)),
+                        square_patch(b))
+        patches = hn.negative_patches(self.tmpfolder)
+        miner = hn.HardNegativeMiner(self.detector, hn.HardNegativeCache(5),
+                                     thresh=0, batchsize=4)
+        # Scanning is bounded by the budget, and resumes where it stopped
+        self.assertEqual(miner.scan(patches, 10), 10)
+        self.assertEqual(miner.scan(patches, 100), len(brightness) - 10)
+        cached = miner.cache.negatives()
+        self.assertEqual([int(round(n.score * 255)) for n in cached],
+                         sorted(brightness)[::-1][0:5])
+        for n in cached:
+            self.assertEqual(n.bbox, [[30,20],[39,29]])
+            # Crops keep half the size of the square around it
+            self.assertEqual(n.crop.shape, (20, 20, 3))
+        # With a new model, negatives not detected anymore are dropped
+        self.detector.setModel(225 / 255.)
+        miner.rescore()
+        self.assertEqual(len(miner.cache), 2)
+        filenames = hn.write_negatives(miner.cache, os.path.join(self.tmpfolder,
+                                                                 'hard'))
+        self.assertEqual(len(filenames), 2)
+        self.assertEqual(cv2.imread(filenames[0])[10,10,0], 240)
+
+    def test_train_with_mining(self):
+        for i in range(0, 6):
+            cv2.imwrite(os.path.join(self.tmpfolder,
+                                     neg.negative_filename('img_' + repr(i), 0)),
+                        square_patch(40 * (i + 1)))
+        trained = []
+        def train(backend, model, pos, negs, *args):
+            trained.append(negs)
+            return model + 0.1
+        def factory():
+            backend = dpm.StubBackend(square_detector)
+            backend.train = lambda *args: train(backend, *args)
+            return backend
+        detector = dpm.DPMObjectDetection(1, factory)
+        model = hn.train_with_mining(detector, 0.0, [], self.tmpfolder,
+                                     os.path.join(self.tmpfolder, 'hard'), 3, 2, 4,
+                                     0, 1, 1, 100, 0.7, 10, False, 'test', 0.01,
+                                     thresh=0)
+        detector.close()
+        self.assertAlmostEqual(model, 0.3)
+        # Each round trains on the cache only
+        self.assertEqual([len(negs) for negs in trained], [2, 2, 2])
+
+    def test_mining_small_source(self):
+        # Fewer patches than the budget, so each round scans them all again
+        for i in range(0, 3):
+            cv2.imwrite(os.path.join(self.tmpfolder,
+                                     neg.negative_filename('img_' + repr(i), 0)),
+                        square_patch(40 * (i + 1)))
+        trained = []
+        def train(model, pos, negs, *args):
+            trained.append(negs)
+            return model
+        def factory():
+            backend = dpm.StubBackend(square_detector)
+            backend.train = train
+            return backend
+        detector = dpm.DPMObjectDetection(1, factory)
+        hn.train_with_mining(detector, 0.0, [], self.tmpfolder,
+                             os.path.join(self.tmpfolder, 'hard'), 2, 10, 10, 0, 1, 1,
+                             100, 0.7, 10, False, 'test', 0.01, thresh=0)
+        detector.close()
+        for negs in trained:
+            keys = [os.path.basename(f).split('_', 2)[2] for f in negs]
+            self.assertEqual(sorted(keys), sorted(set(keys)))
+            self.assertEqual(len(keys), 3)
+
+if __name__ == '__main__':
+    unittest.main()
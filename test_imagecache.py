@@ -0,0 +1,96 @@
+""" Unit tests for imagecache.py.
+"""
+import imagecache
+import unittest
+import cv2
+import numpy as np
+import os
+import os.path
+import tempfile
+import shutil
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.filenames = []
+        for i in range(0,3):
+            filename = os.path.join(self.tmpfolder, 'img_' + repr(i) + '.png')
+            cv2.imwrite(filename, rng.randint(0, 255, [20, 30, 3]).astype(np.uint8))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpfolder)
+
+    def test_memory_lru(self):
+        # Room for exactly 2 images in memory
+        cache = imagecache.ImageCache(None, 2 * 20 * 30 * 3)
+        for filename in self.filenames[0:2] + self.filenames[0:1]:
+            image = cache.imread(filename)
+            self.assertTrue(np.array_equal(image, cv2.imread(filename)))
+        self.assertEqual(cache.stats()['hits'], 1)
+        # Reading the 3rd evicts the 2nd, least recently used one
+        cache.imread(self.filenames[2])
+        cache.imread(self.filenames[0])
+        cache.imread(self.filenames[1])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 4))
+        self.assertEqual(stats['bytessaved'], 2 * 20 * 30 * 3)
+        self.assertFalse(cache.imread(self.filenames[0]).flags.writeable)
+
+    def test_disk_cache(self):
+        cachefolder = os.path.join(self.tmpfolder, 'cache')
+        imagecache.ImageCache(cachefolder).imread(self.filenames[0])
+        # A new cache, e.g. in another process, should find it on disk
+        cache = imagecache.ImageCache(cachefolder)
+        image = cache.imread(self.filenames[0])
+        self.assertTrue(np.array_equal(image, cv2.imread(self.filenames[0])))
+        self.assertEqual(cache.stats()['diskhits'], 1)
+        # Modifying the image should invalidate it
+        stat = os.stat(self.filenames[0])
+        os.utime(self.filenames[0], (stat.st_atime, stat.st_mtime + 10))
+        cache.imread(self.filenames[0])
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.imread(os.path.join(self.tmpfolder, 'none.png')), 
+                         None)
+
+    def test_disk_budget(self):
+        filename = os.path.join(self.tmpfolder, 'img_3.png')
+        cv2.imwrite(filename, cv2.imread(self.filenames[0])[::-1])
+        filenames = self.filenames + [filename]
+        cachefolder = os.path.join(self.tmpfolder, 'cache')
+        cache = imagecache.ImageCache(cachefolder)
+        diskfilenames = [cache.diskfilename(cache.key(f)) for f in filenames]
+        cache.imread(filenames[0])
+        nbbytes = os.path.getsize(diskfilenames[0])
+        # Room for 3 files, the first ones being used longer ago
+        cache = imagecache.ImageCache(cachefolder, 0, 3 * nbbytes)
+        for i in [1, 2]:
+            cache.imread(filenames[i])
+        for i, age in [(0, 30), (1, 20), (2, 10)]:
+            stat = os.stat(diskfilenames[i])
+            os.utime(diskfilenames[i], (stat.st_atime - age, stat.st_mtime - age))
+        # A disk hit makes the first image the most recently used one, and the 4th
+        # prunes the least recently used down to 3/4 of the budget
+        cache.imread(filenames[0])
+        self.assertEqual(cache.stats()['diskhits'], 1)
+        cache.imread(filenames[3])
+        self.assertEqual(sorted(os.listdir(cachefolder)),
+                         sorted([os.path.basename(diskfilenames[i]) for i in [0, 3]]))
+        self.assertEqual(cache.diskbytes, 2 * nbbytes)
+        self.assertEqual(imagecache.prune(cachefolder, None), 2 * nbbytes)
+        self.assertEqual(imagecache.prune(cachefolder, nbbytes), nbbytes)
+
+    def test_configure(self):
+        defaultcache = imagecache.defaultcache
+        try:
+            cache = imagecache.configure(maxbytes=0, cachefolder=None)
+            self.assertTrue(imagecache.getcache() is cache)
+            imagecache.imread(self.filenames[0])
+            imagecache.imread(self.filenames[0])
+            self.assertEqual(cache.stats()['misses'], 2)
+        finally:
+            imagecache.defaultcache = defaultcache
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+""" Unit tests for instrumentation.py.
+"""
+import instrumentation as instr
+import negatives as neg
+import dpmDetection as dpmd
+import test_negatives
+import unittest
+import json
+import os
+import os.path
+import numpy as np
+import tempfile
+import shutil
+
+class FakeSession:
+    def __init__(self):
+        self.values = {}
+
+    def putvalue(self, name, value):
+        self.values[name] = value
+
+    def run(self, command):
+        pass
+
+    def getvalue(self, name):
+        return self.values[name]
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        instr.disable()
+        shutil.rmtree(self.tmpfolder)
+
+    def test_disabled(self):
+        instr.disable()
+        self.assertFalse(instr.enabled())
+        # The same timer doing nothing for all stages
+        with instr.timer('a', 10) as t:
+            t.nbytes = 5
+        self.assertTrue(instr.timer('b') is t)
+        instr.count('c')
+        self.assertEqual(instr.collect(), None)
+
+    def test_recorder(self):
+        recorder = instr.Recorder()
+        for seconds in [1e-7, 1e-3, 1.5e-3, 0.1]:
+            recorder.record('stage', seconds, 100)
+        recorder.count('items', 3)
+        other = instr.Recorder()
+        other.record('stage', 2.0, 50)
+        other.record('other', 1e-3)
+        other.count('items')
+        recorder.merge(other.collect())
+        self.assertEqual(other.stages, {})
+        summary = instr.summarize(recorder.collect())
+        stage = summary['stages']['stage']
+        self.assertEqual((stage['count'], stage['bytes']), (5, 450))
+        self.assertAlmostEqual(stage['total'], 2.1025001)
+        self.assertEqual((stage['min'], stage['max']), (1e-7, 2.0))
+        self.assertEqual(sum([n for bound, n in stage['histogram']]), 5)
+        # Each latency is at most the upper bound of its bin, and more than half of
+        # it
+        bounds = [bound for bound, n in stage['histogram']]
+        self.assertEqual(bounds, sorted(bounds))
+        for seconds in [1e-3, 1.5e-3, 0.1, 2.0]:
+            bound = instr.firstbin * 2 ** instr._bin(seconds)
+            self.assertTrue(bound / 2 < seconds <= bound * (1 + 1e-9))
+        # The median 1.5e-3 is in the bin up to 2.048e-3
+        self.assertEqual(stage['p50'], instr.firstbin * 2 ** 11)
+        self.assertTrue(stage['p99'] >= 2.0)
+        self.assertEqual(summary['counters'], {'items': 4})
+
+    def test_negatives(self):
+        imagesfolder, bboxesfolder, outfolder = test_negatives.TestNegatives(
+            'make_dataset').make_dataset(self.tmpfolder)
+        filename = os.path.join(self.tmpfolder, 'summary', 'negatives.json')
+        instr.enable(filename)
+        neg.batch_negatives(imagesfolder, bboxesfolder, outfolder)
+        # Again in worker processes, without the manifest so nothing is skipped
+        os.remove(os.path.join(outfolder, 'manifest.json'))
+        neg.batch_negatives(imagesfolder, bboxesfolder, outfolder, 2)
+        instr.save()
+        summaryfile = open(filename)
+        summary = json.load(summaryfile)
+        summaryfile.close()
+        nbnegatives = len([f for f in os.listdir(outfolder) if f.endswith('.png')])
+        # Records of the workers are merged into this process
+        self.assertEqual(summary['counters']['negatives/images'], 8)
+        self.assertEqual(summary['counters']['negatives/negatives'], 2 * nbnegatives)
+        stages = summary['stages']
+        self.assertEqual(stages['negatives/decode']['count'], 8)
+        self.assertEqual(stages['negatives/decode']['bytes'], 8 * 100 * 150 * 3)
+        self.assertEqual(stages['negatives/encode']['count'], 2 * nbnegatives)
+        self.assertTrue(stages['negatives/encode']['bytes'] > 0)
+        self.assertTrue(summary['peakmemory'] > 0)
+
+    def test_detection(self):
+        instr.enable(os.path.join(self.tmpfolder, 'detection.json'))
+        detector = dpmd.DPMObjectDetection(2, dpmd.StubBackend)
+        detector.setModel('model')
+        images = [np.zeros([10, 20, 3], dtype=np.uint8)] * 5
+        detector.detectBatch(images, 0, 1)
+        detector.close()
+        session = dpmd.TimedSession(FakeSession())
+        session.putvalue('im', images[0])
+        session.run("ds = imgdetect(im, model, thresh);")
+        session.run("cd ./train/")
+        self.assertTrue(session.getvalue('im') is images[0])
+        summary = instr.summary()
+        self.assertEqual(summary['counters'], {'detection/images': 5})
+        stages = summary['stages']
+        self.assertEqual(stages['detection/image']['count'], 5)
+        self.assertEqual(stages['detection/image']['bytes'], 5 * 600)
+        self.assertEqual(stages['detection/batch']['count'], 1)
+        self.assertEqual(stages['matlab/putvalue']['bytes'], 600)
+        self.assertEqual(stages['matlab/getvalue']['bytes'], 600)
+        self.assertEqual(stages['matlab/run/imgdetect']['count'], 1)
+        self.assertEqual(stages['matlab/run/cd']['count'], 1)
+
+    def test_profile(self):
+        instr.enable(os.path.join(self.tmpfolder, 'profile.json'), profile=True)
+        with instr.timer('sum'):
+            sum(range(0, 1000))
+        instr.save()
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpfolder, 'profile.prof')))
+        summaryfile = open(os.path.join(self.tmpfolder, 'profile.json'))
+        summary = json.load(summaryfile)
+        summaryfile.close()
+        self.assertTrue(len(summary['profile']) > 0)
+        self.assertTrue('tracemalloc' in summary)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,26 @@
 """ Unit tests for negatives.py.
 """
 import negatives as neg
+import negativestore
+import imagecache
+import annotations
+import evaluation
+import geometry
 import unittest
 import acdconf as conf
 import cv2
 import os
 import os.path
 import json
+import numpy as np
+import tempfile
+import shutil
 
 class TestNegatives(unittest.TestCase):
     def test_negative_samples_boxes(self):
+        annotationsource = annotations.open_annotations(
+            conf.annotationsfile if os.path.isfile(conf.annotationsfile)
+            else conf.bboxesfolder)
         imagefilenames = [f for f in sorted(os.listdir(conf.imagesfolder), 
                                             key=str.lower) 
                           if f.endswith('.jpg')]
@@ -17,19 +28,21 @@ class TestNegatives(unittest.TestCase):
         for imagefilename in imagefilenames:
             print "processing " + imagefilename
             # Load image and bounding boxes
-            image = cv2.imread(os.path.join(conf.imagesfolder, imagefilename))
+            image = imagecache.imread(os.path.join(conf.imagesfolder, imagefilename))
             stem = os.path.splitext(imagefilename)[0]
-            bboxesfile = open(os.path.join(conf.bboxesfolder, stem + '_bb.json'))
-            bboxes = json.load(bboxesfile)
-            bboxesfile.close()
+            bboxes = annotationsource.boxes(stem)
             # Compute the negatives, and write the boxes info to the output folder
             negatives = neg.negative_samples_boxes(image, bboxes)
-            # First checks whether the negatives are indeed only background
-            andf = lambda b1, b2: b1 and b2
-            # Check that the negatives are indeed background
-            onlybg = reduce(andf, map(lambda negval: reduce(andf, map(lambda bbox: not neg.overlapping(bbox, negval), bboxes)), negatives), True)
+            # Check that the negatives are indeed background, i.e. that none of
+            # them shares a pixel, hence a positive overlap, with a bounding box
+            zeros = np.zeros(len(negatives), dtype=np.int64)
+            _, bestiou = evaluation.best_matches(
+                zeros, geometry.toarray(negatives),
+                np.zeros(len(bboxes), dtype=np.int64), geometry.toarray(bboxes))
+            onlybg = not np.any(bestiou > 0)
             # If test fails, show debug info before assertion
             if not onlybg:
+                image = image.copy()
                 for [ul,dr] in bboxes:
                     cv2.rectangle(image, tuple(ul), tuple(dr), (255,0,0), 1)
                 cv2.imshow("image", image)
@@ -40,6 +53,136 @@ class TestNegatives(unittest.TestCase):
                     i += 1
                 cv2.waitKey(0)
             self.assertTrue(onlybg)
+        print imagecache.getcache().report()
+
+    def test_negative_samples_engines(self):
+        # Both engines should give exactly the same boxes, in the same order, on
+        # random synthetic images and boxes.
+        rng = np.random.RandomState(42)
+        for nbboxes in [0, 1, 2, 5, 10, 50, 200]:
+            for trial in range(0,5):
+                rows, cols = rng.randint(50, 500, size=2)
+                image = np.zeros([rows, cols, 3], dtype=np.uint8)
+                ul = np.stack([rng.randint(0, cols, nbboxes),
+                               rng.randint(0, rows, nbboxes)], axis=1)
+                size = rng.randint(1, 200, size=[nbboxes, 2])
+                bboxes = [[[int(x),int(y)],[int(x+w),int(y+h)]]
+                          for [x,y],[w,h] in zip(ul, size)]
+                self.assertEqual(
+                    neg.negative_samples_boxes(image, bboxes, engine='python'),
+                    neg.negative_samples_boxes(image, bboxes, engine='numpy'))
+
+    def make_dataset(self, tmpfolder, nbimages=4):
+        """ Writes random images and bounding boxes in a temporary folder.
+        """
+        imagesfolder, bboxesfolder, outfolder = [
+            os.path.join(tmpfolder, f) for f in ['images', 'bboxes', 'out']]
+        for folder in [imagesfolder, bboxesfolder, outfolder]:
+            os.makedirs(folder)
+        rng = np.random.RandomState(0)
+        for i in range(0,nbimages):
+            cv2.imwrite(os.path.join(imagesfolder, 'img_' + repr(i) + '.jpg'),
+                        rng.randint(0, 255, [100, 150, 3]).astype(np.uint8))
+            bboxesfile = open(os.path.join(bboxesfolder, 
+                                           'img_' + repr(i) + '_bb.json'), 'w')
+            json.dump([[[10,10],[40+i,60]]], bboxesfile)
+            bboxesfile.close()
+        return imagesfolder, bboxesfolder, outfolder
+
+    def test_batch_negatives(self):
+        # Second run should skip everything, and touching a bounding boxes file
+        # should only redo that image.
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            imagesfolder, bboxesfolder, outfolder = self.make_dataset(tmpfolder)
+            self.assertEqual(neg.batch_negatives(imagesfolder, bboxesfolder, 
+                                                 outfolder, 2), (4, 0))
+            manifest = neg.load_manifest(os.path.join(outfolder, 'manifest.json'))
+            self.assertEqual(sorted(manifest.keys()), 
+                             ['img_' + repr(i) for i in range(0,4)])
+            nbnegatives = sum([entry['negatives'] for entry in manifest.values()])
+            self.assertEqual(len(os.listdir(outfolder)), nbnegatives + 1)
+            self.assertEqual(neg.batch_negatives(imagesfolder, bboxesfolder, 
+                                                 outfolder, 2), (0, 4))
+            bboxesfilename = os.path.join(bboxesfolder, 'img_1_bb.json')
+            stat = os.stat(bboxesfilename)
+            os.utime(bboxesfilename, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(neg.batch_negatives(imagesfolder, bboxesfolder, 
+                                                 outfolder), (1, 3))
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_negative_stores(self):
+        # Box index and patch store should give back the same patches as
+        # negative_samples, without writing any png file.
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            imagesfolder, bboxesfolder, outfolder = self.make_dataset(tmpfolder)
+            for mode in ['boxes', 'memmap']:
+                modefolder = os.path.join(outfolder, mode)
+                os.makedirs(modefolder)
+                neg.batch_negatives(imagesfolder, bboxesfolder, modefolder, 2,
+                                    mode=mode)
+                self.assertEqual([f for f in os.listdir(modefolder) 
+                                  if f.endswith('.png')], [])
+                index = negativestore.load(modefolder)
+                self.assertEqual(len(index), 4)
+                # Only keep half of the stems, as makefolds.py does
+                foldfolder = os.path.join(tmpfolder, mode + '_fold')
+                os.makedirs(foldfolder)
+                negativestore.save(index.subset(['img_1', 'img_3']), foldfolder)
+                subset = negativestore.load(foldfolder)
+                self.assertEqual(subset.stems, ['img_1', 'img_3'])
+                for stem in subset.stems:
+                    image = cv2.imread(os.path.join(imagesfolder, stem + '.jpg'))
+                    bboxesfile = open(os.path.join(bboxesfolder, stem + '_bb.json'))
+                    expected = neg.negative_samples(image, json.load(bboxesfile))
+                    bboxesfile.close()
+                    crops = subset.crops(stem)
+                    self.assertEqual(len(crops), len(expected))
+                    for crop, negative in zip(crops, expected):
+                        self.assertTrue(np.array_equal(crop, negative))
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_outputs(self):
+        # Redone images leave unreferenced patches in the data file until it is
+        # rewritten, and switching modes removes the outputs of the earlier one
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            imagesfolder, bboxesfolder, outfolder = self.make_dataset(tmpfolder)
+            datafilename = os.path.join(outfolder, negativestore.patchdataname)
+            def redo(maxslack):
+                bboxesfilename = os.path.join(bboxesfolder, 'img_1_bb.json')
+                stat = os.stat(bboxesfilename)
+                os.utime(bboxesfilename, (stat.st_atime, stat.st_mtime + 10))
+                neg.batch_negatives(imagesfolder, bboxesfolder, outfolder,
+                                    mode='memmap', maxslack=maxslack)
+                return os.path.getsize(datafilename)
+            neg.batch_negatives(imagesfolder, bboxesfolder, outfolder, mode='memmap')
+            size = os.path.getsize(datafilename)
+            self.assertTrue(redo(1) > size)
+            self.assertEqual(redo(0), size)
+            index = negativestore.load(outfolder)
+            self.assertEqual(index.unreferenced(), 0)
+            for stem in index.stems:
+                image = cv2.imread(os.path.join(imagesfolder, stem + '.jpg'))
+                bboxesfile = open(os.path.join(bboxesfolder, stem + '_bb.json'))
+                expected = neg.negative_samples(image, json.load(bboxesfile))
+                bboxesfile.close()
+                for crop, negative in zip(index.crops(stem), expected):
+                    self.assertTrue(np.array_equal(crop, negative))
+            # The compacted manifest still skips unchanged images
+            self.assertEqual(neg.batch_negatives(imagesfolder, bboxesfolder,
+                                                 outfolder, mode='memmap'), (0, 4))
+            neg.batch_negatives(imagesfolder, bboxesfolder, outfolder, mode='png')
+            self.assertEqual(negativestore.load(outfolder), None)
+            self.assertTrue(any([f.endswith('.png') for f in os.listdir(outfolder)]))
+            neg.batch_negatives(imagesfolder, bboxesfolder, outfolder, mode='boxes')
+            self.assertEqual(sorted(os.listdir(outfolder)),
+                             [negativestore.boxindexname, 'manifest.json'])
+        finally:
+            shutil.rmtree(tmpfolder)
 
 if __name__ == '__main__':
     unittest.main()
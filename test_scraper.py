@@ -0,0 +1,186 @@
+""" Unit tests for the pooled mode of scripts/scraper.py, against a local HTTP server
+    standing in for deviantArt's RSS feed.
+"""
+import sys
+import os
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'scripts'))
+import scraper
+import duplicates
+import unittest
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import collections
+import time
+import json
+import cv2
+import numpy as np
+import tempfile
+import shutil
+
+_rss = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/">
+<channel>
+<title>stand-in</title>
+%s
+</channel>
+</rss>"""
+_item = """<item>
+<title>%s</title>
+<link>%s</link>
+<media:content url="%s" medium="image"/>
+</item>"""
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves a feed per query, whose entries point to images of the server, and
+        counts the requests to each path.
+    """
+    daemon_threads = True
+
+    def __init__(self, feeds, images):
+        """ Initializes the server from the image names of the feed of each query,
+            and the (content type, bytes) of each image name.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.feeds = feeds
+        self.images = images
+        self.requests = collections.Counter()
+        self.url = 'http://127.0.0.1:' + repr(self.server_address[1])
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.server.requests[url.path] += 1
+        if url.path == '/rss.xml':
+            query = urlparse.parse_qs(url.query)['q'][0]
+            names = [names for q, names in self.server.feeds.items() if q in query][0]
+            items = [_item % (name, self.server.url + '/view/' + name,
+                              self.server.url + '/images/' + name) for name in names]
+            self.reply('application/rss+xml', _rss % '\n'.join(items))
+        elif url.path.startswith('/images/'):
+            self.reply(*self.server.images[url.path[len('/images/'):]])
+        else:
+            self.send_error(404)
+
+    def reply(self, contenttype, content):
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', repr(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+def artwork(seed):
+    """ Smooth random image, different enough from other seeds not to be taken for a
+        near duplicate.
+    """
+    noise = np.random.RandomState(seed).randint(0, 256, [12, 16, 3]).astype(np.uint8)
+    return cv2.resize(cv2.GaussianBlur(noise, (0, 0), 1), (64, 48))
+
+def png(seed):
+    return cv2.imencode('.png', artwork(seed))[1].tostring()
+
+class TestScraper(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.seeds = dict([('a' + repr(i), i) for i in range(0, 6)]
+                          + [('b' + repr(i), 100 + i) for i in range(0, 4)])
+        images = dict([(name, ('image/png', png(seed)))
+                       for name, seed in self.seeds.items()])
+        images['a1'] = ('text/html', '<html></html>')
+        self.server = StandInServer(
+            {'asuka': ['a' + repr(i) for i in range(0, 6)],
+             'rei': ['b' + repr(i) for i in range(0, 4)]}, images)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpfolder)
+
+    def scrape(self, reviewer, nbImages=2, index=None):
+        return scraper.scrapeQueries(['asuka', 'rei'], nbImages, 'popular',
+                                     self.tmpfolder, reviewer, nbWorkers=3,
+                                     prefetch=4, baseUrl=self.server.url + '/rss.xml',
+                                     index=index)
+
+    def test_scrape(self):
+        reviewed = []
+        def reviewer(image, entry):
+            reviewed.append(entry.title)
+            self.assertTrue(np.array_equal(image, artwork(self.seeds[entry.title])))
+            # Accept even images
+            return int(entry.title[1:]) % 2 == 0
+        self.assertEqual(self.scrape(reviewer), [2, 2])
+        # a1 is not an image, and reviewing stops for each query at 2 images
+        self.assertEqual(reviewed, ['a0', 'a2', 'b0', 'b1', 'b2'])
+        for stem, title in [('asuka_0', 'a0'), ('asuka_1', 'a2'), ('rei_0', 'b0'),
+                            ('rei_1', 'b2')]:
+            image = cv2.imread(os.path.join(self.tmpfolder, stem + '.png'))
+            self.assertTrue(np.array_equal(image, artwork(self.seeds[title])))
+            jsonfile = open(os.path.join(self.tmpfolder, stem + '.json'))
+            self.assertEqual(json.load(jsonfile)['title'], title)
+            jsonfile.close()
+        # Each image downloaded at most once
+        self.assertTrue(max([n for path, n in self.server.requests.items()
+                             if path.startswith('/images/')]) == 1)
+
+    def test_resume(self):
+        reviewed = []
+        def interrupted(image, entry):
+            if len(reviewed) == 2:
+                raise KeyboardInterrupt()
+            reviewed.append(entry.title)
+            return True
+        self.assertRaises(KeyboardInterrupt, self.scrape, interrupted, 3)
+        self.assertEqual(reviewed, ['a0', 'a2'])
+        # Decided images are not reviewed again
+        def reviewer(image, entry):
+            reviewed.append(entry.title)
+            return True
+        self.assertEqual(self.scrape(reviewer, 3), [3, 3])
+        self.assertEqual(reviewed, ['a0', 'a2', 'a3', 'b0', 'b1', 'b2'])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpfolder, 'asuka_2.png')))
+        journal = scraper.Journal(os.path.join(self.tmpfolder, 'asuka.journal'))
+        self.assertEqual(journal.nbAccepted, 3)
+
+    def test_prefetch(self):
+        # While the first image is reviewed, the next ones are downloaded
+        nbdownloaded = []
+        def reviewer(image, entry):
+            if nbdownloaded == []:
+                time.sleep(0.3)
+            nbdownloaded.append(sum([n for path, n in self.server.requests.items()
+                                     if path.startswith('/images/')]))
+            return False
+        self.scrape(reviewer)
+        self.assertTrue(nbdownloaded[0] >= 4)
+
+    def test_duplicates(self):
+        # b1 is a rescaled repost of a0, and b2 of an image already in the folder
+        self.server.images['b1'] = ('image/jpeg', cv2.imencode(
+                '.jpg', cv2.resize(artwork(0), (128, 96)))[1].tostring())
+        cv2.imwrite(os.path.join(self.tmpfolder, 'old_0.png'), artwork(102))
+        index = duplicates.HashIndex(self.tmpfolder)
+        index.update()
+        reviewed = []
+        def reviewer(image, entry):
+            reviewed.append(entry.title)
+            return True
+        self.scrape(reviewer, 3, index)
+        self.assertEqual(reviewed, ['a0', 'a2', 'a3', 'b0', 'b3'])
+        journal = scraper.Journal(os.path.join(self.tmpfolder, 'rei.journal'))
+        self.assertEqual([journal.decisions[self.server.url + '/images/' + name]
+                          ['filename'] for name in ['b1', 'b2']],
+                         ['asuka_0.png', 'old_0.png'])
+        self.assertEqual(len(index), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+""" Unit tests for streaming.py, using the stub backend.
+"""
+import streaming
+import dpmDetection as dpmd
+import evaluation
+import test_duplicates
+import unittest
+import cv2
+import numpy as np
+import os
+import os.path
+import StringIO
+import tempfile
+import shutil
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.backends = []
+        def factory():
+            self.backends.append(dpmd.StubBackend())
+            return self.backends[-1]
+        self.detector = dpmd.DPMObjectDetection(2, factory)
+        self.detector.setModel('model')
+
+    def tearDown(self):
+        self.detector.close()
+        shutil.rmtree(self.tmpfolder)
+
+    def shots(self):
+        """ Two shots of 5 and 3 frames, with noise within each shot.
+        """
+        rng = np.random.RandomState(0)
+        frames = []
+        for seed, length in [(1, 5), (2, 3)]:
+            image = test_duplicates.artwork(seed, 120, 160)
+            for i in range(0, length):
+                noise = rng.randint(-2, 3, image.shape)
+                frames.append(np.clip(image + noise, 0, 255).astype(np.uint8))
+        return frames
+
+    def test_folder_stream(self):
+        frames = self.shots()
+        for i, frame in enumerate(frames):
+            cv2.imwrite(os.path.join(self.tmpfolder, 'f' + '%02d' % i + '.png'), frame)
+        outputfile = StringIO.StringIO()
+        stats = streaming.run_stream(self.detector,
+                                     streaming.open_frames(self.tmpfolder),
+                                     outputfile, 0, 1, batchsize=3)
+        self.assertEqual((stats['frames'], stats['detected'], stats['reused']),
+                         (8, 2, 6))
+        self.assertTrue(stats['fps'] > 0)
+        self.assertEqual(sum([b.nbdetections for b in self.backends]), 2)
+        # Frames of a shot have the detections of its first frame, in the format of
+        # evaluation.save_detections
+        lines = outputfile.getvalue().splitlines()
+        self.assertEqual(len(lines), 8)
+        detectionsfilename = os.path.join(self.tmpfolder, 'detections.json')
+        detectionsfile = open(detectionsfilename, 'w')
+        detectionsfile.write(outputfile.getvalue())
+        detectionsfile.close()
+        detections = evaluation.load_detections(detectionsfilename)
+        for i, frame in enumerate(frames):
+            first = frames[0] if i < 5 else frames[5]
+            self.assertEqual(detections['f' + '%02d' % i],
+                             [([[0,0],[159,119]], float(np.mean(first)))])
+
+    def test_tracker(self):
+        frames = self.shots()
+        def reused(tracker):
+            return [r for s, d, r in streaming.detect_stream(
+                    self.detector, [(repr(i), f) for i, f in enumerate(frames)],
+                    0, 1, 4, 2, tracker)]
+        self.assertEqual(reused(streaming.SceneTracker(10, 2)),
+                         [False, True, True, False, True, False, True, True])
+        self.assertEqual(reused(streaming.SceneTracker(-1, 2)), [False] * 8)
+
+    def test_backpressure(self):
+        self.detector.pool.backends[0].delay = 0.02
+        self.detector.pool.backends[1].delay = 0.02
+        frames = self.shots()
+        decoded = []
+        ahead = []
+        def source():
+            for i in range(0, 40):
+                decoded.append(i)
+                yield repr(i), frames[i % 8]
+        tracker = streaming.SceneTracker(-1)
+        for n, (stem, detections, reused) in enumerate(streaming.detect_stream(
+                self.detector, source(), 0, 1, 4, 3, tracker)):
+            self.assertEqual(stem, repr(n))
+            ahead.append(len(decoded) - n)
+        # Frames decoded ahead are bounded by the queue, a batch and the frame the
+        # reader waits to put
+        self.assertTrue(max(ahead) <= 3 + 4 + 1)
+        self.assertEqual(len(decoded), 40)
+
+    def test_errors(self):
+        def source():
+            yield 'a', np.zeros([8, 8, 3], dtype=np.uint8)
+            raise IOError("truncated")
+        with self.assertRaises(IOError):
+            list(streaming.detect_stream(self.detector, source(), 0, 1))
+        with self.assertRaises(IOError):
+            list(streaming.open_frames(os.path.join(self.tmpfolder, 'missing.avi')))
+
+    def test_video(self):
+        filename = os.path.join(self.tmpfolder, 'episode.avi')
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), 24,
+                                 (160, 120))
+        if not writer.isOpened():
+            self.skipTest("no video encoder")
+        for frame in self.shots():
+            writer.write(frame)
+        writer.release()
+        stems = [stem for stem, frame in streaming.video_frames(filename, 3)]
+        self.assertEqual(stems, ['episode_000000', 'episode_000003', 'episode_000006'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+""" Unit tests for tiling.py.
+"""
+import tiling
+import dpmDetection as dpmd
+import dpmscoring as dpms
+import featpyramid as fp
+import geometry
+import test_cascade
+import unittest
+import cv2
+import numpy as np
+
+class TestTiling(unittest.TestCase):
+    def test_tiles(self):
+        rows, cols, size, overlap = 500, 1000, 256, 100
+        result = tiling.tiles(rows, cols, size, overlap)
+        covered = np.zeros([rows, cols], dtype=np.int64)
+        for tile, core in result:
+            self.assertEqual((tile[0] % 64, tile[1] % 64), (0, 0))
+            self.assertTrue(tile[2] - tile[0] < size and tile[3] - tile[1] < size)
+            covered[core[1]:core[3]+1,core[0]:core[2]+1] += 1
+        # Cores partition the image
+        self.assertTrue(np.all(covered == 1))
+        # Boxes no larger than the overlap are within the tile of their center
+        rng = np.random.RandomState(0)
+        for i in range(0, 1000):
+            w, h = rng.randint(1, overlap + 1, 2)
+            x, y = rng.randint(0, cols - w + 1), rng.randint(0, rows - h + 1)
+            cx, cy = x + (w - 1) / 2.0, y + (h - 1) / 2.0
+            [tile] = [t for t, c in result
+                      if c[0] <= cx < c[2] + 1 and c[1] <= cy < c[3] + 1]
+            self.assertTrue(tile[0] <= x and x + w - 1 <= tile[2])
+            self.assertTrue(tile[1] <= y and y + h - 1 <= tile[3])
+
+    def test_budget(self):
+        model = dpms.DPMModel([dpms.Component(np.zeros([5, 4, 31]), [], 0)])
+        builder = model.pyramidbuilder()
+        maxbytes = 64 * 1024 ** 2
+        size = tiling.tilesize(builder, maxbytes, 200)
+        self.assertTrue(builder.nbbytes(size, size) <= maxbytes
+                        < builder.nbbytes(size + 64, size + 64))
+        octaves = tiling.coarsescale(builder, 3000, 4000, maxbytes)
+        self.assertTrue(builder.nbbytes(3000 >> octaves, 4000 >> octaves) <= maxbytes
+                        < builder.nbbytes(3000 >> octaves - 1, 4000 >> octaves - 1))
+        with self.assertRaises(ValueError):
+            tiling.tilesize(builder, 1024 ** 2, 200)
+
+    def test_detect_tiled(self):
+        rng = np.random.RandomState(2)
+        image = rng.randint(0, 256, [160, 200, 3]).astype(np.uint8)
+        model, box = test_cascade.template_model(image)
+        canvas = np.zeros([640, 960, 3], dtype=np.uint8)
+        # Copies across tile edges, and a copy larger than half the overlap found in
+        # the downscaled image only
+        for y, x in [(0, 0), (304, 296), (48, 616), (96, 328)]:
+            canvas[y:y+160,x:x+200] = image
+        canvas[320:640,560:960] = cv2.resize(image, (400, 320),
+                                             interpolation=cv2.INTER_NEAREST)
+        large = [[656, 368], [719, 447]]
+        builder = model.pyramidbuilder()
+        maxbytes = 48 * 1024 ** 2
+        self.assertEqual(tiling.coarsescale(builder, 640, 960, maxbytes), 1)
+        detector = dpmd.DPMObjectDetection(2, dpms.NativeBackend)
+        try:
+            detector.setModel(model)
+            whole = detector.detectObject(canvas, 49, None)
+            tiled = detector.detectTiled(canvas, 49, None, maxbytes, 96, builder)
+            # Same as whole image detection when it fits the budget
+            self.assertEqual(detector.detectTiled(canvas, 0, 20, 10 ** 9, 96, builder),
+                             detector.detectObject(canvas, 0, 20))
+            # The budget is checked against the pyramids the backends build for the
+            # model by default, not those of voc-dpm models
+            budget = builder.nbbytes(640, 960)
+            self.assertTrue(fp.PyramidBuilder(cachesize=0).nbbytes(640, 960) > budget)
+            self.assertEqual(detector.detectTiled(canvas, 49, None, budget, 96),
+                             whole)
+        finally:
+            detector.close()
+        # Detections of the tiles are the same as in the whole image, including the
+        # copies across tile edges
+        def small(detections):
+            return sorted([(bbox, score) for bbox, score in detections
+                           if max(bbox[1][0] - bbox[0][0] + 1,
+                                  bbox[1][1] - bbox[0][1] + 1) <= 48])
+        expected = small(whole)
+        actual = small(tiled)
+        self.assertTrue(len(expected) > 4)
+        self.assertEqual([b for b, s in actual], [b for b, s in expected])
+        self.assertTrue(np.allclose([s for b, s in actual], [s for b, s in expected]))
+        self.assertEqual(len([s for b, s in actual if s > 52]), 4)
+        # The large copy is found in the downscaled image, with its parts scored on
+        # coarser features
+        self.assertEqual(tiled[0][0], large)
+        self.assertTrue(large in [b for b, s in whole])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+""" Unit tests for vocdpm.py.
+"""
+import vocdpm
+import dpmscoring as dpms
+import unittest
+import numpy as np
+import os.path
+import tempfile
+import shutil
+
+class Struct:
+    """ MATLAB struct as read by scipy.io.loadmat with struct_as_record=False.
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+def cells(*values):
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+def voc_model(rng):
+    """ voc-release5 star model with a component and its mirror, each with a part.
+    """
+    root = rng.randn(5, 3, 32)
+    part = rng.randn(4, 2, 32)
+    blocks = cells(*[Struct(w=w.ravel(order='F'), shape=np.array(w.shape))
+                     for w in [root, part, np.array([0.1, 0.3, 0.2, -0.4]),
+                               np.array([-0.5])]])
+    filters = cells(Struct(blocklabel=1, flip=False), Struct(blocklabel=2, flip=False),
+                    Struct(blocklabel=1, flip=True), Struct(blocklabel=2, flip=True))
+    symbols = cells(Struct(type='N'), Struct(type='T', filter=1), Struct(type='N'),
+                    Struct(type='T', filter=2), Struct(type='T', filter=3),
+                    Struct(type='N'), Struct(type='T', filter=4))
+    def structural(rhs, anchor):
+        return Struct(type='S', rhs=np.array(rhs),
+                      anchor=cells(np.array([0, 0, 0]), np.array(anchor)),
+                      offset=Struct(blocklabel=4))
+    def deformation(rhs, flip):
+        return Struct(type='D', rhs=rhs, offset=Struct(w=0),
+                      **{'def': Struct(blocklabel=3, flip=flip)})
+    empty = np.zeros([0, 0])
+    rules = cells(cells(structural([2, 3], [1, 2, 1]), structural([5, 6], [3, 2, 1])),
+                  empty, deformation(4, False), empty, empty, deformation(7, True),
+                  empty)
+    return Struct(sbin=8, interval=10, start=1, features=Struct(bias=10),
+                  blocks=blocks, filters=filters, symbols=symbols, rules=rules)
+
+def star_model(root, part, anchor, defcost):
+    """ voc-release5 star model with a single component and part.
+    """
+    blocks = cells(*[Struct(w=w.ravel(order='F'), shape=np.array(w.shape))
+                     for w in [root, part, np.asarray(defcost), np.array([0.])]])
+    filters = cells(Struct(blocklabel=1, flip=False), Struct(blocklabel=2, flip=False))
+    symbols = cells(Struct(type='N'), Struct(type='T', filter=1), Struct(type='N'),
+                    Struct(type='T', filter=2))
+    structural = Struct(type='S', rhs=np.array([2, 3]),
+                        anchor=cells(np.array([0, 0, 0]), np.array(anchor)),
+                        offset=Struct(blocklabel=4))
+    deformation = Struct(type='D', rhs=4, offset=Struct(w=0),
+                         **{'def': Struct(blocklabel=3, flip=False)})
+    empty = np.zeros([0, 0])
+    return Struct(sbin=8, interval=2, start=1, features=Struct(bias=10),
+                  blocks=blocks, filters=filters, symbols=symbols,
+                  rules=cells(structural, empty, deformation, empty))
+
+class TestVocDPM(unittest.TestCase):
+    def test_convert(self):
+        rng = np.random.RandomState(0)
+        vocmodel = voc_model(rng)
+        model = vocdpm.convert(vocmodel)
+        self.assertEqual((model.sbin, model.interval), (8, 10))
+        self.assertEqual(len(model.components), 2)
+        root = vocmodel.blocks[0].w.reshape([5, 3, 32], order='F')
+        component, mirrored = model.components
+        self.assertTrue(np.array_equal(component.root, root[:,:,0:31]))
+        self.assertEqual(component.bias, -5)
+        [part] = component.parts
+        self.assertEqual(part.anchor, (1, 2))
+        self.assertTrue(np.array_equal(part.defcost, [0.1, 0.3, 0.2, -0.4]))
+        # Mirrored filters and deformations
+        self.assertTrue(np.array_equal(mirrored.root,
+                                       root[:,::-1,vocdpm._flipped[0:31]]))
+        self.assertTrue(np.array_equal(mirrored.parts[0].defcost,
+                                       [0.1, -0.3, 0.2, -0.4]))
+        self.assertEqual(mirrored.parts[0].anchor, (3, 2))
+        # Mirroring twice gives back the features
+        self.assertTrue(np.array_equal(vocdpm._flipped[vocdpm._flipped],
+                                       np.arange(32)))
+        # Converted models are saved in the native format
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpfolder, 'model.dpm')
+            dpms.savemodel(model, filename)
+            loaded = dpms.loadmodel(filename)
+            self.assertTrue(np.allclose(loaded.components[1].parts[0].filter,
+                                        mirrored.parts[0].filter, atol=1e-6))
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_part_placement(self):
+        # A blank root with a one-hot part finds the root location voc-dpm anchors
+        # the part to where its feature is set
+        padx, pady = 3, 4
+        ax, ay = 3, 5
+        part = np.zeros([1, 1, 32])
+        part[0,0,0] = 1
+        model = vocdpm.convert(star_model(np.zeros([5, 4, 32]), part, [ax, ay, 1],
+                                          [10, 0, 10, 0]))
+        self.assertEqual(model.components[0].parts[0].anchor, (ax, ay))
+        # voc-dpm's gdetect_dp places the part of the root at 1-based location
+        # (y,x) at (starty + 2(y-1), startx + 2(x-1)), with starty = 1+ay-pady and
+        # startx = 1+ax-padx its virtual padding
+        y, x = 9, 12
+        py = 1 + ay - pady + 2 * (y - 1)
+        px = 1 + ax - padx + 2 * (x - 1)
+        rootfeat = np.zeros([16, 18, 31])
+        partfeat = np.zeros([32, 36, 31])
+        partfeat[py-1,px-1,0] = 1
+        [scores] = dpms.score_level(model, rootfeat, partfeat, padx, pady)
+        self.assertEqual(np.unravel_index(np.argmax(scores), scores.shape),
+                         (y - 1, x - 1))
+        self.assertEqual(scores[y-1,x-1], 1)
+        self.assertEqual(np.sum(scores == 1), 1)
+
+if __name__ == '__main__':
+    unittest.main()
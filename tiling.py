@@ -0,0 +1,175 @@
+""" Tiled detection of very large images with bounded memory.
+
+Detecting in a whole image builds its whole feature pyramid, so memory grows with
+the area of the image. Instead, the image is cut into overlapping tiles small enough
+for the pyramid of each to fit a memory budget, and the tiles are streamed through
+the backends of a DPMObjectDetection a few batches at a time.
+
+Tiles overlap by a number of pixels. Each tile only reports the detections centered
+in its core, the part of it closer to its middle than to the cores of its
+neighbours, and no larger than half the overlap. Those are at least a quarter of the
+overlap away from the edges of the tile, so the features they are scored on, which
+extend a few cells around them, are the same as in the whole image, and an object
+across a tile edge is reported once by the tile containing it. Larger detections
+are found in the whole image downscaled by a power of 2 until its pyramid fits the
+budget, whose levels match the coarser levels of the pyramid of the original image.
+Detections of both are then merged with non-maximum suppression as for a whole
+image.
+
+Boxes match those of whole-image detection up to features near the edges of the
+image and of the cores, and the part filters of large detections, which are scored
+on the features of the downscaled image, coarser than those of the original one.
+Tile origins are aligned to multiples of 8 cells, so cells of the levels at scales
+2, 1, 1/2 and 1/4 fall on the same pixels as in the whole image.
+"""
+import cv2
+import numpy as np
+import acdconf as conf
+import dpmscoring as dpms
+import featpyramid as fp
+import geometry
+import instrumentation as instr
+
+def tilesize(builder, maxbytes, overlap):
+    """ Size of the largest square tiles whose pyramid fits a memory budget.
+    Args:
+        builder (featpyramid.PyramidBuilder): builder of the pyramids of the
+            backends, estimating their memory.
+        maxbytes (int): memory budget of the pyramid of a tile, in bytes.
+        overlap (int): overlap between tiles in pixels.
+    Returns:
+        The size of the tiles in pixels, a multiple of 8 cells.
+    """
+    align = 8 * builder.sbin
+    size = (overlap // align + 2) * align
+    if builder.nbbytes(size, size) > maxbytes:
+        raise ValueError("A budget of " + repr(maxbytes) + " bytes is too small for "
+                         + "tiles overlapping by " + repr(overlap) + " pixels")
+    while builder.nbbytes(size + align, size + align) <= maxbytes:
+        size += align
+    return size
+
+def _origins(length, size, step):
+    """ Origins of the tiles along one dimension, and the bounds of their cores.
+    """
+    origins = range(0, max(length - size, 0) + step, step)
+    overlap = size - step
+    bounds = [0] + [o + overlap // 2 for o in origins[1:]] + [length]
+    return origins, bounds
+
+def tiles(rows, cols, size, overlap, align=64):
+    """ Overlapping tiles covering an image.
+    Args:
+        rows, cols (int): size of the image.
+        size (int): size of the square tiles in pixels, clipped to the image.
+        overlap (int): minimum overlap between neighbouring tiles in pixels.
+        align (int): tile origins are multiples of it.
+    Returns:
+        A list of (tile, core) pairs of [ulx,uly,drx,dry] boxes in inclusive pixel
+        coordinates of the image, the cores of the tiles partitioning the image.
+    """
+    step = (size - overlap) // align * align
+    if step <= 0:
+        raise ValueError("Tiles of " + repr(size) + " pixels cannot overlap by "
+                         + repr(overlap) + " pixels")
+    xs, xbounds = _origins(cols, size, step)
+    ys, ybounds = _origins(rows, size, step)
+    result = []
+    for j, y in enumerate(ys):
+        for i, x in enumerate(xs):
+            tile = [x, y, min(x + size, cols) - 1, min(y + size, rows) - 1]
+            core = [xbounds[i], ybounds[j], xbounds[i+1] - 1, ybounds[j+1] - 1]
+            result.append((tile, core))
+    return result
+
+def coarsescale(builder, rows, cols, maxbytes):
+    """ Smallest number of halvings of an image for its pyramid to fit a memory
+        budget.
+    """
+    octaves = 0
+    while builder.nbbytes(max(rows >> octaves, 1), max(cols >> octaves, 1)) > maxbytes:
+        octaves += 1
+    return octaves
+
+def _todetections(boxes, scores):
+    return [([[ulx,uly],[drx,dry]], s) for [ulx,uly,drx,dry], s
+            in zip(boxes.tolist(), scores.tolist())]
+
+def detect_tiled(detector, image, thresh, max_num, maxbytes=conf.tilebytes,
+                 overlap=conf.tileoverlap, builder=None, batchsize=None, nms=0.5):
+    """ Detects objects in a large image tile by tile, see the module documentation.
+    Args:
+        detector (dpmDetection.DPMObjectDetection): detector with a model set.
+        image (array): BGR image.
+        thresh (float): minimum score of detections.
+        max_num (int): maximum number of detections.
+        maxbytes (int): memory budget of the pyramid of a tile, in bytes.
+        overlap (int): overlap between tiles in pixels. Tiles detect objects up to
+            half of it, so it should be at least twice as large as the smallest
+            detections of the model in the downscaled image, scaled back to the
+            original one.
+        builder (featpyramid.PyramidBuilder): builder of the pyramids of the
+            backends, to estimate their memory. By default the one of the native
+            model of the detector, with its padding, otherwise the one of voc-dpm
+            models, with 8 pixel cells, 10 levels per octave and no padding.
+        batchsize (int): number of tiles detected at once, twice the number of
+            backends of the detector by default.
+        nms (float): maximum overlap between kept detections.
+    Returns:
+        A list of (bbox, score) pairs in decreasing order of score.
+    """
+    if builder == None and isinstance(detector.model, dpms.DPMModel):
+        builder = detector.model.pyramidbuilder(0)
+    elif builder == None:
+        builder = fp.PyramidBuilder(cachesize=0)
+    rows, cols = image.shape[0:2]
+    if builder.nbbytes(rows, cols) <= maxbytes:
+        return detector.detectObject(image, thresh, max_num)
+    if batchsize == None:
+        batchsize = 2 * len(detector.pool.backends)
+    size = tilesize(builder, maxbytes, overlap)
+    octaves = coarsescale(builder, rows, cols, maxbytes)
+    coarse = cv2.resize(image, (max(cols >> octaves, 1), max(rows >> octaves, 1)),
+                        interpolation=cv2.INTER_AREA)
+    # Tiles are views of the image, so only a batch of them is copied at a time
+    jobs = [(coarse, None, None)]
+    jobs += [(image[tile[1]:tile[3]+1,tile[0]:tile[2]+1], tile, core) for tile, core
+             in tiles(rows, cols, size, overlap, 8 * builder.sbin)]
+    instr.count('detection/tiles', len(jobs))
+    boxes = []
+    scores = []
+    with instr.timer('detection/tiled', image.nbytes):
+        for start in range(0, len(jobs), batchsize):
+            batch = jobs[start:start+batchsize]
+            results = detector.detectBatch([j[0] for j in batch], thresh, None)
+            for (subimage, tile, core), detections in zip(batch, results):
+                if detections == []:
+                    continue
+                b = geometry.toarray([bbox for bbox, score in detections])
+                s = np.array([score for bbox, score in detections], dtype=np.float64)
+                if tile == None:
+                    # Back to the original image
+                    b[:,0:2] <<= octaves
+                    b[:,2:4] = ((b[:,2:4] + 1) << octaves) - 1
+                    b[:,0::2] = np.minimum(b[:,0::2], cols - 1)
+                    b[:,1::2] = np.minimum(b[:,1::2], rows - 1)
+                else:
+                    b[:,0::2] += tile[0]
+                    b[:,1::2] += tile[1]
+                size = np.maximum(b[:,2] - b[:,0], b[:,3] - b[:,1]) + 1
+                large = size > overlap // 2
+                if tile == None:
+                    keep = large
+                else:
+                    cx = (b[:,0] + b[:,2]) / 2.0
+                    cy = (b[:,1] + b[:,3]) / 2.0
+                    keep = (~large & (cx >= core[0]) & (cx < core[2] + 1)
+                            & (cy >= core[1]) & (cy < core[3] + 1))
+                boxes.append(b[keep])
+                scores.append(s[keep])
+    if boxes == []:
+        return []
+    boxes = np.concatenate(boxes)
+    scores = np.concatenate(scores)
+    keep = geometry.nms(boxes, scores, nms, max_num=max_num)
+    return _todetections(boxes[keep], scores[keep])
@@ -0,0 +1,129 @@
+""" Import of models trained by the voc-dpm MATLAB code (voc-release5) into native
+models, see dpmscoring.py, to save them in the native format and detect without
+MATLAB.
+
+voc-dpm models are grammars: the rules of the start symbol are the components,
+their right hand sides the root filter followed by a symbol per part, each with a
+deformation rule placing the part filter. Weights are read from the blocks of the
+model when it has them, as voc-dpm's model_get_block does, mirroring the filters
+and deformation costs of mirrored components. voc-dpm features have a 32nd boundary
+truncation feature, which is dropped: native pyramids are padded with zeros instead.
+Only star models are imported, with their parts at twice the resolution of the root.
+Anchors are kept as they are, native scoring placing parts with the same virtual
+padding as voc-dpm, see dpmscoring.part_anchors.
+
+Reading .mat files requires scipy:
+
+python vocdpm.py model.mat model.dpm
+"""
+import argparse
+import numpy as np
+import dpmscoring as dpms
+import featpyramid as fp
+try:
+    import scipy.io as sio
+except ImportError:
+    sio = None
+
+# Permutation of the features of a cell mirrored horizontally, from voc-dpm's
+# flipfeat.m: contrast sensitive and insensitive orientations are mirrored, as well
+# as the texture features of the blocks around the cell.
+_flipped = np.array([10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 18, 17, 16, 15, 14, 13, 12, 11,
+                     19, 27, 26, 25, 24, 23, 22, 21, 20, 30, 31, 28, 29, 32]) - 1
+
+def _items(value):
+    """ Elements of a MATLAB struct array or cell array as read by scipy with
+        squeeze_me, which turns arrays of one element into the element itself.
+    """
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        return list(value.ravel())
+    return [value]
+
+def _block(vocmodel, obj):
+    """ Weights of a filter or deformation rule of a model, as model_get_block.
+    """
+    blocks = getattr(vocmodel, 'blocks', None)
+    if blocks is None or not hasattr(obj, 'blocklabel'):
+        # Older models only have the weights of each object, mirrored already
+        return np.asarray(obj.w, dtype=np.float64)
+    block = _items(blocks)[int(obj.blocklabel) - 1]
+    w = np.reshape(np.asarray(block.w, dtype=np.float64), np.atleast_1d(block.shape),
+                   order='F')
+    if bool(getattr(obj, 'flip', False)):
+        if w.ndim == 3:
+            w = w[:,::-1,_flipped[0:w.shape[2]]]
+        else:
+            # Mirrored deformations move the other way horizontally
+            w = w.ravel() * [1, -1, 1, 1]
+    return w
+
+def _rules(vocmodel, symbol):
+    return [r for r in _items(_items(vocmodel.rules)[symbol - 1])
+            if not isinstance(r, np.ndarray)]
+
+def _filter(vocmodel, symbol):
+    """ Filter of a terminal symbol, with the 31 native features.
+    """
+    sym = _items(vocmodel.symbols)[symbol - 1]
+    if sym.type != 'T':
+        raise ValueError("Symbol " + repr(symbol) + " is not a filter")
+    w = _block(vocmodel, _items(vocmodel.filters)[int(sym.filter) - 1])
+    return w[:,:,0:fp.nbfeatures]
+
+def convert(vocmodel):
+    """ Converts a voc-dpm model into a native one.
+    Args:
+        vocmodel: model struct, e.g. as read by scipy.io.loadmat with
+            squeeze_me=True and struct_as_record=False.
+    Returns:
+        The DPMModel.
+    """
+    bias = 1.0
+    if hasattr(vocmodel, 'features') and hasattr(vocmodel.features, 'bias'):
+        bias = float(vocmodel.features.bias)
+    components = []
+    for rule in _rules(vocmodel, int(vocmodel.start)):
+        if rule.type != 'S':
+            raise ValueError("Only star models are supported")
+        rhs = [int(s) for s in np.atleast_1d(rule.rhs)]
+        anchors = rule.anchor
+        if not (isinstance(anchors, np.ndarray) and anchors.dtype == object):
+            anchors = [anchors]
+        anchors = [np.atleast_1d(a).astype(np.int64) for a in anchors]
+        parts = []
+        for symbol, anchor in zip(rhs[1:], anchors[1:]):
+            deformations = _rules(vocmodel, symbol)
+            if len(deformations) != 1 or deformations[0].type != 'D':
+                raise ValueError("Only star models are supported")
+            if anchor[2] != 1:
+                raise ValueError("Only parts at twice the root resolution are "
+                                 + "supported")
+            deformation = deformations[0]
+            parts.append(dpms.Part(
+                _filter(vocmodel, int(np.atleast_1d(deformation.rhs)[0])),
+                anchor[0:2], _block(vocmodel, getattr(deformation, 'def'))))
+        offset = np.ravel(_block(vocmodel, rule.offset))[0]
+        components.append(dpms.Component(_filter(vocmodel, rhs[0]), parts,
+                                         offset * bias))
+    return dpms.DPMModel(components, int(vocmodel.sbin), int(vocmodel.interval))
+
+def import_model(filename, name='model'):
+    """ Reads a voc-dpm model from a .mat file, see convert.
+    Args:
+        filename (str): .mat file, as saved by voc-dpm's training code.
+        name (str): name of the model variable in the file.
+    """
+    if sio == None:
+        raise ImportError("scipy is required to read .mat files")
+    mat = sio.loadmat(filename, squeeze_me=True, struct_as_record=False)
+    return convert(mat[name])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts a voc-dpm model into a native model file.")
+    parser.add_argument('input', help=".mat file of the model")
+    parser.add_argument('output', help="native model file to write")
+    parser.add_argument('--name', default='model',
+                        help="name of the model variable in the .mat file")
+    args = parser.parse_args()
+    dpms.savemodel(import_model(args.input, args.name), args.output)